@@ -2,7 +2,11 @@ import logging
 from pathlib import Path
 
 from .args import get_settings
+from .catalog import Catalog
+from .config.defaults import STAGING_MAX_AGE
+from .layout import StorageLayout
 from .loadlogger import LoggingConfigurator
+from .upload import clean_staging
 from .web import start
 
 LOGGER = logging.getLogger(__name__)
@@ -14,7 +18,12 @@ def configure_logging(settings):
     log_level = settings["log_level"]
 
     try:
-        LoggingConfigurator.configure(log_config_path=log_config, log_level=log_level)
+        LoggingConfigurator.configure(
+            log_config_path=log_config,
+            log_level=log_level,
+            queue_size=settings.get("log_queue_size"),
+            overflow=settings.get("log_overflow") or "drop",
+        )
 
     except Exception as e:
         raise Exception("Logger configuration failed: ", e)
@@ -24,6 +33,41 @@ def main():
     settings = get_settings()
     Path(settings["storage_path"]).mkdir(parents=True, exist_ok=True)
     configure_logging(settings)
+    clean_staging(settings["storage_path"], STAGING_MAX_AGE)
+
+    local = settings["storage_backend"] == "local"
+    if not local and not settings["s3_bucket"]:
+        raise SystemExit("--storage-backend s3 requires --s3-bucket")
+
+    if settings["migrate_storage_layout"]:
+        if not local:
+            raise SystemExit("--migrate-storage-layout requires local storage")
+        StorageLayout(settings["storage_path"], sharded=True).migrate()
+        return
+
+    if settings["rebuild_catalog"] and not local:
+        raise SystemExit("--rebuild-catalog requires local storage")
+    if settings["catalog"]:
+        catalog = Catalog(settings["catalog"])
+        try:
+            if settings["rebuild_catalog"]:
+                catalog.rebuild(
+                    StorageLayout(
+                        settings["storage_path"],
+                        settings["storage_layout"] == "sharded",
+                    )
+                )
+            # A catalog of remote storage is filled in as files are uploaded;
+            # a new one of local storage in the background once serving
+            elif local and catalog.created:
+                settings["fill_catalog"] = True
+        finally:
+            catalog.close()
+    elif settings["rebuild_catalog"]:
+        raise SystemExit("--rebuild-catalog requires --catalog")
+    if settings["rebuild_catalog"]:
+        return
+
     start(settings)
 
 
@@ -2,6 +2,17 @@
 
 import argparse
 
+from .config.defaults import (
+    DEFAULT_INDEX_REFRESH_INTERVAL,
+    DEFAULT_LEDGER_POOL_CACHE_SIZE,
+    DEFAULT_LEDGER_POOL_IDLE_TIMEOUT,
+    DEFAULT_LEDGER_POOL_REFRESH_INTERVAL,
+    DEFAULT_MAX_UPLOAD_SIZE,
+    DEFAULT_REV_REG_DEF_CACHE_SIZE,
+    DEFAULT_REV_REG_DEF_NEGATIVE_TTL,
+)
+from .logqueue import OVERFLOW_POLICIES
+
 PARSER = argparse.ArgumentParser(description="Runs the server.")
 
 
@@ -23,6 +34,17 @@ PARSER.add_argument(
     help="Specify the port on which to accept connections.",
 )
 
+PARSER.add_argument(
+    "--workers",
+    type=int,
+    required=False,
+    dest="workers",
+    metavar="<workers>",
+    default=1,
+    help="Number of server processes sharing the listening socket. Crashed "
+    "workers are restarted.",
+)
+
 PARSER.add_argument(
     "--log-level",
     type=str,
@@ -43,6 +65,39 @@ PARSER.add_argument(
     help="Specifies a custom logging configuration file",
 )
 
+PARSER.add_argument(
+    "--log-queue-size",
+    type=int,
+    required=False,
+    dest="log_queue_size",
+    metavar="<records>",
+    help="Hand log records to background threads, with at most this many "
+    "waiting, so slow log sinks do not stall requests. Logs synchronously by "
+    "default.",
+)
+
+PARSER.add_argument(
+    "--log-overflow",
+    type=str,
+    required=False,
+    choices=OVERFLOW_POLICIES,
+    dest="log_overflow",
+    default="drop",
+    help="What to do with log records when the log queue is full: drop them, "
+    "or block until there is room. Defaults to drop.",
+)
+
+PARSER.add_argument(
+    "--access-log-sample-rate",
+    type=float,
+    required=False,
+    dest="access_log_sample_rate",
+    metavar="<fraction>",
+    default=1.0,
+    help="Fraction of successful requests written to the access log. Requests "
+    "that fail are always logged. Defaults to 1.",
+)
+
 PARSER.add_argument(
     "--storage-path",
     type=str,
@@ -52,6 +107,259 @@ PARSER.add_argument(
     help="Specify the path to store files.",
 )
 
+PARSER.add_argument(
+    "--max-upload-size",
+    type=int,
+    required=False,
+    dest="max_upload_size",
+    metavar="<bytes>",
+    default=DEFAULT_MAX_UPLOAD_SIZE,
+    help="Reject uploads larger than this. Defaults to 1 GiB.",
+)
+
+PARSER.add_argument(
+    "--storage-layout",
+    type=str,
+    required=False,
+    dest="storage_layout",
+    choices=("flat", "sharded"),
+    default="flat",
+    help="Store tails files directly in the storage path (flat), or spread over "
+    "subdirectories (sharded). Defaults to flat.",
+)
+
+PARSER.add_argument(
+    "--migrate-storage-layout",
+    action="store_true",
+    dest="migrate_storage_layout",
+    help="Move tails files stored directly in the storage path into the sharded "
+    "layout and exit. Safe to run while servers using the sharded layout are "
+    "running.",
+)
+
+PARSER.add_argument(
+    "--storage-backend",
+    type=str,
+    required=False,
+    dest="storage_backend",
+    choices=("local", "s3"),
+    default="local",
+    help="Keep tails files under the storage path (local) or in an S3 bucket "
+    "(s3). Defaults to local.",
+)
+
+PARSER.add_argument(
+    "--s3-bucket",
+    type=str,
+    required=False,
+    dest="s3_bucket",
+    metavar="<bucket>",
+    help="Bucket to store tails files in with the s3 storage backend. "
+    "Credentials are read from AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and "
+    "AWS_SESSION_TOKEN.",
+)
+
+PARSER.add_argument(
+    "--s3-region",
+    type=str,
+    required=False,
+    dest="s3_region",
+    metavar="<region>",
+    help="Region of the S3 bucket. Defaults to AWS_REGION, or us-east-1.",
+)
+
+PARSER.add_argument(
+    "--s3-endpoint",
+    type=str,
+    required=False,
+    dest="s3_endpoint",
+    metavar="<url>",
+    help="URL of an S3-compatible service to use instead of AWS, e.g. MinIO.",
+)
+
+PARSER.add_argument(
+    "--s3-prefix",
+    type=str,
+    required=False,
+    dest="s3_prefix",
+    metavar="<prefix>",
+    default="",
+    help="Store tails files under this key prefix in the bucket.",
+)
+
+PARSER.add_argument(
+    "--upstream",
+    type=str,
+    required=False,
+    dest="upstream",
+    metavar="<url>",
+    help="Run as a mirror of the tails server at this URL: tails files that are "
+    "not stored locally are fetched from it, verified and stored.",
+)
+
+PARSER.add_argument(
+    "--peer",
+    type=str,
+    required=False,
+    action="append",
+    dest="peers",
+    metavar="<url>",
+    default=[],
+    help="URL of a peer tails server to replicate tails files with. Uploads are "
+    "announced to every peer, and files stored on the peers but not here are "
+    "pulled at startup. May be given several times.",
+)
+
+PARSER.add_argument(
+    "--catalog",
+    type=str,
+    required=False,
+    dest="catalog",
+    metavar="<path>",
+    help="Record stored tails files in an SQLite catalog at this path, which "
+    "must be on a local filesystem. Disabled by default.",
+)
+
+PARSER.add_argument(
+    "--rebuild-catalog",
+    action="store_true",
+    dest="rebuild_catalog",
+    help="Rescan the storage path into the catalog and exit.",
+)
+
+PARSER.add_argument(
+    "--index-refresh-interval",
+    type=int,
+    required=False,
+    dest="index_refresh_interval",
+    metavar="<seconds>",
+    default=DEFAULT_INDEX_REFRESH_INTERVAL,
+    help="Rescan the storage directory this often to pick up files stored by "
+    "other processes. Set to 0 to only scan at startup.",
+)
+
+PARSER.add_argument(
+    "--cache-size",
+    type=int,
+    required=False,
+    dest="cache_size",
+    metavar="<bytes>",
+    default=0,
+    help="Keep up to this many bytes of frequently downloaded tails files in "
+    "memory. Disabled by default.",
+)
+
+PARSER.add_argument(
+    "--cache-max-file-size",
+    type=int,
+    required=False,
+    dest="cache_max_file_size",
+    metavar="<bytes>",
+    help="Do not cache tails files larger than this. Defaults to 16 MiB.",
+)
+
+PARSER.add_argument(
+    "--ledger-pool-cache-size",
+    type=int,
+    required=False,
+    dest="ledger_pool_cache_size",
+    metavar="<pools>",
+    default=DEFAULT_LEDGER_POOL_CACHE_SIZE,
+    help="Number of ledger pools kept open for reuse between uploads. Set to 0 "
+    "to open a new pool for every upload.",
+)
+
+PARSER.add_argument(
+    "--ledger-pool-idle-timeout",
+    type=int,
+    required=False,
+    dest="ledger_pool_idle_timeout",
+    metavar="<seconds>",
+    default=DEFAULT_LEDGER_POOL_IDLE_TIMEOUT,
+    help="Close cached ledger pools that have not been used for this long.",
+)
+
+PARSER.add_argument(
+    "--ledger-pool-refresh-interval",
+    type=int,
+    required=False,
+    dest="ledger_pool_refresh_interval",
+    metavar="<seconds>",
+    default=DEFAULT_LEDGER_POOL_REFRESH_INTERVAL,
+    help="Refresh the node list of cached ledger pools this often.",
+)
+
+PARSER.add_argument(
+    "--rev-reg-def-cache-size",
+    type=int,
+    required=False,
+    dest="rev_reg_def_cache_size",
+    metavar="<entries>",
+    default=DEFAULT_REV_REG_DEF_CACHE_SIZE,
+    help="Number of revocation registry definitions kept in memory. Set to 0 to "
+    "look up every upload on the ledger.",
+)
+
+PARSER.add_argument(
+    "--rev-reg-def-negative-ttl",
+    type=int,
+    required=False,
+    dest="rev_reg_def_negative_ttl",
+    metavar="<seconds>",
+    default=DEFAULT_REV_REG_DEF_NEGATIVE_TTL,
+    help="How long to remember that a revocation registry was not found or its "
+    "id was invalid.",
+)
+
+PARSER.add_argument(
+    "--fake-ledger",
+    type=str,
+    required=False,
+    dest="fake_ledger",
+    metavar="<fixture_dir>",
+    help="Serve revocation registry definitions from the JSON files in this "
+    "directory instead of the ledger. For testing and benchmarking only.",
+)
+
+PARSER.add_argument(
+    "--fake-ledger-latency",
+    type=float,
+    required=False,
+    dest="fake_ledger_latency",
+    metavar="<seconds>",
+    default=0,
+    help="How long each lookup on the fake ledger takes.",
+)
+
+PARSER.add_argument(
+    "--fake-ledger-error-rate",
+    type=float,
+    required=False,
+    dest="fake_ledger_error_rate",
+    metavar="<fraction>",
+    default=0,
+    help="Fraction of lookups on the fake ledger that fail.",
+)
+
+PARSER.add_argument(
+    "--fake-ledger-timeout-rate",
+    type=float,
+    required=False,
+    dest="fake_ledger_timeout_rate",
+    metavar="<fraction>",
+    default=0,
+    help="Fraction of lookups on the fake ledger that time out.",
+)
+
+PARSER.add_argument(
+    "--fake-ledger-seed",
+    type=int,
+    required=False,
+    dest="fake_ledger_seed",
+    metavar="<seed>",
+    help="Seed choosing which lookups on the fake ledger fail, for repeatable runs.",
+)
+
 
 def get_settings():
     """Convert command line arguments to a settings dictionary."""
@@ -61,10 +369,45 @@ def get_settings():
 
     settings["host"] = args.host
     settings["port"] = args.port
+    settings["workers"] = args.workers
 
     settings["log_config"] = args.log_config
     settings["log_level"] = args.log_level
+    settings["log_queue_size"] = args.log_queue_size
+    settings["log_overflow"] = args.log_overflow
+    settings["access_log_sample_rate"] = args.access_log_sample_rate
 
     settings["storage_path"] = args.storage_path
+    settings["storage_layout"] = args.storage_layout
+    settings["migrate_storage_layout"] = args.migrate_storage_layout
+    settings["storage_backend"] = args.storage_backend
+    settings["s3_bucket"] = args.s3_bucket
+    settings["s3_region"] = args.s3_region
+    settings["s3_endpoint"] = args.s3_endpoint
+    settings["s3_prefix"] = args.s3_prefix
+    settings["max_upload_size"] = args.max_upload_size
+    settings["index_refresh_interval"] = args.index_refresh_interval
+
+    settings["upstream"] = args.upstream
+    settings["peers"] = args.peers
+
+    settings["catalog"] = args.catalog
+    settings["rebuild_catalog"] = args.rebuild_catalog
+
+    settings["cache_size"] = args.cache_size
+    settings["cache_max_file_size"] = args.cache_max_file_size
+
+    settings["ledger_pool_cache_size"] = args.ledger_pool_cache_size
+    settings["ledger_pool_idle_timeout"] = args.ledger_pool_idle_timeout
+    settings["ledger_pool_refresh_interval"] = args.ledger_pool_refresh_interval
+
+    settings["rev_reg_def_cache_size"] = args.rev_reg_def_cache_size
+    settings["rev_reg_def_negative_ttl"] = args.rev_reg_def_negative_ttl
+
+    settings["fake_ledger"] = args.fake_ledger
+    settings["fake_ledger_latency"] = args.fake_ledger_latency
+    settings["fake_ledger_error_rate"] = args.fake_ledger_error_rate
+    settings["fake_ledger_timeout_rate"] = args.fake_ledger_timeout_rate
+    settings["fake_ledger_seed"] = args.fake_ledger_seed
 
     return settings
@@ -0,0 +1,68 @@
+"""In-memory cache for frequently downloaded tails files."""
+
+import logging
+from collections import OrderedDict
+from typing import NamedTuple
+
+from . import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CachedTailsFile(NamedTuple):
+    """Contents and validators of a cached tails file."""
+
+    data: bytes
+    mtime: float
+    tails_hash: str
+
+
+class TailsCache:
+    """Byte-budgeted LRU cache of tails file contents, keyed by tailsHash.
+
+    A file stored under several names is cached once. Only used from the event
+    loop, so no locking is needed.
+    """
+
+    def __init__(self, max_bytes: int, max_file_bytes: int):
+        """Initialize the cache.
+
+        Args:
+            max_bytes: Total size of cached file contents.
+            max_file_bytes: Files larger than this are never cached.
+        """
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes, max_bytes)
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def __contains__(self, tails_hash: str) -> bool:
+        return tails_hash in self._entries
+
+    def accepts(self, size: int) -> bool:
+        """Check whether a file of `size` bytes may be cached."""
+        return size <= self.max_file_bytes
+
+    def get(self, tails_hash: str):
+        """Return the cached entry for `tails_hash`, or None."""
+        entry = self._entries.get(tails_hash)
+        if entry is None:
+            metrics.TAILS_CACHE_LOOKUPS.inc("miss")
+            return None
+        self._entries.move_to_end(tails_hash)
+        metrics.TAILS_CACHE_LOOKUPS.inc("hit")
+        return entry
+
+    def put(self, tails_hash: str, entry: CachedTailsFile):
+        """Cache `entry`, evicting least recently used files to make room."""
+        if not self.accepts(len(entry.data)) or tails_hash in self._entries:
+            return
+        while self.size + len(entry.data) > self.max_bytes:
+            evicted_hash, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted.data)
+            metrics.TAILS_CACHE_EVICTIONS.inc()
+            LOGGER.debug(f"Evicted {evicted_hash} from tails cache")
+        self._entries[tails_hash] = entry
+        self.size += len(entry.data)
+        metrics.TAILS_CACHE_FILES.set(len(self._entries))
+        metrics.TAILS_CACHE_BYTES.set(self.size)
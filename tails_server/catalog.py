@@ -0,0 +1,180 @@
+"""SQLite catalog of stored tails files."""
+
+import asyncio
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from .config.defaults import CATALOG_BUSY_TIMEOUT, CATALOG_FILL_LOCK
+from .download import hash_tails_file
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tails_files (
+    name TEXT PRIMARY KEY,
+    tails_hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tails_files_by_hash ON tails_files (tails_hash);
+"""
+
+
+class CatalogEntry(NamedTuple):
+    """What the catalog knows about a stored tails file."""
+
+    name: str
+    tails_hash: str
+    size: int
+    mtime: float
+
+
+class Catalog:
+    """Name, tailsHash, size and upload time of every stored tails file.
+
+    The database runs in WAL mode, so the workers of one server read it
+    concurrently while another writes. WAL relies on shared memory, so the
+    database must live on a local filesystem even if the tails files do not.
+
+    Queries run on a dedicated thread that owns the connection; use `run` to
+    call the methods below from the event loop.
+    """
+
+    def __init__(self, path):
+        """Open, and if needed create, the catalog at `path`."""
+        self.path = path
+        self.created = not os.path.exists(path)
+        self._db = sqlite3.connect(
+            path,
+            timeout=CATALOG_BUSY_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="catalog")
+
+    async def run(self, method, *args):
+        """Call one of the catalog's methods on its thread."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, method, *args
+        )
+
+    def get(self, name):
+        """Return the entry for the file called `name`, or None."""
+        row = self._db.execute(
+            "SELECT name, tails_hash, size, mtime FROM tails_files WHERE name = ?",
+            (name,),
+        ).fetchone()
+        return CatalogEntry(*row) if row else None
+
+    def put(self, entry):
+        """Record a stored file."""
+        self._db.execute(
+            "INSERT OR REPLACE INTO tails_files (name, tails_hash, size, mtime) "
+            "VALUES (?, ?, ?, ?)",
+            entry,
+        )
+
+    def remove(self, name):
+        """Forget a file that is no longer stored."""
+        self._db.execute("DELETE FROM tails_files WHERE name = ?", (name,))
+
+    def names(self):
+        """Return the names of all catalogued files."""
+        return {name for (name,) in self._db.execute("SELECT name FROM tails_files")}
+
+    def stored_bytes(self):
+        """Return the total size of the distinct files catalogued."""
+        (size,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM "
+            "(SELECT MAX(size) AS size FROM tails_files GROUP BY tails_hash)"
+        ).fetchone()
+        return size
+
+    def rebuild(self, layout, stop=None):
+        """Bring the catalog in line with the files stored in `layout`.
+
+        Files whose size and modification time match their entry are not hashed
+        again, so rescanning an up-to-date store is cheap. Setting the
+        `threading.Event` `stop` abandons the rebuild after the current file,
+        keeping the entries added so far.
+        """
+        known = {
+            entry.name: entry
+            for entry in map(
+                CatalogEntry._make,
+                self._db.execute(
+                    "SELECT name, tails_hash, size, mtime FROM tails_files"
+                ),
+            )
+        }
+        stored = layout.names()
+
+        added = 0
+        for name in sorted(stored):
+            if stop is not None and stop.is_set():
+                LOGGER.info(f"Stopped rebuilding tails file catalog: {added} added")
+                return
+            try:
+                with layout.open(name) as tails_file:
+                    st = os.fstat(tails_file.fileno())
+                    entry = known.get(name)
+                    if entry and (entry.size, entry.mtime) == (st.st_size, st.st_mtime):
+                        continue
+                    tails_hash = hash_tails_file(tails_file)
+            except FileNotFoundError:
+                stored.discard(name)
+                continue
+            self.put(CatalogEntry(name, tails_hash, st.st_size, st.st_mtime))
+            added += 1
+
+        removed = known.keys() - stored
+        self._db.executemany(
+            "DELETE FROM tails_files WHERE name = ?", ((name,) for name in removed)
+        )
+        LOGGER.info(
+            f"Rebuilt tails file catalog: {added} added or updated, "
+            f"{len(removed)} removed, {len(stored)} files"
+        )
+
+    def close(self):
+        """Close the catalog."""
+        self._executor.shutdown()
+        self._db.close()
+
+
+async def fill_catalog(path, layout):
+    """Rebuild the catalog at `path` from `layout`, e.g. once it was just created.
+
+    Runs on a connection and thread of its own, so lookups and uploads keep
+    using the catalog meanwhile; files not catalogued yet are hashed on
+    demand. Workers of one server share their catalog, so only one of them
+    fills it.
+    """
+    lock = os.open(path + CATALOG_FILL_LOCK, os.O_RDONLY | os.O_CREAT, 0o644)
+    catalog = None
+    stop = threading.Event()
+    try:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        catalog = Catalog(path)
+        await catalog.run(catalog.rebuild, layout, stop)
+    except asyncio.CancelledError:
+        stop.set()
+        raise
+    except Exception:
+        LOGGER.exception("Filling the tails file catalog failed")
+    finally:
+        if catalog is not None:
+            # Waits for the rebuild to notice `stop`
+            catalog.close()
+        os.close(lock)
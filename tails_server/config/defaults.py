@@ -1,3 +1,105 @@
 DEFAULT_WEB_HOST = "127.0.0.1"
 DEFAULT_WEB_PORT = 6543
+SHUTDOWN_TIMEOUT = 60
+
+# Multi-process worker mode
+WORKER_RESTART_DELAY = 1
+WORKER_KILL_GRACE = 5
 CHUNK_SIZE = 8192
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+# Upper bound on distinct byte ranges served in one multipart/byteranges response
+MAX_RANGES = 16
+
+# Tails files are immutable once published
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+MAX_REMEMBERED_HASHES = 65536
+
+# Characters of a base58-encoded tailsHash
+BASE58_CHARS = frozenset("123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz")
+
+# Tails file layout: a 2-byte version tag ("00 02") followed by 128-byte tails
+TAILS_VERSION_TAG = b"\x00\x02"
+TAIL_SIZE = 128
+MAX_TAILS_PER_REQUEST = 1024
+
+# The in-memory tails cache is disabled unless a size is given
+DEFAULT_CACHE_MAX_FILE_SIZE = 16 * 1024 * 1024
+
+# Open ledger pools kept for reuse across uploads
+DEFAULT_LEDGER_POOL_CACHE_SIZE = 8
+DEFAULT_LEDGER_POOL_IDLE_TIMEOUT = 15 * 60
+DEFAULT_LEDGER_POOL_REFRESH_INTERVAL = 60 * 60
+POOL_MAINTENANCE_INTERVAL = 30
+
+# Revocation registry definitions looked up on the ledger
+DEFAULT_REV_REG_DEF_CACHE_SIZE = 4096
+DEFAULT_REV_REG_DEF_NEGATIVE_TTL = 30
+
+# Seconds the fake ledger takes to report an injected timeout, as indy_vdr's
+# default request timeout
+FAKE_LEDGER_TIMEOUT = 20
+
+# Uploads are staged in this directory under the storage path, then linked into
+# place. Staging files older than STAGING_MAX_AGE are removed at startup.
+STAGING_DIR = ".staging"
+STAGING_MAX_AGE = 24 * 60 * 60
+
+# Upload reads start at CHUNK_SIZE and grow up to UPLOAD_MAX_CHUNK_SIZE; at most
+# UPLOAD_QUEUE_DEPTH chunks per upload wait to be hashed and written.
+UPLOAD_MAX_CHUNK_SIZE = 1024 * 1024
+UPLOAD_QUEUE_DEPTH = 4
+UPLOAD_HEAD_SIZE = 16
+
+# Seconds a duplicate upload waits for the upload of the same file in progress
+UPLOAD_CLAIM_TIMEOUT = 30
+
+# Largest request body accepted by the upload endpoints
+DEFAULT_MAX_UPLOAD_SIZE = 1024 * 1024 * 1024
+
+# The filename index is reconciled with the storage directory this often. It
+# keeps names in sorted blocks of up to 2 * INDEX_BLOCK_SIZE names, so a change
+# only re-sorts and re-joins one block.
+DEFAULT_INDEX_REFRESH_INTERVAL = 60
+INDEX_BLOCK_SIZE = 1024
+
+# Registry queries stream NDJSON in pages of at most MAX_QUERY_LIMIT records,
+# written QUERY_BATCH_SIZE records at a time
+NDJSON = "application/x-ndjson"
+DEFAULT_QUERY_LIMIT = 100
+MAX_QUERY_LIMIT = 10000
+QUERY_BATCH_SIZE = 100
+
+# Seconds to wait for another process holding a lock on the catalog
+CATALOG_BUSY_TIMEOUT = 30
+# One worker per catalog, holding the catalog path + CATALOG_FILL_LOCK, fills a
+# new catalog in the background
+CATALOG_FILL_LOCK = ".fill.lock"
+
+# Sharded storage keeps files in subdirectories named by this many hex digits
+# of the SHA-256 of their name
+SHARD_PREFIX_LENGTH = 2
+
+# Uploads to object stores are sent in parts of this size; S3 requires at least
+# 5 MiB for all but the last part
+S3_PART_SIZE = 8 * 1024 * 1024
+
+# Mirror mode: files missing locally are fetched from an upstream tails server.
+# Downloads of files up to MIRROR_STREAM_MAX_SIZE are streamed to clients while
+# they are being fetched; larger ones are served once stored.
+UPSTREAM_TIMEOUT = 60
+MIRROR_STREAM_MAX_SIZE = 64 * 1024 * 1024
+
+# Peer replication: at most REPLICATION_CONCURRENCY files are pulled at once,
+# announcements are refused while REPLICATION_MAX_PENDING names are waiting to
+# be pulled, and one worker per storage path, holding REPLICATION_LOCK, catches
+# up with the peers at startup
+REPLICATION_CONCURRENCY = 4
+REPLICATION_MAX_PENDING = 10000
+REPLICATION_LOCK = ".replication.lock"
+
+# Request and ledger lookup latencies are counted in buckets of these bounds,
+# in seconds. In worker mode, each worker saves its metrics for the others to
+# report every METRICS_FLUSH_INTERVAL seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_FLUSH_INTERVAL = 5
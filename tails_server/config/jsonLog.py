@@ -1,26 +1,49 @@
 # Python3 logging custom formatter.
 # For more information, please visit: https://docs.python.org/3/library/logging.html
+import itertools
 import json
 import logging
 import socket
+import time
 import uuid
-from datetime import datetime
 
 hostname = socket.gethostname()
 
 
 class JsonFormatter(logging.Formatter):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Records of the same second share the formatted date and time
+        self._second = (None, None)
+        self._log_ids = (None, None, None)
+
+    def _timestamp(self, record):
+        second, text = self._second
+        if int(record.created) != second:
+            second = int(record.created)
+            text = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(second))
+            self._second = (second, text)
+        # Only 3 Milliseconds
+        return f"{text}.{int(record.msecs):03d}Z"
+
+    def _log_id(self, record):
+        # Log ids keep the shape of a random UUID, but only its first 20 hex
+        # digits are random, drawn once per process; the last 12 count records
+        pid, prefix, counter = self._log_ids
+        if record.process != pid:
+            prefix = str(uuid.uuid4())[:-12]
+            counter = itertools.count()
+            self._log_ids = (record.process, prefix, counter)
+        return f"{prefix}{next(counter) % 16**12:012x}"
+
     def format(self, record):
         # Interpolates record message properly
         record.msg = super().format(record)
 
         jsonLog = {
-            "timestamp": datetime.fromtimestamp(record.created).strftime(
-                "%Y-%m-%dT%H:%M:%S.%f"
-            )[:-3]
-            + "Z",  # Only 3 Milliseconds
+            "timestamp": self._timestamp(record),
             "level": record.levelname,
-            "logId": str(uuid.uuid4()),
+            "logId": self._log_id(record),
             "service": "tails",
             "hostname": hostname,
             "pid": record.process,
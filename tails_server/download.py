@@ -0,0 +1,448 @@
+"""Download responses for stored tails files."""
+
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+from functools import partial
+
+import base58
+from aiohttp import hdrs, web
+
+from .cache import CachedTailsFile
+from .config.defaults import (
+    BASE58_CHARS,
+    CACHE_CONTROL,
+    DOWNLOAD_CHUNK_SIZE,
+    MAX_RANGES,
+    MAX_REMEMBERED_HASHES,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+NOSENDFILE = bool(os.environ.get("AIOHTTP_NOSENDFILE"))
+
+OCTET_STREAM = "application/octet-stream"
+
+# Tails files are never modified once published, so the tailsHash of a file
+# served by revocation registry id only has to be worked out once.
+_tails_hashes = {}
+
+# Files whose tailsHash is being worked out in the background, by name
+_hashing = {}
+
+
+def remember_tails_hash(file_name, tails_hash):
+    """Record the tailsHash of a published file for use as its ETag."""
+    if len(_tails_hashes) >= MAX_REMEMBERED_HASHES:
+        _tails_hashes.pop(next(iter(_tails_hashes)))
+    _tails_hashes[file_name] = tails_hash
+
+
+def is_tails_hash(value):
+    """Check whether `value` could be a base58-encoded tailsHash."""
+    return bool(value) and set(value) <= BASE58_CHARS
+
+
+def hash_tails_data(data):
+    """Return the base58-encoded SHA-256 digest of tails file contents."""
+    return base58.b58encode(hashlib.sha256(data).digest()).decode("utf-8")
+
+
+def hash_tails_file(tails_file):
+    """Return the base58-encoded SHA-256 digest of an open tails file."""
+    sha256 = hashlib.sha256()
+    offset = 0
+    while chunk := os.pread(tails_file.fileno(), DOWNLOAD_CHUNK_SIZE, offset):
+        sha256.update(chunk)
+        offset += len(chunk)
+    return base58.b58encode(sha256.digest()).decode("utf-8")
+
+
+def _hash_local_file(layout, file_name):
+    with layout.open(file_name) as tails_file:
+        return hash_tails_file(tails_file)
+
+
+async def _hash_stored_file(storage, file_name):
+    sha256 = hashlib.sha256()
+    async for chunk in storage.read(file_name):
+        sha256.update(chunk)
+    return base58.b58encode(sha256.digest()).decode("utf-8")
+
+
+def _hashed(file_name, hashing):
+    del _hashing[file_name]
+    if not hashing.cancelled() and hashing.exception() is None:
+        remember_tails_hash(file_name, hashing.result())
+
+
+def _hash_later(file_name, hashing):
+    """Remember the tailsHash of `file_name` once the `hashing` awaitable has it.
+
+    Only one file of each name is hashed at a time.
+    """
+    if file_name in _hashing:
+        if asyncio.iscoroutine(hashing):
+            hashing.close()
+        return
+    task = asyncio.ensure_future(hashing)
+    _hashing[file_name] = task
+    task.add_done_callback(partial(_hashed, file_name))
+
+
+def _needs_etag(request):
+    """Check whether the answer to `request` depends on the file's ETag."""
+    return (
+        hdrs.IF_MATCH in request.headers
+        or hdrs.IF_NONE_MATCH in request.headers
+        or request.headers.get(hdrs.IF_RANGE, "").startswith('"')
+    )
+
+
+def parse_range(header, size):
+    """Parse a `Range` header against a representation of `size` bytes.
+
+    Returns a sorted list of coalesced `(start, stop)` byte offsets, or None if
+    the header is not a well-formed bytes range and must be ignored.
+
+    Raises `web.HTTPRequestRangeNotSatisfiable` if no range overlaps the file or
+    the request asks for more than `MAX_RANGES` distinct ranges.
+    """
+    unit, sep, spec = header.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        first, sep, last = part.strip().partition("-")
+        if not sep or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+
+        if first:
+            start = int(first)
+            stop = int(last) + 1 if last else size
+            if last and stop <= start:
+                return None
+        else:
+            # Suffix range: the last N bytes of the file
+            start, stop = max(size - int(last), 0), size
+            if int(last) == 0:
+                continue
+
+        if start < size:
+            ranges.append((start, min(stop, size)))
+
+    unsatisfiable = web.HTTPRequestRangeNotSatisfiable(
+        headers={hdrs.CONTENT_RANGE: f"bytes */{size}"}
+    )
+    if not ranges:
+        raise unsatisfiable
+
+    # Overlapping and adjacent ranges are served as one part
+    ranges.sort()
+    coalesced = [ranges[0]]
+    for start, stop in ranges[1:]:
+        last_start, last_stop = coalesced[-1]
+        if start <= last_stop:
+            coalesced[-1] = (last_start, max(last_stop, stop))
+        else:
+            coalesced.append((start, stop))
+
+    if len(coalesced) > MAX_RANGES:
+        raise unsatisfiable
+
+    return coalesced
+
+
+def _open_tails_file(layout, file_name):
+    tails_file = layout.open(file_name)
+    try:
+        st = os.fstat(tails_file.fileno())
+    except OSError:
+        tails_file.close()
+        raise
+    return tails_file, st
+
+
+def _etag_matches(etag, etags, weak):
+    return any(
+        candidate.value in (etag, "*")
+        for candidate in etags
+        if weak or not candidate.is_weak
+    )
+
+
+def _check_preconditions(request, mtime, etag):
+    """Evaluate `If-Match`, `If-None-Match` and `If-Modified-Since`."""
+    if request.if_match is not None and not _etag_matches(
+        etag, request.if_match, weak=False
+    ):
+        raise web.HTTPPreconditionFailed()
+
+    headers = {hdrs.CACHE_CONTROL: CACHE_CONTROL}
+    if etag is not None:
+        headers[hdrs.ETAG] = f'"{etag}"'
+    not_modified = web.HTTPNotModified(headers=headers)
+    if request.if_none_match is not None:
+        if _etag_matches(etag, request.if_none_match, weak=True):
+            raise not_modified
+    elif (
+        request.if_modified_since is not None
+        and int(mtime) <= request.if_modified_since.timestamp()
+    ):
+        raise not_modified
+
+
+def _range_requested(request, mtime, etag):
+    """Evaluate `If-Range`: only honour `Range` if the validator still matches."""
+    if_range = request.headers.get(hdrs.IF_RANGE)
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == f'"{etag}"'
+    since = request.if_range
+    return since is not None and int(mtime) <= since.timestamp()
+
+
+def _read_tails_file(tails_file, size):
+    return os.pread(tails_file.fileno(), size, 0)
+
+
+async def _write_file_range(request, response, offset, count, tails_file):
+    loop = asyncio.get_running_loop()
+    if not NOSENDFILE:
+        transport = request.transport
+        if transport is None:
+            raise ConnectionResetError("Connection lost")
+        # Falls back to reads in the default executor on transports without
+        # sendfile support, e.g. TLS.
+        await loop.sendfile(transport, tails_file, offset, count)
+        return
+
+    while count > 0:
+        chunk = await loop.run_in_executor(
+            None,
+            os.pread,
+            tails_file.fileno(),
+            min(DOWNLOAD_CHUNK_SIZE, count),
+            offset,
+        )
+        if not chunk:
+            break
+        await response.write(chunk)
+        offset += len(chunk)
+        count -= len(chunk)
+
+
+async def _write_memory_range(request, response, offset, count, data):
+    view = memoryview(data)
+    for start in range(offset, offset + count, DOWNLOAD_CHUNK_SIZE):
+        await response.write(
+            view[start : min(start + DOWNLOAD_CHUNK_SIZE, offset + count)]
+        )
+
+
+async def _send(request, size, mtime, tails_hash, write_range):
+    _check_preconditions(request, mtime, tails_hash)
+
+    ranges = None
+    if hdrs.RANGE in request.headers and _range_requested(request, mtime, tails_hash):
+        ranges = parse_range(request.headers[hdrs.RANGE], size)
+
+    response = web.StreamResponse()
+    response.etag = tails_hash
+    response.last_modified = mtime
+    response.headers[hdrs.CACHE_CONTROL] = CACHE_CONTROL
+    response.headers[hdrs.ACCEPT_RANGES] = "bytes"
+
+    if not ranges:
+        parts = [(0, size, None)]
+        response.content_type = OCTET_STREAM
+        response.content_length = size
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        parts = [(start, stop, None)]
+        response.set_status(web.HTTPPartialContent.status_code)
+        response.content_type = OCTET_STREAM
+        response.content_length = stop - start
+        response.headers[hdrs.CONTENT_RANGE] = f"bytes {start}-{stop - 1}/{size}"
+    else:
+        boundary = secrets.token_hex(16)
+        parts = [
+            (
+                start,
+                stop,
+                (
+                    f"\r\n--{boundary}\r\n"
+                    f"{hdrs.CONTENT_TYPE}: {OCTET_STREAM}\r\n"
+                    f"{hdrs.CONTENT_RANGE}: bytes {start}-{stop - 1}/{size}\r\n"
+                    "\r\n"
+                ).encode("latin-1"),
+            )
+            for start, stop in ranges
+        ]
+        trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+        response.set_status(web.HTTPPartialContent.status_code)
+        response.headers[hdrs.CONTENT_TYPE] = (
+            f"multipart/byteranges; boundary={boundary}"
+        )
+        response.content_length = len(trailer) + sum(
+            len(head) + stop - start for start, stop, head in parts
+        )
+
+    await response.prepare(request)
+    if request.method != hdrs.METH_HEAD:
+        try:
+            for start, stop, head in parts:
+                if head:
+                    await response.write(head)
+                await write_range(request, response, start, stop - start)
+            if len(parts) > 1:
+                await response.write(trailer)
+        except ConnectionError:
+            # Clients fetching ranges in parallel or resuming downloads often
+            # hang up mid-transfer; there is no one left to answer
+            LOGGER.debug(f"Client disconnected during download of {request.path}")
+            return response
+    await response.write_eof()
+
+    return response
+
+
+async def send_tails_file(request, file_name, tails_hash=None):
+    """Stream a stored tails file, honouring conditional and `Range` headers.
+
+    The tailsHash of the file is its strong ETag. If the caller does not know
+    it, it is computed before answering requests whose answer depends on it,
+    and otherwise in the background while the file is served without an
+    ETag, then remembered. As the content is immutable, responses may be
+    cached indefinitely.
+
+    A single range is answered with a `206` and the slice itself, several
+    ranges with a `multipart/byteranges` body. File data is served from the
+    tails cache if one is configured, otherwise pushed through sendfile from
+    local storage wherever the transport allows it, or read from the storage
+    backend a range at a time. With a catalog, `HEAD` requests are
+    answered without touching the file.
+    """
+    cache = request.app.get("tails_cache")
+
+    catalog = request.app.get("catalog")
+    is_head = request.method == hdrs.METH_HEAD
+
+    if tails_hash is None:
+        tails_hash = _tails_hashes.get(file_name)
+    entry = None
+    if catalog and (tails_hash is None or is_head):
+        entry = await catalog.run(catalog.get, file_name)
+        if entry and tails_hash is None:
+            tails_hash = entry.tails_hash
+            remember_tails_hash(file_name, tails_hash)
+
+    # The cache holds a file once, by content, whichever name it is asked for by
+    cached = cache.get(tails_hash) if cache and tails_hash else None
+    if cached:
+        return await _send(
+            request,
+            len(cached.data),
+            cached.mtime,
+            cached.tails_hash,
+            partial(_write_memory_range, data=cached.data),
+        )
+
+    if entry and is_head:
+        # Everything a HEAD response needs is in the catalog
+        return await _send(request, entry.size, entry.mtime, entry.tails_hash, None)
+
+    storage = request.app["storage"]
+    if storage.local:
+        return await _send_local(request, storage.layout, file_name, tails_hash)
+    return await _send_stored(request, storage, file_name, tails_hash)
+
+
+async def _send_local(request, layout, file_name, tails_hash):
+    """Serve a file from the local filesystem, through sendfile if possible."""
+    cache = request.app.get("tails_cache")
+    loop = asyncio.get_running_loop()
+    try:
+        tails_file, st = await loop.run_in_executor(
+            None, _open_tails_file, layout, file_name
+        )
+    except (FileNotFoundError, IsADirectoryError):
+        raise web.HTTPNotFound()
+
+    try:
+        data = None
+        if cache and cache.accepts(st.st_size):
+            data = await loop.run_in_executor(
+                None, _read_tails_file, tails_file, st.st_size
+            )
+
+        if tails_hash is None:
+            if data is not None:
+                tails_hash = await loop.run_in_executor(None, hash_tails_data, data)
+                remember_tails_hash(file_name, tails_hash)
+            elif _needs_etag(request):
+                tails_hash = await loop.run_in_executor(
+                    None, hash_tails_file, tails_file
+                )
+                remember_tails_hash(file_name, tails_hash)
+            else:
+                # Hashing a large file first would hold up its first byte
+                _hash_later(
+                    file_name,
+                    loop.run_in_executor(None, _hash_local_file, layout, file_name),
+                )
+
+        if data is not None:
+            cache.put(tails_hash, CachedTailsFile(data, st.st_mtime, tails_hash))
+            write_range = partial(_write_memory_range, data=data)
+        else:
+            write_range = partial(_write_file_range, tails_file=tails_file)
+
+        return await _send(request, st.st_size, st.st_mtime, tails_hash, write_range)
+    finally:
+        tails_file.close()
+
+
+async def _write_stored_range(request, response, offset, count, storage, file_name):
+    async for chunk in storage.read(file_name, offset, count):
+        await response.write(chunk)
+
+
+async def _send_stored(request, storage, file_name, tails_hash):
+    """Serve a file from a storage backend, reading it in ranges as needed."""
+    cache = request.app.get("tails_cache")
+    try:
+        stored = await storage.stat(file_name)
+    except FileNotFoundError:
+        raise web.HTTPNotFound()
+    tails_hash = tails_hash or stored.tails_hash
+
+    data = None
+    if cache and cache.accepts(stored.size):
+        data = b"".join([chunk async for chunk in storage.read(file_name)])
+
+    if tails_hash is None:
+        if data is not None:
+            tails_hash = await asyncio.get_running_loop().run_in_executor(
+                None, hash_tails_data, data
+            )
+        elif _needs_etag(request):
+            tails_hash = await _hash_stored_file(storage, file_name)
+        else:
+            _hash_later(file_name, _hash_stored_file(storage, file_name))
+    if tails_hash is not None:
+        remember_tails_hash(file_name, tails_hash)
+
+    if data is not None:
+        cache.put(tails_hash, CachedTailsFile(data, stored.mtime, tails_hash))
+        write_range = partial(_write_memory_range, data=data)
+    else:
+        write_range = partial(_write_stored_range, storage=storage, file_name=file_name)
+
+    return await _send(request, stored.size, stored.mtime, tails_hash, write_range)
@@ -0,0 +1,92 @@
+"""An in-process stand-in for the ledger, for tests and benchmarks."""
+
+import asyncio
+import copy
+import json
+import logging
+import os
+import random
+
+import indy_vdr
+
+from .config.defaults import FAKE_LEDGER_TIMEOUT
+from .ledger import BadGenesisError, LedgerResolver, build_rev_reg_def_request
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FakeLedger(LedgerResolver):
+    """Serves revocation registry definitions from a fixture directory.
+
+    Each `.json` file in the directory holds a definition, as found in the
+    `data` of a ledger response, or a list of them. Definitions are served by
+    their `id` whatever the genesis transactions, though ids and genesis
+    transactions are still checked the way the ledger would.
+
+    Every lookup takes `latency` seconds. A fraction `error_rate` of lookups
+    fail with a connection error, and a fraction `timeout_rate` of them fail
+    with a pool timeout after `timeout` seconds. Failures are drawn from a
+    random generator seeded with `seed`, so a run with a given seed fails the
+    same lookups each time.
+    """
+
+    def __init__(
+        self,
+        fixture_dir=None,
+        latency=0,
+        error_rate=0,
+        timeout_rate=0,
+        timeout=FAKE_LEDGER_TIMEOUT,
+        seed=None,
+    ):
+        """Initialize the ledger."""
+        self.latency = latency
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.timeout = timeout
+        self.definitions = {}
+        self._random = random.Random(seed)
+        if fixture_dir:
+            self.load(fixture_dir)
+
+    def add(self, definition):
+        """Serve `definition` under its `id`."""
+        self.definitions[definition["id"]] = definition
+
+    def load(self, fixture_dir):
+        """Serve the definitions in the `.json` files of `fixture_dir`."""
+        loaded = 0
+        for file_name in sorted(os.listdir(fixture_dir)):
+            if not file_name.endswith(".json"):
+                continue
+            with open(os.path.join(fixture_dir, file_name)) as fixture:
+                definitions = json.load(fixture)
+            if isinstance(definitions, dict):
+                definitions = [definitions]
+            for definition in definitions:
+                self.add(definition)
+                loaded += 1
+        LOGGER.info(f"Loaded {loaded} revocation registry definitions")
+
+    async def get_rev_reg_def(self, genesis_txn_bytes, rev_reg_id):
+        try:
+            genesis_txn_bytes.decode("utf-8")
+        except UnicodeDecodeError:
+            raise BadGenesisError()
+        build_rev_reg_def_request(rev_reg_id)
+
+        outcome = self._random.random()
+        if outcome < self.timeout_rate:
+            await asyncio.sleep(self.timeout)
+            raise indy_vdr.error.VdrError(
+                indy_vdr.VdrErrorCode.POOL_TIMEOUT, "Request timed out"
+            )
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if outcome < self.timeout_rate + self.error_rate:
+            raise indy_vdr.error.VdrError(
+                indy_vdr.VdrErrorCode.CONNECTION, "Connection to the pool failed"
+            )
+
+        # Callers may keep or change what they get, as with a real response
+        return copy.deepcopy(self.definitions.get(rev_reg_id))
@@ -0,0 +1,173 @@
+"""In-memory index of stored tails file names."""
+
+import asyncio
+import logging
+import sqlite3
+from bisect import bisect_left, bisect_right, insort
+
+from .config.defaults import INDEX_BLOCK_SIZE
+
+LOGGER = logging.getLogger(__name__)
+
+# Cannot appear in a file name, so a match never spans two names
+_SEPARATOR = "\0"
+
+
+class _Block:
+    """A sorted run of names, joined into a single string when first searched.
+
+    `names` is never changed in place, so iterators over it are unaffected by
+    later changes to the block.
+    """
+
+    __slots__ = ("names", "corpus", "starts")
+
+    def __init__(self, names):
+        self.names = names
+        self.corpus = None
+        self.starts = None
+
+    def _build(self):
+        self.starts = []
+        offset = 0
+        for name in self.names:
+            self.starts.append(offset)
+            offset += len(name) + len(_SEPARATOR)
+        self.corpus = _SEPARATOR.join(self.names)
+
+    def match(self, substring):
+        if self.corpus is None:
+            self._build()
+        pos = self.corpus.find(substring)
+        while pos != -1:
+            i = bisect_right(self.starts, pos) - 1
+            yield self.names[i]
+            if i + 1 == len(self.names):
+                break
+            # Each name is reported once, however often it contains `substring`
+            pos = self.corpus.find(substring, self.starts[i + 1])
+
+
+class FilenameIndex:
+    """Names of the stored tails files, answering substring queries from memory.
+
+    The names are kept sorted, in blocks each joined into a single string, so
+    a query is a handful of `str.find` calls rather than a listing of the
+    storage directory. Adding or removing a name only rebuilds its block, so
+    queries stay fast while files keep arriving in a large store.
+
+    Only used from the event loop, so no locking is needed.
+    """
+
+    def __init__(self):
+        """Initialize an empty index."""
+        self._names = set()
+        self._added = set()
+        self._blocks = []
+        # The last name of each block
+        self._maxes = []
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def _rebuild(self):
+        names = sorted(self._names)
+        self._blocks = [
+            _Block(names[i : i + INDEX_BLOCK_SIZE])
+            for i in range(0, len(names), INDEX_BLOCK_SIZE)
+        ]
+        self._maxes = [block.names[-1] for block in self._blocks]
+
+    def add(self, name):
+        """Record a published file."""
+        self._added.add(name)
+        if name in self._names:
+            return
+        self._names.add(name)
+
+        if not self._blocks:
+            self._blocks.append(_Block([name]))
+            self._maxes.append(name)
+            return
+        i = min(bisect_left(self._maxes, name), len(self._blocks) - 1)
+        names = list(self._blocks[i].names)
+        insort(names, name)
+        if len(names) > 2 * INDEX_BLOCK_SIZE:
+            half = len(names) // 2
+            self._blocks[i : i + 1] = [_Block(names[:half]), _Block(names[half:])]
+            self._maxes[i : i + 1] = [names[half - 1], names[-1]]
+        else:
+            self._blocks[i] = _Block(names)
+            self._maxes[i] = names[-1]
+
+    def discard(self, name):
+        """Forget a file that is no longer stored."""
+        if name not in self._names:
+            return
+        self._names.remove(name)
+
+        i = bisect_left(self._maxes, name)
+        names = list(self._blocks[i].names)
+        del names[bisect_left(names, name)]
+        if names:
+            self._blocks[i] = _Block(names)
+            self._maxes[i] = names[-1]
+        else:
+            del self._blocks[i]
+            del self._maxes[i]
+
+    def match(self, substring):
+        """Return the sorted names containing `substring`."""
+        if _SEPARATOR in substring:
+            return []
+        return [name for block in self._blocks for name in block.match(substring)]
+
+    def range(self, prefix="", after=None):
+        """Yield the sorted names starting with `prefix`, beginning after `after`.
+
+        Iterates over a snapshot, so the index may change while this runs.
+        """
+        if after is not None and after >= prefix:
+            start, find = after, bisect_right
+        else:
+            start, find = prefix, bisect_left
+        first = bisect_left(self._maxes, start)
+        for names in [block.names for block in self._blocks[first:]]:
+            for i in range(find(names, start), len(names)):
+                if not names[i].startswith(prefix):
+                    return
+                yield names[i]
+
+    async def refresh(self, load_names):
+        """Reconcile the index with the set of names returned by `load_names()`.
+
+        Picks up files published by other processes and drops files removed
+        behind the server's back. Files added while the names are being loaded
+        are kept.
+        """
+        self._added = set()
+        names = await load_names()
+        removed = self._names - names - self._added
+        added = names - self._names
+        if len(removed) + len(added) > INDEX_BLOCK_SIZE:
+            # Cheaper than inserting names one at a time, e.g. at startup
+            self._names = (self._names - removed) | added
+            self._rebuild()
+        else:
+            for name in removed:
+                self.discard(name)
+            for name in added:
+                self.add(name)
+        LOGGER.debug(f"Indexed {len(self._names)} tails files")
+
+    async def maintain(self, load_names, interval):
+        """Refresh the index every `interval` seconds, until cancelled."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh(load_names)
+            except (OSError, sqlite3.Error) as e:
+                LOGGER.warning(f"Failed to refresh tails file index: {e}")
@@ -0,0 +1,162 @@
+"""Placement of tails files under the storage path."""
+
+import hashlib
+import logging
+import os
+
+from .config.defaults import SHARD_PREFIX_LENGTH
+
+LOGGER = logging.getLogger(__name__)
+
+_HEX_DIGITS = frozenset("0123456789abcdef")
+
+
+def scan_directory(path):
+    """Return the names of the tails files directly under `path`.
+
+    Hidden files, such as the catalog, are not tails files.
+    """
+    with os.scandir(path) as entries:
+        return {
+            entry.name
+            for entry in entries
+            if not entry.name.startswith(".") and entry.is_file()
+        }
+
+
+def is_file_name(name):
+    """Check whether `name` names a tails file rather than some other path.
+
+    Tails files are visible files directly in the storage path or a shard.
+    """
+    return (
+        bool(name)
+        and not name.startswith(".")
+        and os.sep not in name
+        and (os.altsep is None or os.altsep not in name)
+        and "\0" not in name
+    )
+
+
+def is_shard(name):
+    """Check whether `name` is the name of a shard directory."""
+    return len(name) == SHARD_PREFIX_LENGTH and set(name) <= _HEX_DIGITS
+
+
+class StorageLayout:
+    """Where tails files live under the storage path.
+
+    The flat layout keeps every file directly in the storage path. The sharded
+    layout puts each file in a subdirectory named by the first hex digits of
+    the SHA-256 of its name, so no directory grows too large to list or look
+    up in quickly, even on network filesystems.
+
+    Reads in the sharded layout fall back to the flat location, which lets a
+    flat store be migrated with `migrate` while it is being served.
+
+    Names that are not file names, e.g. ones containing `/`, are never
+    stored: `path` and `prepare` raise `ValueError` for them, and reads do not
+    find them.
+
+    Methods other than `shard` and `path` perform blocking I/O and should be
+    run in an executor.
+    """
+
+    def __init__(self, storage_path, sharded=False):
+        """Initialize the layout."""
+        self.storage_path = storage_path
+        self.sharded = sharded
+
+    def shard(self, file_name):
+        """Return the shard directory name for `file_name`."""
+        digest = hashlib.sha256(file_name.encode("utf-8")).hexdigest()
+        return digest[:SHARD_PREFIX_LENGTH]
+
+    def _flat_path(self, file_name):
+        return os.path.join(self.storage_path, file_name)
+
+    def path(self, file_name):
+        """Return the path `file_name` is stored at in this layout."""
+        if not is_file_name(file_name):
+            raise ValueError(f"Not a tails file name: {file_name!r}")
+        if not self.sharded:
+            return self._flat_path(file_name)
+        return os.path.join(self.storage_path, self.shard(file_name), file_name)
+
+    def _candidates(self, file_name):
+        if not self.sharded:
+            return (self._flat_path(file_name),)
+        # Look in the sharded location again in case the file was migrated
+        # while we looked in the flat one
+        path = self.path(file_name)
+        return (path, self._flat_path(file_name), path)
+
+    def open(self, file_name):
+        """Open a stored tails file for reading."""
+        if not is_file_name(file_name):
+            raise FileNotFoundError(file_name)
+        candidates = self._candidates(file_name)
+        for path in candidates[:-1]:
+            try:
+                return open(path, "rb")
+            except FileNotFoundError:
+                pass
+        return open(candidates[-1], "rb")
+
+    def locate(self, file_name):
+        """Return the path of a stored tails file, or None if it is not stored."""
+        if not is_file_name(file_name):
+            return None
+        for path in self._candidates(file_name):
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def prepare(self, file_name):
+        """Return the path to publish `file_name` at, creating its directory.
+
+        Raises `FileExistsError` if `file_name` is still stored in the flat
+        location, and `ValueError` if it is not a file name.
+        """
+        path = self.path(file_name)
+        if self.sharded:
+            if os.path.isfile(self._flat_path(file_name)):
+                raise FileExistsError(file_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _shards(self):
+        with os.scandir(self.storage_path) as entries:
+            return [
+                entry.path
+                for entry in entries
+                if is_shard(entry.name) and entry.is_dir()
+            ]
+
+    def names(self):
+        """Return the names of all stored tails files."""
+        names = scan_directory(self.storage_path)
+        if self.sharded:
+            for shard in self._shards():
+                names |= scan_directory(shard)
+        return names
+
+    def migrate(self):
+        """Move the files stored in the flat location into their shards.
+
+        Each file is renamed, which is atomic and keeps files stored under
+        several names sharing their data. Readers look in the shard again if
+        a file disappears from the flat location, so the store can be served
+        throughout.
+        """
+        moved = 0
+        for file_name in sorted(scan_directory(self.storage_path)):
+            path = self.path(file_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.rename(self._flat_path(file_name), path)
+            except FileNotFoundError:
+                continue
+            moved += 1
+        LOGGER.info(f"Moved {moved} tails files into the sharded layout")
+        return moved
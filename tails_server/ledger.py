@@ -1,8 +1,15 @@
+import asyncio
+import hashlib
 import logging
-from tempfile import NamedTemporaryFile
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import partial
 
 import indy_vdr
 
+from .config.defaults import POOL_MAINTENANCE_INTERVAL
+
 logger = logging.getLogger(__name__)
 
 
@@ -14,39 +21,279 @@ class BadRevocationRegistryIdError(Exception):
     pass
 
 
-async def get_rev_reg_def(genesis_txn_bytes, rev_reg_id, storage_path):
-    pool = None
+async def open_pool(genesis_txn_bytes):
+    # Try to connect to ledger
     try:
-        # Write the genesis transactions to the file system
-        with NamedTemporaryFile("w+b") as tmp_file:
-            # Let's test the genesis file before we store it permanently
-            tmp_file.write(genesis_txn_bytes)
-            tmp_file.seek(0)
-            # Try to connect to ledger
-            try:
-                pool = await indy_vdr.open_pool(transactions_path=tmp_file.name)
-            except indy_vdr.error.VdrError as e:
-                if e.code == indy_vdr.VdrErrorCode.INPUT:
-                    raise BadGenesisError()
-                else:
-                    raise
-
-        # Get transaction from ledger
+        return await indy_vdr.open_pool(transactions=genesis_txn_bytes.decode("utf-8"))
+    except UnicodeDecodeError:
+        raise BadGenesisError()
+    except indy_vdr.error.VdrError as e:
+        if e.code == indy_vdr.VdrErrorCode.INPUT:
+            raise BadGenesisError()
+        else:
+            raise
+
+
+class _CachedPool:
+    def __init__(self, pool):
+        self.pool = pool
+        self.users = 0
+        self.last_used = self.last_refresh = time.monotonic()
+
+
+class PoolCache:
+    """Open ledger pools shared between uploads, keyed by genesis transactions.
+
+    Opening a pool means a catchup with the validator nodes, which dominates
+    the time taken to look up a revocation registry definition. Pools are kept
+    open for reuse, refreshed periodically and closed once idle for
+    `idle_timeout` seconds, or when more than `max_pools` are open.
+    """
+
+    def __init__(self, max_pools, idle_timeout, refresh_interval):
+        """Initialize the pool cache."""
+        self.max_pools = max_pools
+        self.idle_timeout = idle_timeout
+        self.refresh_interval = refresh_interval
+        self._pools = {}
+        self._opening = {}
+        self._closed = False
+
+    @asynccontextmanager
+    async def pool(self, genesis_txn_bytes):
+        """Borrow an open pool for the ledger described by `genesis_txn_bytes`."""
+        key = hashlib.sha256(genesis_txn_bytes).hexdigest()
+        entry = self._pools.get(key)
+        while entry is None:
+            if self._closed:
+                raise RuntimeError("Ledger pool cache is closed")
+            # Concurrent uploads against a new ledger share a single catchup
+            opening = self._opening.get(key)
+            if opening is None:
+                opening = asyncio.ensure_future(open_pool(genesis_txn_bytes))
+                self._opening[key] = opening
+                opening.add_done_callback(partial(self._opened, key))
+            await asyncio.shield(opening)
+            entry = self._pools.get(key)
+
+        entry.users += 1
+        try:
+            yield entry.pool
+        finally:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+
+    def _opened(self, key, opening):
+        # Runs even if every upload waiting for the pool was cancelled, so the
+        # pool is always either cached or closed
+        self._opening.pop(key, None)
+        if opening.cancelled() or opening.exception() is not None:
+            return
+        pool = opening.result()
+        if self._closed or key in self._pools:
+            pool.close()
+            return
+        # Make room among the idle pools; the new one is about to be used
+        self._evict(self.max_pools - 1)
+        self._pools[key] = _CachedPool(pool)
+
+    def _close(self, key):
+        entry = self._pools.pop(key)
+        logger.debug(f"Closing ledger pool {key}")
+        entry.pool.close()
+
+    def _evict(self, max_pools, idle_before=None):
+        # Least recently used first; pools in use are never closed
+        for key, entry in sorted(self._pools.items(), key=lambda i: i[1].last_used):
+            if entry.users:
+                continue
+            if len(self._pools) > max_pools or (
+                idle_before is not None and entry.last_used < idle_before
+            ):
+                self._close(key)
+
+    async def _refresh(self, key, entry):
         try:
-            req = indy_vdr.ledger.build_get_revoc_reg_def_request(None, rev_reg_id)
+            await entry.pool.refresh()
+            entry.last_refresh = time.monotonic()
         except indy_vdr.error.VdrError as e:
-            logger.info(e.code)
-            if e.code == indy_vdr.VdrErrorCode.INPUT:
+            logger.warning(f"Failed to refresh ledger pool {key}: {e}")
+            if not entry.users and self._pools.get(key) is entry:
+                self._close(key)
+
+    async def maintain(self):
+        """Close idle pools and refresh the rest, until cancelled."""
+        while True:
+            await asyncio.sleep(POOL_MAINTENANCE_INTERVAL)
+            now = time.monotonic()
+            self._evict(self.max_pools, idle_before=now - self.idle_timeout)
+            await asyncio.gather(
+                *(
+                    self._refresh(key, entry)
+                    for key, entry in list(self._pools.items())
+                    if now - entry.last_refresh >= self.refresh_interval
+                )
+            )
+
+    def close(self):
+        """Close every cached pool."""
+        self._closed = True
+        for key in list(self._pools):
+            self._close(key)
+
+
+@asynccontextmanager
+async def _uncached_pool(genesis_txn_bytes):
+    pool = await open_pool(genesis_txn_bytes)
+    try:
+        yield pool
+    finally:
+        pool.close()
+
+
+class RevRegDefCache:
+    """Revocation registry definitions by ledger and id.
+
+    Definitions are immutable once written to the ledger, so they are kept
+    until evicted by `max_entries`. Lookups that found nothing, or were given
+    an invalid id, are remembered for `negative_ttl` seconds so retry storms
+    do not reach the ledger. Concurrent lookups of the same key share one
+    ledger request.
+    """
+
+    _BAD_ID = object()
+
+    def __init__(self, max_entries, negative_ttl):
+        """Initialize the cache."""
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, key, value, ttl):
+        expires = time.monotonic() + ttl if ttl is not None else None
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _fetch(self, key, fetch):
+        try:
+            value = await fetch()
+        except BadRevocationRegistryIdError:
+            self._put(key, self._BAD_ID, self.negative_ttl)
+            raise
+        self._put(key, value, None if value else self.negative_ttl)
+        return value
+
+    async def lookup(self, key, fetch):
+        """Return the cached result for `key`, calling `fetch()` on a miss."""
+        entry = self._get(key)
+        if entry is not None:
+            value, _ = entry
+            if value is self._BAD_ID:
                 raise BadRevocationRegistryIdError()
-            else:
-                raise
+            return value
+
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch(key, fetch))
+            self._pending[key] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(pending)
+
+
+def build_rev_reg_def_request(rev_reg_id):
+    """Build a request for a revocation registry definition, checking its id."""
+    try:
+        return indy_vdr.ledger.build_get_revoc_reg_def_request(None, rev_reg_id)
+    except indy_vdr.error.VdrError as e:
+        logger.info(e.code)
+        if e.code == indy_vdr.VdrErrorCode.INPUT:
+            raise BadRevocationRegistryIdError()
+        else:
+            raise
 
+
+async def fetch_rev_reg_def(genesis_txn_bytes, rev_reg_id, pools=None):
+    # Get transaction from ledger
+    req = build_rev_reg_def_request(rev_reg_id)
+
+    if pools:
+        pool_context = pools.pool(genesis_txn_bytes)
+    else:
+        pool_context = _uncached_pool(genesis_txn_bytes)
+
+    async with pool_context as pool:
         resp = await pool.submit_request(req)
-    finally:
-        if pool:
-            pool.close()
 
     try:
         return resp["data"]
     except KeyError:
         return None
+
+
+class LedgerResolver:
+    """Where revocation registry definitions are looked up.
+
+    `get_rev_reg_def` returns the definition, or None if the registry is not on
+    the ledger described by `genesis_txn_bytes`. It raises `BadGenesisError`
+    or `BadRevocationRegistryIdError` for invalid input, and
+    `indy_vdr.error.VdrError` if the ledger fails to answer.
+    """
+
+    async def get_rev_reg_def(self, genesis_txn_bytes, rev_reg_id):
+        """Look up the definition of the revocation registry `rev_reg_id`."""
+        raise NotImplementedError()
+
+
+class IndyVdrResolver(LedgerResolver):
+    """Looks up definitions on the ledger itself, through indy_vdr pools."""
+
+    def __init__(self, pools=None):
+        """Initialize the resolver."""
+        self.pools = pools
+
+    async def get_rev_reg_def(self, genesis_txn_bytes, rev_reg_id):
+        return await fetch_rev_reg_def(genesis_txn_bytes, rev_reg_id, self.pools)
+
+
+def create_resolver(settings, pools=None):
+    """Create the ledger resolver configured in `settings`."""
+    if settings.get("fake_ledger"):
+        from .fakeledger import FakeLedger
+
+        logger.warning(
+            f"Serving revocation registry definitions from {settings['fake_ledger']}"
+            " instead of the ledger"
+        )
+        return FakeLedger(
+            settings["fake_ledger"],
+            latency=settings.get("fake_ledger_latency") or 0,
+            error_rate=settings.get("fake_ledger_error_rate") or 0,
+            timeout_rate=settings.get("fake_ledger_timeout_rate") or 0,
+            seed=settings.get("fake_ledger_seed"),
+        )
+
+    return IndyVdrResolver(pools)
+
+
+async def get_rev_reg_def(resolver, genesis_txn_bytes, rev_reg_id, rev_reg_defs=None):
+    if not rev_reg_defs:
+        return await resolver.get_rev_reg_def(genesis_txn_bytes, rev_reg_id)
+
+    key = (hashlib.sha256(genesis_txn_bytes).hexdigest(), rev_reg_id)
+    return await rev_reg_defs.lookup(
+        key, lambda: resolver.get_rev_reg_def(genesis_txn_bytes, rev_reg_id)
+    )
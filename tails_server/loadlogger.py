@@ -10,6 +10,8 @@ from typing import Optional
 
 import yaml
 
+from .logqueue import queue_handlers
+
 sys.path.insert(1, os.path.realpath(os.path.dirname(__file__)) + "/config")
 
 LOGGER = logging.getLogger(__name__)
@@ -55,7 +57,11 @@ class LoggingConfigurator:
 
     @classmethod
     def configure(
-        cls, log_config_path: Optional[str] = None, log_level: Optional[str] = None
+        cls,
+        log_config_path: Optional[str] = None,
+        log_level: Optional[str] = None,
+        queue_size: Optional[int] = None,
+        overflow: str = "drop",
     ):
         """Configure logger.
 
@@ -63,12 +69,24 @@ class LoggingConfigurator:
             custom logging config
 
         :param log_level: str: (Default value = None)
+
+        :param queue_size: int: (Default value = None) Hand records to background
+            threads through queues of this size, instead of emitting them
+            synchronously
+
+        :param overflow: str: (Default value = "drop") What to do with records
+            when a queue is full, "drop" or "block"
         """
 
-        cls._configure_logging(log_config_path=log_config_path, log_level=log_level)
+        cls._configure_logging(
+            log_config_path=log_config_path,
+            log_level=log_level,
+            queue_size=queue_size,
+            overflow=overflow,
+        )
 
     @classmethod
-    def _configure_logging(cls, log_config_path, log_level):
+    def _configure_logging(cls, log_config_path, log_level, queue_size, overflow):
         # Setup log config and log file if provided
         cls._setup_log_config_file(log_config_path)
 
@@ -76,6 +94,10 @@ class LoggingConfigurator:
         if log_level:
             logging.root.setLevel(log_level.upper())
 
+        # Emit records from background threads
+        if queue_size:
+            queue_handlers(queue_size, overflow)
+
     @classmethod
     def _setup_log_config_file(cls, log_config_path):
         log_config, is_dict_config = cls._load_log_config(log_config_path)
@@ -0,0 +1,134 @@
+"""Hand log records off to background threads, so slow sinks never stall requests."""
+
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+LOGGER = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("drop", "block")
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room rather than fail when stopping with a full queue
+        self.queue.put(self._sentinel)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Queue records for `target`, which a listener thread emits them to.
+
+    At most `maxsize` records wait in the queue. When it is full, `overflow`
+    decides what happens to a new record: `drop` discards it, and `block`
+    waits for room, which guarantees delivery at the cost of stalling the
+    caller. Dropped records are counted, and reported in a warning once the
+    queue has room again.
+
+    Closing the handler, as `logging.shutdown` does, emits the records still
+    queued.
+    """
+
+    def __init__(self, target, maxsize, overflow="drop"):
+        """Initialize the handler."""
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.overflow = overflow
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self.listener = None
+        # Records the target would ignore are not worth queueing
+        self.setLevel(target.level)
+
+    def start(self):
+        """Start emitting queued records to the target."""
+        self.listener = _Listener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+    def restart_in_child(self):
+        """Give a forked process its own queue and listener thread.
+
+        The parent's listener thread does not exist in the child, and the
+        queue's lock may have been held by it at the time of the fork.
+        """
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self.listener = None
+        self.start()
+
+    def enqueue(self, record):
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+            return
+        if self.dropped:
+            self._report_dropped()
+
+    def _report_dropped(self):
+        with self._dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        record = LOGGER.makeRecord(
+            LOGGER.name,
+            logging.WARNING,
+            __file__,
+            0,
+            f"Dropped {dropped} log records because the log queue was full",
+            None,
+            None,
+        )
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += dropped + 1
+
+
+_queue_handlers = []
+
+
+def _restart_all_in_child():
+    for handler in _queue_handlers:
+        handler.restart_in_child()
+
+
+def queue_handlers(maxsize, overflow="drop"):
+    """Put a `BoundedQueueHandler` in front of every configured handler.
+
+    Each distinct handler gets its own queue and listener thread, shared by
+    every logger using it. Forked processes start listeners of their own, and
+    must call `logging.shutdown` before exiting if they bypass the usual exit
+    handlers, as multiprocessing workers do.
+    """
+    if _queue_handlers:
+        return
+    loggers = [logging.getLogger()] + [
+        logger
+        for logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)
+    ]
+    wrapped = {}
+    for logger in loggers:
+        for i, handler in enumerate(logger.handlers):
+            if isinstance(handler, QueueHandler):
+                continue
+            if handler not in wrapped:
+                wrapped[handler] = BoundedQueueHandler(handler, maxsize, overflow)
+            logger.handlers[i] = wrapped[handler]
+
+    _queue_handlers.extend(wrapped.values())
+    for handler in _queue_handlers:
+        handler.start()
+    os.register_at_fork(after_in_child=_restart_all_in_child)
@@ -0,0 +1,347 @@
+"""Runtime metrics, exposed in the Prometheus text format."""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+
+from aiohttp import hdrs, web
+
+from .config.defaults import LATENCY_BUCKETS, METRICS_FLUSH_INTERVAL
+
+LOGGER = logging.getLogger(__name__)
+
+# Prometheus text exposition format, version 0.0.4
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Nginx's status for requests the client gave up on
+CLIENT_CLOSED_REQUEST = 499
+
+# Methods counted under their own name; clients choose the method, so any other
+# is counted as "other" to keep the number of label values bounded
+KNOWN_METHODS = frozenset(hdrs.METH_ALL)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A family of samples sharing a name, distinguished by label values.
+
+    Only updated from the event loop, so no locking is needed.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        """Initialize the metric."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def snapshot(self):
+        """Return the current values in a JSON-serializable form."""
+        return {json.dumps(key): value for key, value in self.values.items()}
+
+    def merge(self, snapshot):
+        """Add the values of another process's `snapshot` to this metric's."""
+        for key, value in snapshot.items():
+            key = tuple(json.loads(key))
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        """Yield `(suffix, label names, label values, value)` for each sample."""
+        for key, value in sorted(self.values.items()):
+            yield "", self.labels, key, value
+
+    def render(self):
+        """Return the metric in the text exposition format."""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, names, values, value in self.samples():
+            labels = _format_labels(names, values)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """A count that only goes up."""
+
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        """Add `amount` to the count for `labels`."""
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down."""
+
+    type = "gauge"
+
+    def inc(self, *labels, amount=1):
+        """Add `amount` to the value for `labels`."""
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        """Subtract `amount` from the value for `labels`."""
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+    def set(self, value, *labels):
+        """Set the value for `labels`."""
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    """Observations counted in cumulative buckets, with their count and sum."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        """Initialize the histogram."""
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """Record one observation for `labels`."""
+        counts = self.values.get(labels)
+        if counts is None:
+            # One count per bucket, then +Inf, then the sum
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def merge(self, snapshot):
+        for key, counts in snapshot.items():
+            key = tuple(json.loads(key))
+            mine = self.values.setdefault(key, [0] * len(counts))
+            self.values[key] = [a + b for a, b in zip(mine, counts)]
+
+    def samples(self):
+        names = self.labels + ("le",)
+        for key, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                yield "_bucket", names, key + (_format_value(bound),), total
+            yield "_count", self.labels, key, total
+            yield "_sum", self.labels, key, counts[-1]
+
+
+REQUESTS = Counter(
+    "tails_server_requests_total",
+    "HTTP requests handled, by route, method and status.",
+    ("route", "method", "status"),
+)
+REQUEST_DURATION = Histogram(
+    "tails_server_request_duration_seconds",
+    "Time taken to handle HTTP requests, by route and method.",
+    ("route", "method"),
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "tails_server_requests_in_flight",
+    "HTTP requests being handled, by route.",
+    ("route",),
+)
+RECEIVED_BYTES = Counter(
+    "tails_server_received_bytes_total",
+    "Request body bytes received, by route.",
+    ("route",),
+)
+SENT_BYTES = Counter(
+    "tails_server_sent_bytes_total",
+    "Response body bytes sent, by route.",
+    ("route",),
+)
+LEDGER_LOOKUP_DURATION = Histogram(
+    "tails_server_ledger_lookup_duration_seconds",
+    "Time taken to look up revocation registry definitions, by outcome.",
+    ("outcome",),
+)
+HASH_MISMATCHES = Counter(
+    "tails_server_hash_mismatches_total",
+    "Tails files rejected because their hash did not match, by source.",
+    ("source",),
+)
+TAILS_CACHE_LOOKUPS = Counter(
+    "tails_server_tails_cache_lookups_total",
+    "Lookups in the in-memory tails cache, by result.",
+    ("result",),
+)
+TAILS_CACHE_EVICTIONS = Counter(
+    "tails_server_tails_cache_evictions_total",
+    "Files evicted from the in-memory tails cache to make room.",
+)
+TAILS_CACHE_FILES = Gauge(
+    "tails_server_tails_cache_files",
+    "Files held in the in-memory tails cache.",
+)
+TAILS_CACHE_BYTES = Gauge(
+    "tails_server_tails_cache_bytes",
+    "Size of the files held in the in-memory tails cache.",
+)
+STORED_FILES = Gauge(
+    "tails_server_stored_files",
+    "Names under which tails files are stored, aliases included.",
+)
+STORED_BYTES = Gauge(
+    "tails_server_stored_bytes",
+    "Size of the distinct tails files stored. Only reported with a catalog.",
+)
+
+# Summed across the worker processes of a server
+SHARED_METRICS = (
+    REQUESTS,
+    REQUEST_DURATION,
+    REQUESTS_IN_FLIGHT,
+    RECEIVED_BYTES,
+    SENT_BYTES,
+    LEDGER_LOOKUP_DURATION,
+    HASH_MISMATCHES,
+    # Each worker has a cache of its own
+    TAILS_CACHE_LOOKUPS,
+    TAILS_CACHE_EVICTIONS,
+    TAILS_CACHE_FILES,
+    TAILS_CACHE_BYTES,
+)
+
+
+def _method(request):
+    return request.method if request.method in KNOWN_METHODS else "other"
+
+
+def _route(request):
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else "unmatched"
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Count requests and their sizes, and time them, by route."""
+    route = _route(request)
+    method = _method(request)
+    REQUESTS_IN_FLIGHT.inc(route)
+    start = time.perf_counter()
+    status = web.HTTPInternalServerError.status_code
+    response = None
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    except asyncio.CancelledError:
+        status = CLIENT_CLOSED_REQUEST
+        raise
+    finally:
+        REQUESTS_IN_FLIGHT.dec(route)
+        REQUESTS.inc(route, method, str(status))
+        REQUEST_DURATION.observe(time.perf_counter() - start, route, method)
+        if request.body_exists:
+            RECEIVED_BYTES.inc(route, amount=request.content.total_bytes)
+        if response is not None and request.method != hdrs.METH_HEAD:
+            sent = response.content_length or response.body_length
+            if sent:
+                SENT_BYTES.inc(route, amount=sent)
+
+
+def snapshot():
+    """Return this process's shared metrics, serialized for the other workers."""
+    return json.dumps(
+        {
+            "pid": os.getpid(),
+            "metrics": {metric.name: metric.snapshot() for metric in SHARED_METRICS},
+        }
+    )
+
+
+def write_snapshot(metrics_dir, data):
+    """Save a `snapshot()` where the other workers will find it.
+
+    This performs blocking I/O and should be run in an executor.
+    """
+    path = os.path.join(metrics_dir, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as snapshot_file:
+        snapshot_file.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def read_snapshots(metrics_dir):
+    """Return the snapshots last saved by the other workers.
+
+    This performs blocking I/O and should be run in an executor.
+    """
+    snapshots = []
+    own = f"{os.getpid()}.json"
+    for entry in os.scandir(metrics_dir):
+        if not entry.name.endswith(".json") or entry.name == own:
+            continue
+        try:
+            with open(entry.path) as snapshot_file:
+                snapshots.append(json.load(snapshot_file))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render(snapshots=()):
+    """Return all metrics in the text exposition format.
+
+    The `snapshots` of other workers are added in. Counters and histograms of
+    workers that have exited are kept, so they never go down; their gauges are
+    dropped.
+    """
+    metrics = list(SHARED_METRICS)
+    if snapshots:
+        metrics = []
+        for metric in SHARED_METRICS:
+            combined = type(metric)(metric.name, metric.documentation, metric.labels)
+            combined.merge(metric.snapshot())
+            for other in snapshots:
+                if isinstance(metric, Gauge) and not _alive(other["pid"]):
+                    continue
+                combined.merge(other["metrics"].get(metric.name, {}))
+            metrics.append(combined)
+    metrics += [STORED_FILES, STORED_BYTES]
+    return "".join(metric.render() for metric in metrics if metric.values)
+
+
+async def save_snapshots(metrics_dir):
+    """Save this process's metrics every `METRICS_FLUSH_INTERVAL`, until cancelled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            await loop.run_in_executor(None, write_snapshot, metrics_dir, snapshot())
+        except OSError as e:
+            LOGGER.warning(f"Failed to save metrics: {e}")
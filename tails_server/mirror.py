@@ -0,0 +1,292 @@
+"""Read-through mirroring of an upstream tails server."""
+
+import asyncio
+import logging
+from urllib.parse import quote
+
+import aiohttp
+from aiohttp import hdrs, web
+
+from . import metrics
+from .config.defaults import (
+    CACHE_CONTROL,
+    DOWNLOAD_CHUNK_SIZE,
+    MIRROR_STREAM_MAX_SIZE,
+    UPSTREAM_TIMEOUT,
+)
+from .download import OCTET_STREAM, is_tails_hash
+from .layout import is_file_name
+from .upload import UploadTooLargeError, receive_upload
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MirrorError(Exception):
+    """The upstream server failed to provide a valid tails file."""
+
+
+def _strong_etag(headers):
+    etag = headers.get(hdrs.ETAG, "")
+    if len(etag) > 2 and etag[0] == etag[-1] == '"':
+        return etag[1:-1]
+    return None
+
+
+class MirrorFetch:
+    """One download of a tails file from upstream, shared by every request for it.
+
+    `started` resolves once the size and tailsHash of the file are known and
+    `finished` once it is stored locally; both carry the error if the fetch
+    fails. Files small enough are kept in memory as they arrive so that
+    requests can stream them before they are stored.
+    """
+
+    def __init__(self, file_name):
+        """Initialize the fetch."""
+        loop = asyncio.get_running_loop()
+        self.file_name = file_name
+        self.size = None
+        self.tails_hash = None
+        self.chunks = None
+        self.started = loop.create_future()
+        self.finished = loop.create_future()
+        self._waiters = []
+        # Failures are reported to whoever waits, if anyone does
+        self.started.add_done_callback(_retrieve_exception)
+        self.finished.add_done_callback(_retrieve_exception)
+
+    def _wake(self):
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters = []
+
+    def start(self, size, tails_hash, streamable):
+        """Record what the upstream server reported about the file."""
+        self.size = size
+        self.tails_hash = tails_hash
+        if streamable:
+            self.chunks = []
+        self.started.set_result(None)
+
+    def append(self, chunk):
+        """Record a chunk received from upstream."""
+        if self.chunks is not None and chunk:
+            self.chunks.append(chunk)
+            self._wake()
+
+    def finish(self, error=None):
+        """Record the outcome of the fetch."""
+        for future in (self.started, self.finished):
+            if not future.done():
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+        self._wake()
+
+    async def stream(self):
+        """Yield the file as it arrives.
+
+        The last chunk is only released once the file has been verified, so a
+        client never receives a complete copy of a file that failed to verify.
+        """
+        i = 0
+        while True:
+            if i + 1 < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            elif self.finished.done():
+                self.finished.result()
+                for chunk in self.chunks[i:]:
+                    yield chunk
+                return
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+                await waiter
+
+
+def _retrieve_exception(future):
+    if not future.cancelled():
+        future.exception()
+
+
+class _TeeReader:
+    """Read a response body like a multipart field, recording each chunk."""
+
+    def __init__(self, content, fetch):
+        self.content = content
+        self.fetch = fetch
+
+    async def read_chunk(self, size):
+        chunk = await self.content.read(size)
+        self.fetch.append(chunk)
+        return chunk
+
+
+class Mirror:
+    """Fetches tails files missing from local storage from an upstream server.
+
+    Files are fetched by tailsHash from `/hash/{tails_hash}`, or by revocation
+    registry id from `/{revocation_reg_id}`, in which case the upstream `ETag`
+    gives the tailsHash to check against. Each file is hashed and staged like
+    an upload and only published if it matches. Concurrent requests for the
+    same missing file share a single fetch.
+
+    `on_stored(file_name, tails_hash)` is awaited for each name published.
+    """
+
+    def __init__(self, upstream, storage, on_stored, max_size=None):
+        """Initialize the mirror."""
+        self.upstream = upstream.rstrip("/")
+        self.storage = storage
+        self.on_stored = on_stored
+        self.max_size = max_size
+        self._fetches = {}
+        self._tasks = set()
+        self._session = None
+
+    def fetch(self, file_name, tails_hash=None):
+        """Return the fetch of `file_name`, starting one if none is running.
+
+        `tails_hash` is given when the file is requested by hash.
+        """
+        fetch = self._fetches.get(file_name)
+        if fetch is None:
+            fetch = MirrorFetch(file_name)
+            self._fetches[file_name] = fetch
+            task = asyncio.create_task(self._run(fetch, tails_hash))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            task.add_done_callback(lambda _: self._fetches.pop(file_name, None))
+        return fetch
+
+    async def _run(self, fetch, tails_hash):
+        try:
+            await self._fetch(fetch, tails_hash)
+        except asyncio.CancelledError:
+            fetch.finish(MirrorError("Mirror is shutting down"))
+            raise
+        except FileNotFoundError as e:
+            fetch.finish(e)
+        except (MirrorError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            LOGGER.warning(f"Failed to fetch {fetch.file_name} from upstream: {e}")
+            fetch.finish(e if isinstance(e, MirrorError) else MirrorError(str(e)))
+        except Exception as e:
+            LOGGER.exception(f"Failed to fetch {fetch.file_name} from upstream")
+            fetch.finish(MirrorError(str(e)))
+        else:
+            fetch.finish()
+
+    async def _fetch(self, fetch, tails_hash):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=UPSTREAM_TIMEOUT, sock_read=UPSTREAM_TIMEOUT
+                ),
+                auto_decompress=False,
+            )
+        file_name = fetch.file_name
+        if not is_file_name(file_name):
+            # Never stored, so never fetched: e.g. `../name` would be published
+            # outside the storage path
+            raise FileNotFoundError(file_name)
+        headers = {}
+        if tails_hash is None:
+            url = f"{self.upstream}/{quote(file_name, safe=':')}"
+            # A condition on the ETag has the upstream server work out the
+            # tailsHash before answering, if it does not know it yet
+            headers[hdrs.IF_MATCH] = "*"
+        else:
+            url = f"{self.upstream}/hash/{quote(tails_hash)}"
+
+        async with self._session.get(url, headers=headers) as response:
+            if response.status == 404:
+                raise FileNotFoundError(file_name)
+            if response.status != 200:
+                raise MirrorError(f"Upstream responded with {response.status}")
+
+            etag = _strong_etag(response.headers)
+            if tails_hash is None:
+                # The upstream server vouches for the content by its ETag
+                if not is_tails_hash(etag):
+                    raise MirrorError("Upstream did not report a tailsHash")
+                tails_hash = etag
+            elif etag is not None and etag != tails_hash:
+                raise MirrorError(f"Upstream ETag {etag} does not match")
+
+            size = response.content_length
+            if self.max_size is not None and size and size > self.max_size:
+                raise MirrorError(f"Upstream file of {size} bytes is too large")
+
+            if file_name != tails_hash and await self.storage.exists(tails_hash):
+                # Already stored under its hash: only the alias is missing
+                fetch.start(size, tails_hash, streamable=False)
+            else:
+                fetch.start(
+                    size,
+                    tails_hash,
+                    streamable=size is not None and size <= MIRROR_STREAM_MAX_SIZE,
+                )
+                await self._store(response, fetch, tails_hash)
+
+        if file_name != tails_hash:
+            try:
+                await self.storage.alias(tails_hash, file_name)
+            except FileExistsError:
+                pass
+            await self.on_stored(file_name, tails_hash)
+
+    async def _store(self, response, fetch, tails_hash):
+        async with self.storage.stage(self.max_size) as staged:
+            try:
+                digest = await receive_upload(
+                    _TeeReader(response.content, fetch), staged
+                )
+            except UploadTooLargeError as e:
+                raise MirrorError(f"Upstream file of {e.size} bytes is too large")
+            if digest != tails_hash:
+                metrics.HASH_MISMATCHES.inc("upstream")
+                raise MirrorError(f"Upstream file hashes to {digest}")
+            if fetch.size is not None and staged.size != fetch.size:
+                raise MirrorError("Upstream file was truncated")
+            try:
+                await staged.publish(tails_hash, tails_hash)
+            except FileExistsError:
+                # Stored by an upload or another process meanwhile
+                return
+        LOGGER.info(f"Mirrored {fetch.file_name} from upstream")
+        await self.on_stored(tails_hash, tails_hash)
+
+    async def close(self):
+        """Stop running fetches and release the client session."""
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+        if self._session is not None:
+            await self._session.close()
+
+
+async def send_fetch(request, fetch):
+    """Stream a file to the client as it is fetched from upstream."""
+    response = web.StreamResponse()
+    response.etag = fetch.tails_hash
+    response.content_type = OCTET_STREAM
+    response.content_length = fetch.size
+    response.headers[hdrs.CACHE_CONTROL] = CACHE_CONTROL
+    response.headers[hdrs.ACCEPT_RANGES] = "bytes"
+    await response.prepare(request)
+    try:
+        async for chunk in fetch.stream():
+            for start in range(0, len(chunk), DOWNLOAD_CHUNK_SIZE):
+                await response.write(chunk[start : start + DOWNLOAD_CHUNK_SIZE])
+    except MirrorError:
+        # Too late for an error status: cut the response short instead, so the
+        # client sees an incomplete download
+        if request.transport is not None:
+            request.transport.close()
+        return response
+    await response.write_eof()
+    return response
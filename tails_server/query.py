@@ -0,0 +1,60 @@
+"""Structured queries over the revocation registries of stored tails files."""
+
+import re
+from typing import NamedTuple, Optional
+
+# <issuer DID>:4:<cred def id>:<registry type>:<tag>, where the cred def id
+# itself contains colons
+REV_REG_ID = re.compile(
+    r"^(?P<issuer_did>[^:]+):4:(?P<cred_def_id>.+):"
+    r"(?P<registry_type>[^:]+):(?P<tag>[^:]+)$"
+)
+
+FILTERS = ("issuer_did", "cred_def_id", "registry_type", "tag")
+
+
+class RevocationRegistryId(NamedTuple):
+    """The parts of a revocation registry id."""
+
+    revocation_reg_id: str
+    issuer_did: str
+    cred_def_id: str
+    registry_type: str
+    tag: str
+
+
+def parse_rev_reg_id(rev_reg_id: str) -> Optional[RevocationRegistryId]:
+    """Split a revocation registry id into its parts, or return None."""
+    match = REV_REG_ID.match(rev_reg_id)
+    if match is None:
+        return None
+    return RevocationRegistryId(rev_reg_id, *match.group(*FILTERS))
+
+
+def _prefix(issuer_did=None, cred_def_id=None):
+    # Registry ids sort by issuer DID and then cred def id, so filtering on
+    # those is a range of the sorted names rather than a scan of all of them
+    if issuer_did is not None:
+        prefix = f"{issuer_did}:4:"
+        if cred_def_id is not None:
+            prefix += f"{cred_def_id}:"
+        return prefix
+    if cred_def_id is not None:
+        return f"{cred_def_id.split(':', 1)[0]}:4:{cred_def_id}:"
+    return ""
+
+
+def query_registries(index, filters, after=None):
+    """Yield the stored registries matching `filters`, in id order.
+
+    `filters` maps names from `FILTERS` to the value the part must equal.
+    Registries up to and including `after` are skipped, which makes the id of
+    the last registry of a page the cursor for the next one.
+    """
+    prefix = _prefix(filters.get("issuer_did"), filters.get("cred_def_id"))
+    for name in index.range(prefix, after):
+        rev_reg_id = parse_rev_reg_id(name)
+        if rev_reg_id is None:
+            continue
+        if all(getattr(rev_reg_id, field) == value for field, value in filters.items()):
+            yield rev_reg_id
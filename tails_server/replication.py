@@ -0,0 +1,205 @@
+"""Replication of tails files between peer tails servers."""
+
+import asyncio
+import fcntl
+import json
+import logging
+import os
+
+import aiohttp
+
+from .config.defaults import (
+    MAX_QUERY_LIMIT,
+    REPLICATION_CONCURRENCY,
+    REPLICATION_LOCK,
+    REPLICATION_MAX_PENDING,
+    UPSTREAM_TIMEOUT,
+)
+from .download import is_tails_hash
+from .layout import is_file_name
+from .mirror import Mirror, MirrorError
+from .query import parse_rev_reg_id
+
+LOGGER = logging.getLogger(__name__)
+
+
+def is_replicated(name):
+    """Check whether peers replicate a file called `name`.
+
+    Tails files are stored under their tailsHash and their revocation registry
+    ids, and nothing else is pulled from a peer.
+    """
+    return is_file_name(name) and (
+        is_tails_hash(name) or parse_rev_reg_id(name) is not None
+    )
+
+
+class Replicator:
+    """Keeps the files stored on this node in step with those of its peers.
+
+    Uploads are announced to every peer, which pulls them from whichever of
+    its own peers has them. Pulls go through a `Mirror` of each peer, so each
+    file is hashed and verified before it is stored, and concurrent pulls of
+    the same file share one download. Announcements are only hints: a node
+    only ever pulls from the peers it is configured with.
+    """
+
+    def __init__(self, peers, storage, on_stored, max_size=None):
+        """Initialize the replicator."""
+        self.peers = [peer.rstrip("/") for peer in peers]
+        self.storage = storage
+        self.mirrors = [
+            Mirror(peer, storage, on_stored, max_size) for peer in self.peers
+        ]
+        self._semaphore = asyncio.Semaphore(REPLICATION_CONCURRENCY)
+        self._pending = set()
+        self._tasks = set()
+        self._session = None
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _client(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=UPSTREAM_TIMEOUT, sock_read=UPSTREAM_TIMEOUT
+                )
+            )
+        return self._session
+
+    def announce(self, names):
+        """Tell every peer, in the background, that `names` were uploaded here."""
+        if self.peers:
+            self._spawn(self._announce(list(names)))
+
+    async def _announce(self, names):
+        async def notify(peer):
+            url = f"{peer}/replication/announce"
+            try:
+                async with self._client().post(url, json={"names": names}) as r:
+                    if r.status != 202:
+                        LOGGER.warning(f"Peer {peer} refused announcement: {r.status}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                LOGGER.warning(f"Failed to announce upload to peer {peer}: {e}")
+
+        await asyncio.gather(*(notify(peer) for peer in self.peers))
+
+    def receive(self, names):
+        """Pull `names`, announced by a peer, in the background.
+
+        Names already waiting to be pulled are not pulled again. Returns False,
+        pulling none of `names`, if more than `REPLICATION_MAX_PENDING` names
+        would be waiting; the startup sync catches up with what is missed.
+        """
+        names = set(names) - self._pending
+        if len(self._pending) + len(names) > REPLICATION_MAX_PENDING:
+            return False
+        self._pending |= names
+        task = self._spawn(self.pull(names))
+        task.add_done_callback(lambda _: self._pending.difference_update(names))
+        return True
+
+    async def pull(self, names):
+        """Fetch the files in `names` not stored here from the peers.
+
+        Returns the number of files fetched.
+        """
+
+        async def pull_one(name):
+            async with self._semaphore:
+                return await self._pull(name)
+
+        # Files named by their hash are pulled before the registry ids naming
+        # them, so an alias never downloads its file again
+        pulled = 0
+        for group in (
+            [name for name in names if is_tails_hash(name)],
+            [name for name in names if not is_tails_hash(name)],
+        ):
+            pulled += sum(await asyncio.gather(*map(pull_one, group)))
+        return pulled
+
+    async def _pull(self, name):
+        if await self.storage.exists(name):
+            return False
+        tails_hash = name if is_tails_hash(name) else None
+        for mirror in self.mirrors:
+            try:
+                # Other pulls may be waiting for the same fetch
+                await asyncio.shield(mirror.fetch(name, tails_hash).finished)
+            except (FileNotFoundError, MirrorError):
+                continue
+            return True
+        LOGGER.warning(f"No peer could provide {name}")
+        return False
+
+    async def inventory(self, peer):
+        """Return the names of the files stored on `peer`."""
+        names = set()
+        params = {"limit": str(MAX_QUERY_LIMIT)}
+        while True:
+            url = f"{peer}/replication/inventory"
+            async with self._client().get(url, params=params) as response:
+                response.raise_for_status()
+                page = [json.loads(line) async for line in response.content if line]
+            names.update(page)
+            if len(page) < MAX_QUERY_LIMIT:
+                return names
+            params["cursor"] = page[-1]
+
+    async def sync(self):
+        """Pull every file a peer has and this node does not."""
+        local = await self.storage.names()
+        pulled = 0
+        for peer in self.peers:
+            try:
+                missing = {
+                    name for name in await self.inventory(peer) if is_replicated(name)
+                } - local
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                LOGGER.warning(f"Failed to list tails files on peer {peer}: {e}")
+                continue
+            if missing:
+                LOGGER.info(f"Pulling {len(missing)} tails files found on {peer}")
+                pulled += await self.pull(missing)
+                local |= missing
+        LOGGER.info(f"Replication sync pulled {pulled} tails files")
+        return pulled
+
+    async def sync_once(self, storage_path):
+        """Run `sync`, unless another process sharing `storage_path` is running it.
+
+        Workers of one server share their storage, so only one of them needs to
+        catch up with the peers.
+        """
+        lock = os.open(
+            os.path.join(storage_path, REPLICATION_LOCK),
+            os.O_RDONLY | os.O_CREAT,
+            0o644,
+        )
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            return await self.sync()
+        except Exception:
+            LOGGER.exception("Replication sync failed")
+            return 0
+        finally:
+            os.close(lock)
+
+    async def close(self):
+        """Stop background replication and release the client sessions."""
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+        for mirror in self.mirrors:
+            await mirror.close()
+        if self._session is not None:
+            await self._session.close()
@@ -0,0 +1,368 @@
+"""Storage backend for S3-compatible object stores."""
+
+import hashlib
+import hmac
+import logging
+import os
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from email.utils import parsedate_to_datetime
+from urllib.parse import quote, urlsplit
+
+import aiohttp
+from yarl import URL
+
+from .config.defaults import (
+    DOWNLOAD_CHUNK_SIZE,
+    MAX_REMEMBERED_HASHES,
+    S3_PART_SIZE,
+    STAGING_DIR,
+)
+from .storage import StorageBackend, StoredFile
+from .upload import BaseStagedUpload
+
+LOGGER = logging.getLogger(__name__)
+
+_NS = {"s3": "http://s3.amazonaws.com/doc/2006-03-01/"}
+_EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+_UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+
+# Object metadata recording the tailsHash of a file, and the file an alias
+# stands for
+_META_TAILS_HASH = "x-amz-meta-tails-hash"
+_META_ALIAS_OF = "x-amz-meta-tails-alias-of"
+
+
+class S3Error(Exception):
+    """An unexpected response from the object store."""
+
+    def __init__(self, status, body):
+        """Initialize the error with the response status and body."""
+        super().__init__(f"Object store responded with {status}: {body[:200]!r}")
+        self.status = status
+
+
+def _encode(value, safe="-_.~"):
+    return quote(value, safe=safe)
+
+
+def _sign(key, msg):
+    return hmac.new(key, msg.encode("utf-8"), hashlib.sha256).digest()
+
+
+def sign_request(method, host, path, params, headers, credentials, region):
+    """Return the AWS Signature Version 4 `Authorization` header for a request.
+
+    `path` and `params` must not be URI-encoded yet. `headers` are the
+    lowercase headers to sign other than `host`, including `x-amz-date` and
+    `x-amz-content-sha256`.
+    """
+    access_key, secret_key = credentials
+    amz_date = headers["x-amz-date"]
+    date = amz_date[:8]
+
+    signed = {"host": host, **headers}
+    signed_headers = ";".join(sorted(signed))
+    canonical_request = "\n".join(
+        (
+            method,
+            _encode(path, safe="/-_.~"),
+            "&".join(f"{_encode(k)}={_encode(v)}" for k, v in sorted(params.items())),
+            "".join(f"{k}:{str(signed[k]).strip()}\n" for k in sorted(signed)),
+            signed_headers,
+            headers["x-amz-content-sha256"],
+        )
+    )
+
+    scope = f"{date}/{region}/s3/aws4_request"
+    string_to_sign = "\n".join(
+        (
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+        )
+    )
+    key = _sign(("AWS4" + secret_key).encode("utf-8"), date)
+    for part in (region, "s3", "aws4_request"):
+        key = _sign(key, part)
+    signature = hmac.new(
+        key, string_to_sign.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+
+    return (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+        f"SignedHeaders={signed_headers}, Signature={signature}"
+    )
+
+
+class S3StagedUpload(BaseStagedUpload):
+    """An upload streamed into an object store.
+
+    Small uploads are buffered and stored with a single request once verified.
+    Larger ones are streamed as a multipart upload to a staging object, which
+    is copied to its final name when published.
+    """
+
+    def __init__(self, storage, max_size=None):
+        """Initialize the upload."""
+        super().__init__(max_size)
+        self.storage = storage
+        self.key = f"{STAGING_DIR}/{uuid.uuid4().hex}"
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._staged = False
+
+    async def _flush(self):
+        if self._upload_id is None:
+            self._upload_id = await self.storage.create_multipart_upload(self.key)
+        part = bytes(self._buffer)
+        self._buffer.clear()
+        etag = await self.storage.upload_part(
+            self.key, self._upload_id, len(self._parts) + 1, part
+        )
+        self._parts.append(etag)
+
+    async def write(self, chunk):
+        self._buffer += chunk
+        if len(self._buffer) >= S3_PART_SIZE:
+            await self._flush()
+
+    async def publish(self, file_name, tails_hash):
+        if self._upload_id is None:
+            await self.storage.put_object(file_name, bytes(self._buffer), tails_hash)
+            self._buffer.clear()
+            return
+
+        if self._buffer:
+            await self._flush()
+        await self.storage.complete_multipart_upload(
+            self.key, self._upload_id, self._parts
+        )
+        self._upload_id = None
+        self._staged = True
+        await self.storage.copy_object(self.key, file_name, tails_hash)
+
+    async def discard(self):
+        self._buffer.clear()
+        try:
+            if self._upload_id is not None:
+                await self.storage.abort_multipart_upload(self.key, self._upload_id)
+            elif self._staged:
+                await self.storage.delete_object(self.key)
+        except (aiohttp.ClientError, S3Error) as e:
+            LOGGER.warning(f"Failed to clean up staged upload {self.key}: {e}")
+
+
+class S3Storage(StorageBackend):
+    """Tails files as objects in a bucket of an S3-compatible object store.
+
+    Requests use path-style addressing and are signed with the credentials in
+    `AWS_ACCESS_KEY_ID`, `AWS_SECRET_ACCESS_KEY` and, if set,
+    `AWS_SESSION_TOKEN`. Each file's tailsHash is recorded in its metadata.
+    An alias is an empty object that names the file it stands for, so
+    aliases do not duplicate data.
+    """
+
+    def __init__(self, bucket, region=None, endpoint=None, prefix=""):
+        """Initialize the backend."""
+        self.bucket = bucket
+        self.region = region or os.environ.get("AWS_REGION") or "us-east-1"
+        self.endpoint = (endpoint or f"https://s3.{self.region}.amazonaws.com").rstrip(
+            "/"
+        )
+        self.host = urlsplit(self.endpoint).netloc
+        self.prefix = prefix
+        self.credentials = (
+            os.environ.get("AWS_ACCESS_KEY_ID", ""),
+            os.environ.get("AWS_SECRET_ACCESS_KEY", ""),
+        )
+        self.session_token = os.environ.get("AWS_SESSION_TOKEN")
+        self._session = None
+        # Aliases never change, so each only has to be resolved once
+        self._aliases = {}
+
+    def _key_path(self, file_name=None):
+        if file_name is None:
+            return f"/{self.bucket}"
+        return f"/{self.bucket}/{self.prefix}{file_name}"
+
+    def request(self, method, file_name=None, params=None, headers=None, data=None):
+        """Send a signed request about `file_name`, or the bucket if None."""
+        if self._session is None:
+            self._session = aiohttp.ClientSession(auto_decompress=False)
+        path = self._key_path(file_name)
+        params = params or {}
+        headers = {k.lower(): v for k, v in (headers or {}).items()}
+        headers["x-amz-date"] = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        headers["x-amz-content-sha256"] = (
+            _EMPTY_SHA256 if data is None else _UNSIGNED_PAYLOAD
+        )
+        if self.session_token:
+            headers["x-amz-security-token"] = self.session_token
+        headers["authorization"] = sign_request(
+            method, self.host, path, params, headers, self.credentials, self.region
+        )
+        headers["host"] = self.host
+
+        query = "&".join(f"{_encode(k)}={_encode(v)}" for k, v in params.items())
+        url = (
+            self.endpoint + _encode(path, safe="/-_.~") + (f"?{query}" if query else "")
+        )
+        return self._session.request(
+            method, URL(url, encoded=True), headers=headers, data=data
+        )
+
+    async def _check(self, response, expected=(200,)):
+        body = await response.read()
+        if response.status == 404:
+            raise FileNotFoundError()
+        if response.status == 412:
+            raise FileExistsError()
+        # Some operations report failures in the body of a 200 response
+        if response.status not in expected or body.lstrip().startswith(b"<Error"):
+            raise S3Error(response.status, body)
+        return body
+
+    async def _head(self, file_name):
+        async with self.request("HEAD", file_name) as response:
+            if response.status == 404:
+                raise FileNotFoundError(file_name)
+            if response.status != 200:
+                raise S3Error(response.status, b"")
+            return response.headers
+
+    async def _resolve(self, file_name):
+        """Return the name of the object holding the data of `file_name`."""
+        target = self._aliases.get(file_name)
+        if target is None:
+            target = (await self._head(file_name)).get(_META_ALIAS_OF) or file_name
+            if len(self._aliases) >= MAX_REMEMBERED_HASHES:
+                self._aliases.pop(next(iter(self._aliases)))
+            self._aliases[file_name] = target
+        return target
+
+    def stage(self, max_size=None):
+        return S3StagedUpload(self, max_size)
+
+    async def stat(self, file_name):
+        headers = await self._head(await self._resolve(file_name))
+        return StoredFile(
+            int(headers["Content-Length"]),
+            parsedate_to_datetime(headers["Last-Modified"]).timestamp(),
+            headers.get(_META_TAILS_HASH),
+        )
+
+    async def exists(self, file_name):
+        try:
+            await self._head(file_name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    async def read(self, file_name, offset=0, length=None):
+        if length == 0:
+            return
+        headers = {}
+        if offset or length is not None:
+            end = "" if length is None else offset + length - 1
+            headers["Range"] = f"bytes={offset}-{end}"
+        target = await self._resolve(file_name)
+        async with self.request("GET", target, headers=headers) as response:
+            if response.status == 416:
+                return
+            if response.status not in (200, 206):
+                await self._check(response, (200, 206))
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+
+    async def alias(self, file_name, alias):
+        if await self.exists(alias):
+            raise FileExistsError(alias)
+        tails_hash = (await self.stat(file_name)).tails_hash
+        headers = {_META_ALIAS_OF: await self._resolve(file_name), "If-None-Match": "*"}
+        if tails_hash:
+            headers[_META_TAILS_HASH] = tails_hash
+        async with self.request("PUT", alias, headers=headers, data=b"") as response:
+            await self._check(response)
+
+    async def names(self):
+        names = set()
+        params = {"list-type": "2", "prefix": self.prefix}
+        while True:
+            async with self.request("GET", params=params) as response:
+                root = ET.fromstring(await self._check(response))
+            for key in root.iterfind("s3:Contents/s3:Key", _NS):
+                name = key.text[len(self.prefix) :]
+                # Skip staging objects and anything else that is not a file
+                if not name.startswith(".") and "/" not in name:
+                    names.add(name)
+            token = root.findtext("s3:NextContinuationToken", None, _NS)
+            if root.findtext("s3:IsTruncated", "false", _NS) != "true" or not token:
+                return names
+            params = {**params, "continuation-token": token}
+
+    def location(self, file_name):
+        return f"s3://{self.bucket}/{self.prefix}{file_name}"
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def put_object(self, file_name, data, tails_hash):
+        """Store a small file with a single request, unless it exists."""
+        headers = {_META_TAILS_HASH: tails_hash, "If-None-Match": "*"}
+        async with self.request("PUT", file_name, headers=headers, data=data) as r:
+            await self._check(r)
+
+    async def create_multipart_upload(self, file_name):
+        """Start a multipart upload and return its id."""
+        async with self.request("POST", file_name, params={"uploads": ""}) as r:
+            root = ET.fromstring(await self._check(r))
+        return root.findtext("s3:UploadId", None, _NS)
+
+    async def upload_part(self, file_name, upload_id, part_number, data):
+        """Upload one part of a multipart upload and return its ETag."""
+        params = {"partNumber": str(part_number), "uploadId": upload_id}
+        async with self.request("PUT", file_name, params=params, data=data) as r:
+            await self._check(r)
+            return r.headers["ETag"]
+
+    async def complete_multipart_upload(self, file_name, upload_id, etags):
+        """Assemble the uploaded parts into an object."""
+        root = ET.Element("CompleteMultipartUpload")
+        for number, etag in enumerate(etags, 1):
+            part = ET.SubElement(root, "Part")
+            ET.SubElement(part, "PartNumber").text = str(number)
+            ET.SubElement(part, "ETag").text = etag
+        params = {"uploadId": upload_id}
+        data = ET.tostring(root)
+        async with self.request("POST", file_name, params=params, data=data) as r:
+            await self._check(r)
+
+    async def abort_multipart_upload(self, file_name, upload_id):
+        """Drop a multipart upload and its parts."""
+        params = {"uploadId": upload_id}
+        async with self.request("DELETE", file_name, params=params) as r:
+            await self._check(r, (200, 204))
+
+    async def copy_object(self, source, file_name, tails_hash):
+        """Copy `source` to `file_name`, unless `file_name` exists."""
+        # CopyObject has no conditional write, but a name always holds the
+        # same content, so losing a race to another copy does no harm
+        if await self.exists(file_name):
+            raise FileExistsError(file_name)
+        headers = {
+            "x-amz-copy-source": _encode(self._key_path(source), safe="/-_.~"),
+            "x-amz-metadata-directive": "REPLACE",
+            _META_TAILS_HASH: tails_hash,
+        }
+        async with self.request("PUT", file_name, headers=headers) as r:
+            await self._check(r)
+
+    async def delete_object(self, file_name):
+        """Delete an object."""
+        async with self.request("DELETE", file_name) as r:
+            await self._check(r, (200, 204))
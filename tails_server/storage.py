@@ -0,0 +1,150 @@
+"""Storage backends for tails files."""
+
+import asyncio
+import os
+from typing import NamedTuple, Optional
+
+from .config.defaults import DOWNLOAD_CHUNK_SIZE
+from .layout import StorageLayout
+from .upload import StagedUpload, publish_alias
+
+
+class StoredFile(NamedTuple):
+    """Size, modification time and, if the backend records it, tailsHash."""
+
+    size: int
+    mtime: float
+    tails_hash: Optional[str] = None
+
+
+class StorageBackend:
+    """Where tails files are kept.
+
+    Files are named by their tailsHash or by a revocation registry id, and
+    never change once stored. Methods raise `FileNotFoundError` for files that
+    are not stored.
+    """
+
+    # Whether files are on a local filesystem, as `layout`
+    local = False
+
+    def stage(self, max_size=None):
+        """Return a new `BaseStagedUpload` to stream an upload into."""
+        raise NotImplementedError()
+
+    async def stat(self, file_name) -> StoredFile:
+        """Return the size and modification time of a stored file."""
+        raise NotImplementedError()
+
+    async def exists(self, file_name) -> bool:
+        """Check whether a file is stored."""
+        try:
+            await self.stat(file_name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    async def read(self, file_name, offset=0, length=None):
+        """Yield the contents of a stored file in chunks, from `offset` on.
+
+        Stops after `length` bytes if given, or at the end of the file.
+        """
+        raise NotImplementedError()
+        yield
+
+    async def alias(self, file_name, alias):
+        """Store `alias` as another name for the stored file `file_name`.
+
+        Raises `FileExistsError` if a file called `alias` is already stored.
+        """
+        raise NotImplementedError()
+
+    async def names(self) -> set:
+        """Return the names of all stored files."""
+        raise NotImplementedError()
+
+    def location(self, file_name) -> str:
+        """Return where `file_name` is stored, for display."""
+        raise NotImplementedError()
+
+    async def close(self):
+        """Release the backend's resources."""
+
+
+def _stat_file(layout, file_name):
+    try:
+        with layout.open(file_name) as tails_file:
+            st = os.fstat(tails_file.fileno())
+    except IsADirectoryError:
+        raise FileNotFoundError(file_name)
+    return StoredFile(st.st_size, st.st_mtime)
+
+
+class LocalStorage(StorageBackend):
+    """Tails files on a local or mounted filesystem, placed by a `StorageLayout`."""
+
+    local = True
+
+    def __init__(self, layout):
+        """Initialize the backend."""
+        self.layout = layout
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def stage(self, max_size=None):
+        return StagedUpload(self.layout, max_size)
+
+    async def stat(self, file_name):
+        return await self._run(_stat_file, self.layout, file_name)
+
+    async def exists(self, file_name):
+        return await self._run(self.layout.locate, file_name) is not None
+
+    async def read(self, file_name, offset=0, length=None):
+        try:
+            tails_file = await self._run(self.layout.open, file_name)
+        except IsADirectoryError:
+            raise FileNotFoundError(file_name)
+        try:
+            while length is None or length > 0:
+                size = DOWNLOAD_CHUNK_SIZE
+                if length is not None:
+                    size = min(size, length)
+                chunk = await self._run(os.pread, tails_file.fileno(), size, offset)
+                if not chunk:
+                    break
+                yield chunk
+                offset += len(chunk)
+                if length is not None:
+                    length -= len(chunk)
+        finally:
+            tails_file.close()
+
+    async def alias(self, file_name, alias):
+        await self._run(publish_alias, self.layout, file_name, alias)
+
+    async def names(self):
+        return await self._run(self.layout.names)
+
+    def location(self, file_name):
+        return self.layout.path(file_name)
+
+
+def create_storage(settings):
+    """Create the storage backend configured in `settings`."""
+    if settings.get("storage_backend") == "s3":
+        from .s3 import S3Storage
+
+        return S3Storage(
+            settings["s3_bucket"],
+            region=settings.get("s3_region"),
+            endpoint=settings.get("s3_endpoint"),
+            prefix=settings.get("s3_prefix") or "",
+        )
+
+    return LocalStorage(
+        StorageLayout(
+            settings["storage_path"], settings.get("storage_layout") == "sharded"
+        )
+    )
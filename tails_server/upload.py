@@ -0,0 +1,307 @@
+"""Staging and publishing of uploaded tails files."""
+
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import time
+from contextlib import asynccontextmanager
+from tempfile import mkstemp
+
+import base58
+
+from .config.defaults import (
+    CHUNK_SIZE,
+    STAGING_DIR,
+    UPLOAD_CLAIM_TIMEOUT,
+    UPLOAD_HEAD_SIZE,
+    UPLOAD_MAX_CHUNK_SIZE,
+    UPLOAD_QUEUE_DEPTH,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _link_or_copy(source_path, file_path):
+    try:
+        os.link(source_path, file_path)
+    except FileExistsError:
+        raise
+    except OSError as e:
+        # Some filesystems do not support hard links; fall back to an
+        # exclusive create ('x' mode == O_EXCL | O_CREAT) and a copy.
+        LOGGER.debug(f"Hard link failed ({e}), copying {source_path} instead")
+        with open(source_path, "rb") as source, open(file_path, "xb") as tails_file:
+            shutil.copyfileobj(source, tails_file, CHUNK_SIZE)
+
+
+def publish_alias(layout, tails_hash, alias):
+    """Publish `alias` as another name for the stored tails file `tails_hash`.
+
+    Raises `FileExistsError` if a file called `alias` is already stored.
+    """
+    source_path = layout.locate(tails_hash)
+    if source_path is None:
+        raise FileNotFoundError(tails_hash)
+    _link_or_copy(source_path, layout.prepare(alias))
+
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload grows beyond the size it is allowed to have."""
+
+    def __init__(self, max_size, size):
+        """Initialize the error with the allowed and attempted sizes."""
+        super().__init__(f"Upload of at least {size} bytes exceeds {max_size} bytes")
+        self.max_size = max_size
+        self.size = size
+
+
+class UploadInProgressError(Exception):
+    """Raised when an upload of the same name is still in progress."""
+
+
+class UploadsInProgress:
+    """Names being uploaded to this process, so duplicate uploads run one at a time.
+
+    A duplicate of an upload in progress waits for it to finish rather than
+    staging and hashing the same data alongside it. It then usually finds the
+    file stored, and is rejected without writing anything. Uploads in other
+    processes are still resolved by the exclusive publish.
+    """
+
+    def __init__(self):
+        """Initialize the registry."""
+        self._uploads = {}
+
+    @asynccontextmanager
+    async def claim(self, name, timeout=UPLOAD_CLAIM_TIMEOUT):
+        """Wait until no other upload of `name` is in progress, then hold `name`.
+
+        Raises `UploadInProgressError` if another upload still holds `name`
+        after `timeout` seconds, so a stalled upload cannot hold up the
+        duplicates queued behind it indefinitely.
+        """
+        try:
+            async with asyncio.timeout(timeout):
+                while (running := self._uploads.get(name)) is not None:
+                    LOGGER.debug(f"Waiting for upload of {name} in progress")
+                    await running.wait()
+        except TimeoutError:
+            raise UploadInProgressError(name) from None
+        done = asyncio.Event()
+        self._uploads[name] = done
+        try:
+            yield
+        finally:
+            del self._uploads[name]
+            done.set()
+
+
+class BaseStagedUpload:
+    """An upload on its way into a storage backend.
+
+    `max_size` bounds the number of bytes `receive_upload` accepts; it may be
+    lowered while the upload is in progress, e.g. once the expected size of the
+    file is known. Setting `verifying` makes `receive_upload` hash the rest of
+    the upload without writing it, e.g. once it turns out the file is already
+    stored under another name. Setting `discarding` makes it read the rest
+    without even hashing it, once the upload is bound to be rejected. `head`
+    holds the first bytes received.
+
+    Used as an async context manager, which discards whatever has not been
+    published on exit.
+    """
+
+    def __init__(self, max_size=None):
+        """Initialize the upload."""
+        self.max_size = max_size
+        self.size = 0
+        self.verifying = False
+        self.discarding = False
+        self.head = b""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.discard()
+
+    async def write(self, chunk):
+        """Append a chunk of the upload."""
+        raise NotImplementedError()
+
+    async def publish(self, file_name, tails_hash):
+        """Publish the upload as `file_name`, a file with the given tailsHash.
+
+        Raises `FileExistsError` if a file of that name is already stored.
+        """
+        raise NotImplementedError()
+
+    async def discard(self):
+        """Drop the upload, unless it was published."""
+        raise NotImplementedError()
+
+
+class StagedUpload(BaseStagedUpload):
+    """An upload written to a staging file inside the storage volume.
+
+    Staging next to the final location means the file is written once and then
+    published with a hard link, which is atomic and fails if the target
+    exists, even across networked filesystems:
+    http://nfs.sourceforge.net/ (D10)
+    """
+
+    def __init__(self, layout, max_size=None):
+        """Initialize the upload; the staging file is created on first write."""
+        super().__init__(max_size)
+        self.layout = layout
+        self.path = None
+        self.file = None
+
+    def _write(self, chunk):
+        if self.file is None:
+            staging_path = os.path.join(self.layout.storage_path, STAGING_DIR)
+            os.makedirs(staging_path, exist_ok=True)
+            fd, self.path = mkstemp(dir=staging_path)
+            self.file = os.fdopen(fd, "w+b")
+        self.file.write(chunk)
+
+    async def write(self, chunk):
+        await asyncio.get_running_loop().run_in_executor(None, self._write, chunk)
+
+    def _publish(self, file_name):
+        if self.file is None:
+            self._write(b"")
+        # Never publish a file whose contents could be lost in a crash
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        _link_or_copy(self.path, self.layout.prepare(file_name))
+
+    async def publish(self, file_name, tails_hash):
+        await asyncio.get_running_loop().run_in_executor(None, self._publish, file_name)
+
+    async def discard(self):
+        if self.file is None:
+            return
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+async def read_field(field, max_size=None):
+    """Read a small multipart field whole.
+
+    Raises `UploadTooLargeError` if the field is larger than `max_size`, before
+    the excess is buffered.
+    """
+    data = bytearray()
+    while chunk := await field.read_chunk(CHUNK_SIZE):
+        if max_size is not None and len(data) + len(chunk) > max_size:
+            raise UploadTooLargeError(max_size, len(data) + len(chunk))
+        data += chunk
+    return bytes(data)
+
+
+async def receive_upload(field, staged):
+    """Stream a multipart field into `staged` and return its base58 SHA-256 digest.
+
+    Chunks are hashed in the default executor and written to the storage
+    backend, side by side, while the next chunks are received, so a large
+    upload does not stall the event loop. At most
+    `UPLOAD_QUEUE_DEPTH` chunks are buffered before reads wait for the writer.
+    Read sizes grow while the client keeps the buffer full, and chunks that
+    arrive while a write is in progress are written together.
+
+    Raises `UploadTooLargeError`, before the excess reaches the disk, if the
+    field is larger than `staged.max_size`. Chunks received once
+    `staged.verifying` is set are hashed but not written. The digest is
+    meaningless if `staged.discarding` was set.
+    """
+    loop = asyncio.get_running_loop()
+    sha256 = hashlib.sha256()
+    queue = asyncio.Queue(UPLOAD_QUEUE_DEPTH)
+    failure = None
+
+    async def consume(data):
+        if staged.verifying:
+            await loop.run_in_executor(None, sha256.update, data)
+            return
+        await asyncio.gather(
+            loop.run_in_executor(None, sha256.update, data), staged.write(data)
+        )
+
+    async def write_chunks():
+        nonlocal failure
+        # Keep draining the queue after a failure so the reader never blocks
+        done = False
+        while not done:
+            chunks = [await queue.get()]
+            while not queue.empty():
+                chunks.append(queue.get_nowait())
+            if chunks[-1] is None:
+                chunks.pop()
+                done = True
+            if chunks and failure is None:
+                try:
+                    await consume(b"".join(chunks))
+                except Exception as e:
+                    failure = e
+
+    writer = asyncio.create_task(write_chunks())
+    try:
+        size = CHUNK_SIZE
+        while failure is None:
+            chunk = await field.read_chunk(size)
+            if not chunk:
+                break
+            if (
+                staged.max_size is not None
+                and staged.size + len(chunk) > staged.max_size
+            ):
+                raise UploadTooLargeError(staged.max_size, staged.size + len(chunk))
+            if len(staged.head) < UPLOAD_HEAD_SIZE:
+                staged.head += chunk[: UPLOAD_HEAD_SIZE - len(staged.head)]
+            staged.size += len(chunk)
+            if not staged.discarding:
+                await queue.put(chunk)
+            if len(chunk) == size:
+                size = min(size * 2, UPLOAD_MAX_CHUNK_SIZE)
+    except BaseException as e:
+        # Stop writing, but let the writer wind down before the staged file is
+        # discarded
+        failure = failure or e
+        raise
+    finally:
+        await queue.put(None)
+        await writer
+
+    if failure is not None:
+        raise failure
+
+    return base58.b58encode(sha256.digest()).decode("utf-8")
+
+
+def clean_staging(storage_path, max_age):
+    """Remove staging files left behind by uploads older than `max_age` seconds.
+
+    Other processes may be staging uploads on a shared volume, so recent files
+    are left alone.
+    """
+    staging_path = os.path.join(storage_path, STAGING_DIR)
+    try:
+        entries = list(os.scandir(staging_path))
+    except FileNotFoundError:
+        return
+
+    cutoff = time.time() - max_age
+    for entry in entries:
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+                LOGGER.info(f"Removed stale staged upload {entry.name}")
+        except FileNotFoundError:
+            pass
@@ -1,230 +1,644 @@
-import hashlib
+import asyncio
+import json
 import logging
 import os
-from os.path import isfile, join
-from tempfile import NamedTemporaryFile
-
-import base58
-from aiohttp import web
-
-from .config.defaults import CHUNK_SIZE, DEFAULT_WEB_HOST, DEFAULT_WEB_PORT
-from .ledger import BadGenesisError, BadRevocationRegistryIdError, get_rev_reg_def
+import random
+import shutil
+import time
+from contextlib import asynccontextmanager, suppress
+from functools import partial
+from itertools import islice
+from tempfile import mkdtemp
+
+from aiohttp import hdrs, web
+from aiohttp.web_log import AccessLogger
+
+from . import metrics
+from .cache import CachedTailsFile, TailsCache
+from .catalog import Catalog, CatalogEntry, fill_catalog
+from .config.defaults import (
+    CACHE_CONTROL,
+    DEFAULT_CACHE_MAX_FILE_SIZE,
+    DEFAULT_QUERY_LIMIT,
+    DEFAULT_WEB_HOST,
+    DEFAULT_WEB_PORT,
+    MAX_QUERY_LIMIT,
+    MAX_TAILS_PER_REQUEST,
+    NDJSON,
+    QUERY_BATCH_SIZE,
+    SHUTDOWN_TIMEOUT,
+    TAIL_SIZE,
+    TAILS_VERSION_TAG,
+)
+from .download import is_tails_hash, remember_tails_hash, send_tails_file
+from .index import FilenameIndex
+from .ledger import (
+    BadGenesisError,
+    BadRevocationRegistryIdError,
+    PoolCache,
+    RevRegDefCache,
+    create_resolver,
+    get_rev_reg_def,
+)
+from .mirror import Mirror, MirrorError, send_fetch
+from .query import FILTERS, query_registries
+from .replication import Replicator, is_replicated
+from .storage import create_storage
+from .upload import (
+    UploadInProgressError,
+    UploadsInProgress,
+    UploadTooLargeError,
+    read_field,
+    receive_upload,
+)
+from .workers import run_workers
 
 LOGGER = logging.getLogger(__name__)
 
 routes = web.RouteTableDef()
 
 
+@routes.get("/metrics")
+async def get_metrics(request):
+    """Report runtime metrics in the Prometheus text format."""
+    index = request.app.get("filename_index")
+    if index is not None:
+        metrics.STORED_FILES.set(len(index))
+    catalog = request.app.get("catalog")
+    if catalog is not None:
+        metrics.STORED_BYTES.set(await catalog.run(catalog.stored_bytes))
+
+    snapshots = ()
+    metrics_dir = request.app["settings"].get("metrics_dir")
+    if metrics_dir:
+        snapshots = await asyncio.get_running_loop().run_in_executor(
+            None, metrics.read_snapshots, metrics_dir
+        )
+    return web.Response(
+        body=metrics.render(snapshots).encode("utf-8"),
+        headers={hdrs.CONTENT_TYPE: metrics.CONTENT_TYPE},
+    )
+
+
 @routes.get("/match/{substring}")
 async def match_files(request):
     substring = request.match_info["substring"]  # e.g., cred def id, issuer DID, tag
-    storage_path = request.app["settings"]["storage_path"]
-    tails_files = [
-        join(storage_path, f)
-        for f in os.listdir(storage_path)
-        if isfile(join(storage_path, f)) and substring in f
-    ]
+    storage = request.app["storage"]
+    index = request.app.get("filename_index")
+    if index is not None:
+        names = index.match(substring)
+    else:
+        names = sorted(f for f in await storage.names() if substring in f)
+    tails_files = [storage.location(f) for f in names]
     return web.json_response(tails_files)
 
 
-@routes.get("/{revocation_reg_id}")
-async def get_file(request):
-    revocation_reg_id = request.match_info["revocation_reg_id"]
-    storage_path = request.app["settings"]["storage_path"]
+@routes.get("/registries")
+async def query_files(request):
+    """Stream the stored revocation registries matching the query as NDJSON."""
+    filters = {
+        field: request.query[field] for field in FILTERS if field in request.query
+    }
+    cursor = request.query.get("cursor")
+    limit = query_limit(request)
+    index = await stored_names(request.app)
+    registries = islice(query_registries(index, filters, cursor), limit)
+    return await stream_ndjson(
+        request, (rev_reg_id._asdict() for rev_reg_id in registries)
+    )
 
-    response = web.StreamResponse()
-    response.enable_compression()
-    response.enable_chunked_encoding()
 
-    # Stream the response since the file could be big.
+def query_limit(request):
+    """Return the page size requested by a paginated query."""
     try:
-        with open(os.path.join(storage_path, revocation_reg_id), "rb") as tails_file:
-            await response.prepare(request)
-            while True:
-                chunk = tails_file.read(CHUNK_SIZE)
-                if not chunk:
-                    break
-                await response.write(chunk)
+        limit = int(request.query.get("limit", DEFAULT_QUERY_LIMIT))
+    except ValueError:
+        raise web.HTTPBadRequest(text="limit must be an integer")
+    if not 0 < limit <= MAX_QUERY_LIMIT:
+        raise web.HTTPBadRequest(text=f"limit must be between 1 and {MAX_QUERY_LIMIT}")
+    return limit
+
+
+async def stored_names(app):
+    """Return the filename index, or a throwaway one if it is disabled."""
+    index = app.get("filename_index")
+    if index is None:
+        index = FilenameIndex()
+        for name in await app["storage"].names():
+            index.add(name)
+    return index
+
+
+async def stream_ndjson(request, records):
+    """Stream JSON-serializable `records` as NDJSON."""
+    response = web.StreamResponse()
+    response.content_type = NDJSON
+    await response.prepare(request)
+
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record) + "\n")
+        if len(lines) == QUERY_BATCH_SIZE:
+            await response.write("".join(lines).encode("utf-8"))
+            lines = []
+    if lines:
+        await response.write("".join(lines).encode("utf-8"))
+    await response.write_eof()
 
-    except FileNotFoundError:
+    return response
+
+
+@routes.get("/replication/inventory")
+async def replication_inventory(request):
+    """Stream the sorted names of all stored files as NDJSON, for peers to sync."""
+    limit = query_limit(request)
+    index = await stored_names(request.app)
+    names = index.range(after=request.query.get("cursor"))
+    return await stream_ndjson(request, islice(names, limit))
+
+
+@routes.post("/replication/announce")
+async def replication_announce(request):
+    """Pull files a peer announces, if this node replicates its peers."""
+    replicator = request.app.get("replicator")
+    if replicator is None:
         raise web.HTTPNotFound()
+    try:
+        names = (await request.json())["names"]
+    except (ValueError, KeyError, TypeError):
+        raise web.HTTPBadRequest(text="Expected a JSON object with a names list.")
+    if (
+        not isinstance(names, list)
+        or len(names) > MAX_QUERY_LIMIT
+        or not all(isinstance(name, str) for name in names)
+    ):
+        raise web.HTTPBadRequest(text="Expected a JSON object with a names list.")
+    if not all(map(is_replicated, names)):
+        raise web.HTTPBadRequest(
+            text="Names must be tails hashes or revocation registry ids."
+        )
+    if not replicator.receive(names):
+        raise web.HTTPServiceUnavailable(text="Too many files waiting to be pulled.")
+    return web.Response(status=web.HTTPAccepted.status_code)
+
+
+def announce_upload(app, *names):
+    """Let the peers know about files that were just uploaded."""
+    replicator = app.get("replicator")
+    if replicator is not None:
+        replicator.announce(names)
 
-    await response.write_eof()
+
+@routes.get("/{revocation_reg_id}")
+async def get_file(request):
+    revocation_reg_id = request.match_info["revocation_reg_id"]
+    return await send_or_mirror(request, revocation_reg_id)
 
 
 @routes.get("/hash/{tails_hash}")
 async def get_file_by_hash(request):
     tails_hash = request.match_info["tails_hash"]
-    storage_path = request.app["settings"]["storage_path"]
+    return await send_or_mirror(request, tails_hash, tails_hash)
 
-    response = web.StreamResponse()
-    response.enable_compression()
-    response.enable_chunked_encoding()
 
-    # Stream the response since the file could be big.
+async def wait_for_mirror(future):
+    """Wait for a stage of a fetch from upstream, raising an HTTP error if it fails."""
     try:
-        with open(os.path.join(storage_path, tails_hash), "rb") as tails_file:
-            await response.prepare(request)
-            while True:
-                chunk = tails_file.read(CHUNK_SIZE)
-                if not chunk:
-                    break
-                await response.write(chunk)
-
+        # Other requests may be waiting for the same fetch
+        await asyncio.shield(future)
     except FileNotFoundError:
         raise web.HTTPNotFound()
+    except MirrorError:
+        raise web.HTTPBadGateway(text="Failed to fetch tails file from upstream.")
+
+
+def is_plain_get(request):
+    """Check whether a request asks for a whole file, unconditionally."""
+    return request.method == hdrs.METH_GET and not any(
+        header in request.headers
+        for header in (
+            hdrs.RANGE,
+            hdrs.IF_MATCH,
+            hdrs.IF_NONE_MATCH,
+            hdrs.IF_MODIFIED_SINCE,
+            hdrs.IF_RANGE,
+        )
+    )
 
-    await response.write_eof()
 
+async def send_or_mirror(request, file_name, tails_hash=None):
+    """Serve a stored tails file, fetching it from upstream if it is missing.
 
-@routes.put("/{revocation_reg_id}")
-async def put_file(request):
-    storage_path = request.app["settings"]["storage_path"]
-
-    # Check content-type for multipart
-    content_type_header = request.headers.get("Content-Type")
-    if "multipart" not in content_type_header:
-        LOGGER.debug(f"Bad Content-Type header: {content_type_header}")
-        raise web.HTTPBadRequest(text="Expected mutlipart content type")
+    A whole-file download of a small file is streamed as it is fetched; other
+    requests are answered once the file is stored.
+    """
+    mirror = request.app.get("mirror")
+    if mirror is None:
+        return await send_tails_file(request, file_name, tails_hash)
+    try:
+        return await send_tails_file(request, file_name, tails_hash)
+    except web.HTTPNotFound:
+        pass
+
+    fetch = mirror.fetch(file_name, tails_hash)
+    await wait_for_mirror(fetch.started)
+    if fetch.chunks is not None and is_plain_get(request):
+        return await send_fetch(request, fetch)
+    await wait_for_mirror(fetch.finished)
+    return await send_tails_file(request, file_name, tails_hash)
+
+
+def read_tails(layout, file_name, index, count):
+    """Read up to `count` tails starting at tail `index` from a tails file.
+
+    This performs blocking I/O and should be run in an executor.
+    """
+    offset = len(TAILS_VERSION_TAG) + index * TAIL_SIZE
+    with layout.open(file_name) as tails_file:
+        data = os.pread(tails_file.fileno(), count * TAIL_SIZE, offset)
+    # Never hand out a partial tail
+    return data[: len(data) - len(data) % TAIL_SIZE]
+
+
+async def read_stored_tails(storage, file_name, index, count):
+    """Read up to `count` tails starting at tail `index` from a storage backend."""
+    offset = len(TAILS_VERSION_TAG) + index * TAIL_SIZE
+    data = b"".join(
+        [chunk async for chunk in storage.read(file_name, offset, count * TAIL_SIZE)]
+    )
+    return data[: len(data) - len(data) % TAIL_SIZE]
 
-    reader = await request.multipart()
 
-    # Get genesis transactions
-    field = await reader.next()
-    if field.name != "genesis":
-        LOGGER.debug(f"First field is not `genesis`, it's {field.name}")
+async def read_tails_from(storage, file_name, index, count):
+    """Read up to `count` tails starting at tail `index` from any storage backend."""
+    try:
+        if storage.local:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, read_tails, storage.layout, file_name, index, count
+            )
+        return await read_stored_tails(storage, file_name, index, count)
+    except IsADirectoryError:
+        raise FileNotFoundError(file_name)
+    except OverflowError:
+        # Index is far beyond any file offset
+        return b""
+
+
+async def tails_response(request, file_name, tails_hash=None):
+    """Serve one tail, or a run of consecutive tails, from a stored tails file.
+
+    In mirror mode a missing file is fetched from upstream first.
+    """
+    index = int(request.match_info["index"])
+    try:
+        count = int(request.query.get("count", 1))
+    except ValueError:
+        raise web.HTTPBadRequest(text="count must be an integer.")
+    if not 1 <= count <= MAX_TAILS_PER_REQUEST:
         raise web.HTTPBadRequest(
-            text="First field in multipart request must have name 'genesis'"
+            text=f"count must be between 1 and {MAX_TAILS_PER_REQUEST}."
         )
-    genesis_txn_bytes = await field.read()
 
-    # Lookup revocation registry and get tailsHash
+    storage = request.app["storage"]
+    mirror = request.app.get("mirror")
+    try:
+        data = await read_tails_from(storage, file_name, index, count)
+    except FileNotFoundError:
+        if mirror is None:
+            raise web.HTTPNotFound()
+        await wait_for_mirror(mirror.fetch(file_name, tails_hash).finished)
+        try:
+            data = await read_tails_from(storage, file_name, index, count)
+        except FileNotFoundError:
+            raise web.HTTPNotFound()
+
+    if not data:
+        raise web.HTTPNotFound(text="Tail index out of range.")
+
+    return web.Response(
+        body=data,
+        content_type="application/octet-stream",
+        headers={hdrs.CACHE_CONTROL: CACHE_CONTROL},
+    )
+
+
+@routes.get(r"/{revocation_reg_id}/tails/{index:\d+}")
+async def get_tails(request):
     revocation_reg_id = request.match_info["revocation_reg_id"]
+    return await tails_response(request, revocation_reg_id)
+
+
+@routes.get(r"/hash/{tails_hash}/tails/{index:\d+}")
+async def get_tails_by_hash(request):
+    tails_hash = request.match_info["tails_hash"]
+    return await tails_response(request, tails_hash, tails_hash)
+
+
+async def record_upload(app, file_name, tails_hash):
+    """Make a file that was just published known to the caches, index and catalog."""
+    storage = app["storage"]
+    stored = await storage.stat(file_name)
+
+    remember_tails_hash(file_name, tails_hash)
+
+    # Cached by content, so a file is cached once under all of its names
+    cache = app.get("tails_cache")
+    if cache and cache.accepts(stored.size) and tails_hash not in cache:
+        data = b"".join([chunk async for chunk in storage.read(file_name)])
+        cache.put(tails_hash, CachedTailsFile(data, stored.mtime, tails_hash))
+
+    index = app.get("filename_index")
+    if index is not None:
+        index.add(file_name)
+
+    catalog = app.get("catalog")
+    if catalog is not None:
+        await catalog.run(
+            catalog.put, CatalogEntry(file_name, tails_hash, stored.size, stored.mtime)
+        )
+
+
+async def cancel_and_wait(task):
+    """Cancel `task` if it is still running and wait for it to finish."""
+    task.cancel()
+    with suppress(Exception, asyncio.CancelledError):
+        await task
+
+
+async def lookup_rev_reg_def(request, genesis_txn_bytes, revocation_reg_id):
+    """Return a revocation registry definition, or raise an HTTP error."""
+    start = time.perf_counter()
+    outcome = "error"
     try:
         revocation_registry_definition = await get_rev_reg_def(
-            genesis_txn_bytes, revocation_reg_id, storage_path
+            request.app["ledger"],
+            genesis_txn_bytes,
+            revocation_reg_id,
+            request.app.get("rev_reg_defs"),
         )
+        outcome = "found" if revocation_registry_definition else "not_found"
     except BadGenesisError:
+        outcome = "bad_genesis"
         LOGGER.debug(f"Received invalid genesis transactions")
         raise web.HTTPBadRequest(text="Genesis transactions are not valid.")
     except BadRevocationRegistryIdError:
+        outcome = "bad_id"
         LOGGER.debug(f"Revocation registry id is not valid: {revocation_reg_id}")
         raise web.HTTPBadRequest(
             text=f"Revocation registry ID is not valid: {revocation_reg_id}."
         )
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    finally:
+        metrics.LEDGER_LOOKUP_DURATION.observe(time.perf_counter() - start, outcome)
 
     if not revocation_registry_definition:
         LOGGER.debug(f"Revocation registry not found for id {revocation_reg_id}")
         raise web.HTTPNotFound()
 
-    tails_hash = revocation_registry_definition["value"]["tailsHash"]
+    return revocation_registry_definition
+
+
+def expected_tails_size(revocation_registry_definition):
+    """Return the size of the tails file of a registry, if it can be determined.
+
+    A registry for L credentials has 2L + 1 tails.
+    """
+    try:
+        max_cred_num = int(revocation_registry_definition["value"]["maxCredNum"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return len(TAILS_VERSION_TAG) + (2 * max_cred_num + 1) * TAIL_SIZE
+
+
+def declared_size(field):
+    """Return the Content-Length a multipart field declares, if any."""
+    try:
+        return int(field.headers[hdrs.CONTENT_LENGTH])
+    except (KeyError, ValueError):
+        return None
+
+
+def check_upload_request(request):
+    """Reject an upload whose headers already rule it out."""
+    max_upload_size = request.app["settings"].get("max_upload_size")
+    content_length = request.content_length
+    if max_upload_size and content_length and content_length > max_upload_size:
+        LOGGER.debug(f"Upload of {content_length} bytes is too large")
+        raise web.HTTPRequestEntityTooLarge(max_upload_size, content_length)
+
+    # Check content-type for multipart
+    content_type_header = request.headers.get("Content-Type")
+    if "multipart" not in content_type_header:
+        LOGGER.debug(f"Bad Content-Type header: {content_type_header}")
+        raise web.HTTPBadRequest(text="Expected mutlipart content type")
+
+
+@asynccontextmanager
+async def claim_upload(request, name):
+    """Hold `name` for this upload, once no other upload of it is in progress."""
+    try:
+        async with request.app["uploads"].claim(name):
+            yield
+    except UploadInProgressError:
+        LOGGER.debug(f"Upload of {name} is still in progress")
+        raise web.HTTPConflict(text="This tails file is already being uploaded.")
+
+
+@routes.put("/{revocation_reg_id}")
+async def put_file(request):
+    # Duplicate uploads of a registry wait for the first, then find it stored
+    revocation_reg_id = request.match_info["revocation_reg_id"]
+    check_upload_request(request)
+    async with claim_upload(request, revocation_reg_id):
+        return await receive_tails_file(request, revocation_reg_id)
+
+
+async def receive_tails_file(request, revocation_reg_id):
+    """Verify an upload against the ledger and store it under `revocation_reg_id`."""
+    storage = request.app["storage"]
+    reader = await request.multipart()
 
-    # Get second field
+    # Get genesis transactions
     field = await reader.next()
-    if field.name != "tails":
-        LOGGER.debug(f"Second field is not `tails`, it's {field.name}")
+    if field.name != "genesis":
+        LOGGER.debug(f"First field is not `genesis`, it's {field.name}")
         raise web.HTTPBadRequest(
-            text="Second field in multipart request must have name 'tails'"
+            text="First field in multipart request must have name 'genesis'"
         )
-
-    # Process the file in chunks so we don't explode on large files.
-    # Construct hash and write file in chunks.
-    sha256 = hashlib.sha256()
+    # The genesis transactions count towards the size of the upload
+    max_upload_size = request.app["settings"].get("max_upload_size")
     try:
-        # This should be atomic across networked filesystems:
-        # https://linux.die.net/man/3/open
-        # http://nfs.sourceforge.net/ (D10)
-        # 'x' mode == O_EXCL | O_CREAT
-        with NamedTemporaryFile("w+b") as tmp_file:
-            while True:
-                chunk = await field.read_chunk(CHUNK_SIZE)
-                if not chunk:
-                    break
-                sha256.update(chunk)
-                tmp_file.write(chunk)
+        genesis_txn_bytes = await read_field(field, max_upload_size)
+    except UploadTooLargeError as e:
+        raise web.HTTPRequestEntityTooLarge(e.max_size, e.size)
+    max_tails_size = None
+    if max_upload_size:
+        max_tails_size = max_upload_size - len(genesis_txn_bytes)
+
+    # Lookup revocation registry while the tails file is being received
+    ledger_lookup = asyncio.ensure_future(
+        lookup_rev_reg_def(request, genesis_txn_bytes, revocation_reg_id)
+    )
+    try:
+        # Get second field
+        field = await reader.next()
+        if field is None or field.name != "tails":
+            LOGGER.debug(f"Second field is not `tails`, it's {field and field.name}")
+            raise web.HTTPBadRequest(
+                text="Second field in multipart request must have name 'tails'"
+            )
+
+        # Process the file in chunks so we don't explode on large files.
+        # Construct hash and write file in chunks, staged in the storage backend.
+        alias_stored = await storage.exists(revocation_reg_id)
+        async with storage.stage(max_tails_size) as staged:
+            # A duplicate, e.g. one that waited for the first upload, is read
+            # without being written
+            staged.discarding = alias_stored
+            receiving = asyncio.ensure_future(receive_upload(field, staged))
+            expected_size = None
+            try:
+                done, _ = await asyncio.wait(
+                    (ledger_lookup, receiving), return_when=asyncio.FIRST_COMPLETED
+                )
+                # Fail fast if the upload broke off, and stop receiving as soon
+                # as the ledger rules the upload out
+                if receiving in done and receiving.exception():
+                    await receiving
+                if ledger_lookup in done and ledger_lookup.exception():
+                    receiving.cancel()
+                revocation_registry_definition = await ledger_lookup
+                tails_hash = revocation_registry_definition["value"]["tailsHash"]
+
+                # The registry fixes the size of the tails file, so anything
+                # declaring or growing beyond another size is rejected early
+                expected_size = expected_tails_size(revocation_registry_definition)
+                if expected_size is not None:
+                    if declared_size(field) not in (None, expected_size):
+                        raise web.HTTPBadRequest(
+                            text="Tails file is not the correct size."
+                        )
+                    if max_tails_size is None or expected_size < max_tails_size:
+                        staged.max_size = expected_size
+
+                # Tails files are stored once, named by their hash, and a
+                # revocation registry id is another name for that file. There
+                # is nothing to write if either is already stored, but an
+                # upload naming a stored file must still match its hash.
+                if not is_tails_hash(tails_hash):
+                    raise web.HTTPBadRequest(
+                        text="tailsHash does not match hash of file."
+                    )
+                blob_stored, alias_stored = await asyncio.gather(
+                    storage.exists(tails_hash), storage.exists(revocation_reg_id)
+                )
+                staged.verifying = blob_stored
+                staged.discarding = alias_stored
+
+                b58_digest = await receiving
+                if expected_size is not None and staged.size != expected_size:
+                    raise web.HTTPBadRequest(text="Tails file is not the correct size.")
+            except UploadTooLargeError as e:
+                if expected_size is not None and e.max_size == expected_size:
+                    raise web.HTTPBadRequest(text="Tails file is not the correct size.")
+                raise web.HTTPRequestEntityTooLarge(
+                    max_upload_size, len(genesis_txn_bytes) + e.size
+                )
+            finally:
+                await cancel_and_wait(receiving)
+
+            if alias_stored:
+                raise FileExistsError(revocation_reg_id)
 
             # Check file integrity against tailHash on ledger
-            digest = sha256.digest()
-            b58_digest = base58.b58encode(digest).decode("utf-8")
             if tails_hash != b58_digest:
+                metrics.HASH_MISMATCHES.inc("upload")
                 raise web.HTTPBadRequest(text="tailsHash does not match hash of file.")
 
-            # File integrity is good so write file to permanent location.
-            tmp_file.seek(0)
-            with open(
-                os.path.join(storage_path, revocation_reg_id), "xb"
-            ) as tails_file:
-                while True:
-                    chunk = tmp_file.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    tails_file.write(chunk)
+            if not blob_stored:
+                # File integrity is good so publish the file to its permanent
+                # location, unless an identical upload just beat us to it.
+                try:
+                    await staged.publish(tails_hash, tails_hash)
+                except FileExistsError:
+                    pass
+                else:
+                    await record_upload(request.app, tails_hash, tails_hash)
+
+            await storage.alias(tails_hash, revocation_reg_id)
+            await record_upload(request.app, revocation_reg_id, tails_hash)
+            announce_upload(request.app, tails_hash, revocation_reg_id)
 
     except FileExistsError:
         raise web.HTTPConflict(text="This tails file already exists.")
+    finally:
+        await cancel_and_wait(ledger_lookup)
 
     return web.Response(text=tails_hash)
 
 
 @routes.put("/hash/{tails_hash}")
 async def put_file_by_hash(request):
-    storage_path = request.app["settings"]["storage_path"]
+    # Duplicate uploads of a file wait for the first, then find it stored
+    tails_hash = request.match_info["tails_hash"]
+    check_upload_request(request)
+    async with claim_upload(request, tails_hash):
+        return await receive_tails_file_by_hash(request, tails_hash)
 
-    # Check content-type for multipart
-    content_type_header = request.headers.get("Content-Type")
-    if "multipart" not in content_type_header:
-        LOGGER.debug(f"Bad Content-Type header: {content_type_header}")
-        raise web.HTTPBadRequest(text="Expected mutlipart content type")
 
+async def receive_tails_file_by_hash(request, tails_hash):
+    """Verify an upload against `tails_hash` and store it under that name."""
+    storage = request.app["storage"]
     reader = await request.multipart()
 
-    tails_hash = request.match_info["tails_hash"]
-
     # Get first field
     field = await reader.next()
 
+    # Since each tail is 128 bytes, tails file size must be a multiple of 128
+    # plus the 2-byte version tag; reject a wrong declared size up front
+    size = declared_size(field)
+    if size is not None and (
+        size < len(TAILS_VERSION_TAG) or (size - len(TAILS_VERSION_TAG)) % TAIL_SIZE
+    ):
+        raise web.HTTPBadRequest(text="Tails file is not the correct size.")
+
     # Process the file in chunks so we don't explode on large files.
-    # Construct hash and write file in chunks.
-    sha256 = hashlib.sha256()
+    # Construct hash and write file in chunks, staged in the storage backend.
+    max_upload_size = request.app["settings"].get("max_upload_size")
+    stored = await storage.exists(tails_hash)
     try:
-        # This should be atomic across networked filesystems:
-        # https://linux.die.net/man/3/open
-        # http://nfs.sourceforge.net/ (D10)
-        # 'x' mode == O_EXCL | O_CREAT
-        with NamedTemporaryFile("w+b") as tmp_file:
-            while True:
-                chunk = await field.read_chunk(CHUNK_SIZE)
-                if not chunk:
-                    break
-                sha256.update(chunk)
-                tmp_file.write(chunk)
+        async with storage.stage(max_upload_size) as staged:
+            # Receive the upload before rejecting it, without writing it to disk
+            staged.discarding = stored
+            try:
+                b58_digest = await receive_upload(field, staged)
+            except UploadTooLargeError as e:
+                raise web.HTTPRequestEntityTooLarge(e.max_size, e.size)
+            if stored:
+                raise FileExistsError(tails_hash)
 
             # Check file integrity against tails_hash
-            digest = sha256.digest()
-            b58_digest = base58.b58encode(digest).decode("utf-8")
             if tails_hash != b58_digest:
+                metrics.HASH_MISMATCHES.inc("upload")
                 raise web.HTTPBadRequest(text="tailsHash does not match hash of file.")
 
             # Basic validation of tails file:
             # Tails file must start with "00 02"
-            tmp_file.seek(0)
-            if tmp_file.read(2) != b"\x00\x02":
+            if not staged.head.startswith(TAILS_VERSION_TAG):
                 raise web.HTTPBadRequest(text='Tails file must start with "00 02".')
 
             # Since each tail is 128 bytes, tails file size must be a multiple of 128
             # plus the 2-byte version tag
-            tmp_file.seek(0, 2)
-            if (tmp_file.tell() - 2) % 128 != 0:
+            if (staged.size - len(TAILS_VERSION_TAG)) % TAIL_SIZE != 0:
                 raise web.HTTPBadRequest(text="Tails file is not the correct size.")
 
-            # File integrity is good so write file to permanent location.
-            tmp_file.seek(0)
-            with open(os.path.join(storage_path, tails_hash), "xb") as tails_file:
-                while True:
-                    chunk = tmp_file.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    tails_file.write(chunk)
+            # File integrity is good so publish the file to its permanent location.
+            await staged.publish(tails_hash, tails_hash)
+
+            await record_upload(request.app, tails_hash, tails_hash)
+            announce_upload(request.app, tails_hash)
 
     except FileExistsError:
         raise web.HTTPConflict(text="This tails file already exists.")
@@ -232,14 +646,176 @@ async def put_file_by_hash(request):
     return web.Response(text=tails_hash)
 
 
-def start(settings):
-    app = web.Application()
+async def ledger_pools_ctx(app):
+    pools = app["ledger_pools"]
+    maintenance = asyncio.create_task(pools.maintain())
+    yield
+    maintenance.cancel()
+    pools.close()
+
+
+async def storage_ctx(app):
+    yield
+    await app["storage"].close()
+
+
+async def mirror_ctx(app):
+    yield
+    await app["mirror"].close()
+
+
+async def replication_ctx(app):
+    replicator = app["replicator"]
+    sync = asyncio.create_task(replicator.sync_once(app["settings"]["storage_path"]))
+    yield
+    await cancel_and_wait(sync)
+    await replicator.close()
+
+
+async def metrics_ctx(app):
+    metrics_dir = app["settings"]["metrics_dir"]
+    saving = asyncio.create_task(metrics.save_snapshots(metrics_dir))
+    yield
+    saving.cancel()
+    # Keep this worker's counts in the totals after it exits
+    metrics.write_snapshot(metrics_dir, metrics.snapshot())
+
+
+async def catalog_ctx(app):
+    catalog = app["catalog"]
+    filling = None
+    if app["settings"].get("fill_catalog"):
+        filling = asyncio.create_task(fill_catalog(catalog.path, app["storage"].layout))
+    yield
+    if filling is not None:
+        await cancel_and_wait(filling)
+    catalog.close()
+
+
+async def filename_index_ctx(app):
+    index = app["filename_index"]
+    # Listed from storage even with a catalog, which only knows the files
+    # uploaded through this host
+    load_names = app["storage"].names
+    await index.refresh(load_names)
+    maintenance = None
+    if app["settings"].get("index_refresh_interval"):
+        maintenance = asyncio.create_task(
+            index.maintain(load_names, app["settings"]["index_refresh_interval"])
+        )
+    yield
+    if maintenance:
+        maintenance.cancel()
+
+
+def create_app(settings):
+    app = web.Application(middlewares=[metrics.metrics_middleware])
     app["settings"] = settings
+    if settings.get("metrics_dir"):
+        app.cleanup_ctx.append(metrics_ctx)
+    if settings.get("cache_size"):
+        app["tails_cache"] = TailsCache(
+            settings["cache_size"],
+            settings.get("cache_max_file_size") or DEFAULT_CACHE_MAX_FILE_SIZE,
+        )
+    if settings.get("ledger_pool_cache_size") and not settings.get("fake_ledger"):
+        app["ledger_pools"] = PoolCache(
+            settings["ledger_pool_cache_size"],
+            settings["ledger_pool_idle_timeout"],
+            settings["ledger_pool_refresh_interval"],
+        )
+        app.cleanup_ctx.append(ledger_pools_ctx)
+    if settings.get("rev_reg_def_cache_size"):
+        app["rev_reg_defs"] = RevRegDefCache(
+            settings["rev_reg_def_cache_size"],
+            settings["rev_reg_def_negative_ttl"],
+        )
+    app["ledger"] = create_resolver(settings, app.get("ledger_pools"))
+
+    if settings.get("catalog"):
+        app["catalog"] = Catalog(settings["catalog"])
+        app.cleanup_ctx.append(catalog_ctx)
+
+    app["storage"] = create_storage(settings)
+    app["uploads"] = UploadsInProgress()
+    app.cleanup_ctx.append(storage_ctx)
+
+    if settings.get("upstream"):
+        app["mirror"] = Mirror(
+            settings["upstream"],
+            app["storage"],
+            partial(record_upload, app),
+            settings.get("max_upload_size"),
+        )
+        app.cleanup_ctx.append(mirror_ctx)
+
+    if settings.get("peers"):
+        app["replicator"] = Replicator(
+            settings["peers"],
+            app["storage"],
+            partial(record_upload, app),
+            settings.get("max_upload_size"),
+        )
+        app.cleanup_ctx.append(replication_ctx)
+
+    app["filename_index"] = FilenameIndex()
+    app.cleanup_ctx.append(filename_index_ctx)
 
     # Add routes
     app.add_routes(routes)
+    return app
+
+
+class SampledAccessLogger(AccessLogger):
+    """Writes a sample of successful requests, and every failed one, to the log."""
+
+    sample_rate = 1.0
+
+    def log(self, request, response, elapsed):
+        if response.status < 400 and random.random() >= self.sample_rate:
+            return
+        super().log(request, response, elapsed)
+
+
+def access_log_options(settings):
+    """Return the options of `web.run_app` setting up the access log."""
+    sample_rate = settings.get("access_log_sample_rate")
+    if sample_rate is None or sample_rate >= 1:
+        return {}
+    return {
+        "access_log_class": type(
+            "SampledAccessLogger",
+            (SampledAccessLogger,),
+            {"sample_rate": sample_rate},
+        )
+    }
+
+
+def serve(settings, sock):
+    """Run the server on an already bound socket, as one of several workers."""
+    web.run_app(
+        create_app(settings),
+        sock=sock,
+        shutdown_timeout=SHUTDOWN_TIMEOUT,
+        print=None,
+        **access_log_options(settings),
+    )
+
+
+def start(settings):
+    if (settings.get("workers") or 1) > 1:
+        # Workers share their metrics through snapshots in this directory
+        settings["metrics_dir"] = mkdtemp(prefix="tails-server-metrics-")
+        try:
+            run_workers(settings, serve)
+        finally:
+            shutil.rmtree(settings["metrics_dir"], ignore_errors=True)
+        return
+
     web.run_app(
-        app,
+        create_app(settings),
         host=settings.get("host") or DEFAULT_WEB_HOST,
         port=settings.get("port") or DEFAULT_WEB_PORT,
+        shutdown_timeout=SHUTDOWN_TIMEOUT,
+        **access_log_options(settings),
     )
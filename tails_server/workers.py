@@ -0,0 +1,94 @@
+"""Multi-process worker mode sharing one listening socket."""
+
+import logging
+import multiprocessing
+import signal
+import socket
+import time
+from multiprocessing.connection import wait
+
+from .config.defaults import (
+    DEFAULT_WEB_HOST,
+    DEFAULT_WEB_PORT,
+    SHUTDOWN_TIMEOUT,
+    WORKER_KILL_GRACE,
+    WORKER_RESTART_DELAY,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+
+def _serve(serve, settings, sock):
+    # Let the server install its own graceful shutdown handlers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+        serve(settings, sock)
+    finally:
+        # Worker processes exit without running atexit handlers, so flush
+        # queued log records here
+        logging.shutdown()
+
+
+def run_workers(settings, serve):
+    """Run `settings["workers"]` copies of `serve(settings, sock)` and supervise them.
+
+    The listening socket is bound once here and inherited by every worker, so
+    the kernel spreads incoming connections across them and the port stays
+    open while a crashed worker is restarted. SIGTERM or SIGINT stops all
+    workers gracefully, killing any that outlive the shutdown timeout.
+    """
+    sock = socket.create_server(
+        (
+            settings.get("host") or DEFAULT_WEB_HOST,
+            settings.get("port") or DEFAULT_WEB_PORT,
+        )
+    )
+    host, port = sock.getsockname()[:2]
+    ctx = multiprocessing.get_context("fork")
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def spawn():
+        worker = ctx.Process(target=_serve, args=(serve, settings, sock), daemon=False)
+        worker.start()
+        LOGGER.info(f"Started worker {worker.pid}")
+        return worker, time.monotonic()
+
+    workers = [spawn() for _ in range(settings["workers"])]
+    LOGGER.info(f"Serving on http://{host}:{port} with {len(workers)} workers")
+
+    while not stopping:
+        wait([worker.sentinel for worker, _ in workers], timeout=1)
+        for i, (worker, started) in enumerate(workers):
+            if worker.is_alive() or stopping:
+                continue
+            LOGGER.warning(
+                f"Worker {worker.pid} exited with code {worker.exitcode}, restarting"
+            )
+            # Avoid spinning on a worker that crashes at startup
+            if time.monotonic() - started < WORKER_RESTART_DELAY:
+                time.sleep(WORKER_RESTART_DELAY)
+            workers[i] = spawn()
+
+    LOGGER.info("Stopping workers")
+    for worker, _ in workers:
+        if worker.is_alive():
+            worker.terminate()
+
+    # Workers drain open connections for up to SHUTDOWN_TIMEOUT themselves
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT + WORKER_KILL_GRACE
+    for worker, _ in workers:
+        worker.join(max(deadline - time.monotonic(), 0))
+        if worker.is_alive():
+            LOGGER.warning(f"Worker {worker.pid} did not stop in time, killing it")
+            worker.kill()
+            worker.join()
+
+    sock.close()
@@ -0,0 +1,621 @@
+"""Benchmarks the upload, download and match paths of the tails server.
+
+The server runs in this process on a loopback port, looking up revocation
+registries on a fake ledger, so no von-network is needed. Each combination of
+file size and store size gets a fresh store, against which every scenario is
+run at each level of concurrency. CPU time and RSS are those of the whole
+process, load generator included.
+
+Results can be saved as a JSON baseline and later runs compared against it:
+
+    python test/benchmark.py --output baseline.json
+    python test/benchmark.py --compare baseline.json
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+
+import aiohttp
+import base58
+from aiohttp import web
+from rich import print as rprint
+from rich.table import Table
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tails_server import web as tails_web  # noqa: E402
+from tails_server.catalog import Catalog  # noqa: E402
+from tails_server.config.defaults import TAIL_SIZE, TAILS_VERSION_TAG  # noqa: E402
+from tails_server.fakeledger import FakeLedger  # noqa: E402
+from tails_server.layout import StorageLayout  # noqa: E402
+from tails_server.upload import publish_alias  # noqa: E402
+
+SCENARIOS = ["download-id", "download-hash", "upload-id", "upload-hash", "match"]
+
+# Files of the requested size served by the download scenarios; the rest of
+# the store is filled with files of the smallest size
+DOWNLOAD_TARGETS = 32
+
+# Registries per issuer DID, so a match by DID finds a handful of files
+REGISTRIES_PER_ISSUER = 10
+
+# Sent as the genesis transactions of uploads by id; the fake ledger ignores it
+GENESIS = b'{"reqSignature": {}, "txn": {}}\n'
+
+BASELINE_VERSION = 1
+
+
+def parse_size(text):
+    """Parse a size such as `4096`, `64K` or `1M` into bytes."""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    unit = units.get(text[-1:].upper())
+    if unit:
+        return int(float(text[:-1]) * unit)
+    return int(text)
+
+
+def format_size(size):
+    """Format a size in bytes the way `parse_size` reads it."""
+    for suffix, unit in (("G", 1024**3), ("M", 1024**2), ("K", 1024)):
+        if size >= unit:
+            return f"{size / unit:g}{suffix}"
+    return str(size)
+
+
+def max_cred_num(size):
+    """Return the registry size whose tails file is nearest to `size` bytes."""
+    tails = (size - len(TAILS_VERSION_TAG)) // TAIL_SIZE
+    return max(1, (tails - 1) // 2)
+
+
+class TailsFile:
+    """A tails file made of one tail unique to `seed` and zeroed tails after it.
+
+    Only the unique tail is kept in memory until the body is needed.
+    """
+
+    _padding = {}
+
+    def __init__(self, seed, max_cred_num):
+        """Initialize the file and compute its tailsHash."""
+        self.max_cred_num = max_cred_num
+        self.head = TAILS_VERSION_TAG + hashlib.sha512(seed).digest() * 2
+        sha256 = hashlib.sha256(self.head)
+        sha256.update(self._pad())
+        self.tails_hash = base58.b58encode(sha256.digest()).decode("utf-8")
+
+    def _pad(self):
+        count = 2 * self.max_cred_num
+        padding = self._padding.get(count)
+        if padding is None:
+            padding = self._padding[count] = bytes(count * TAIL_SIZE)
+        return padding
+
+    @property
+    def body(self):
+        return self.head + self._pad()
+
+    @property
+    def size(self):
+        return len(self.head) + 2 * self.max_cred_num * TAIL_SIZE
+
+
+def issuer_did(n):
+    return base58.b58encode(hashlib.sha256(b"issuer %d" % n).digest()[:16]).decode()
+
+
+def rev_reg_id(n):
+    did = issuer_did(n // REGISTRIES_PER_ISSUER)
+    return f"{did}:4:{did}:3:CL:{n}:default:CL_ACCUM:{n}"
+
+
+def rev_reg_def(revocation_reg_id, tails_file):
+    """Return a revocation registry definition as the ledger would."""
+    return {
+        "id": revocation_reg_id,
+        "revocDefType": "CL_ACCUM",
+        "tag": revocation_reg_id.rsplit(":", 1)[-1],
+        "credDefId": revocation_reg_id.split(":4:", 1)[1].rsplit(":CL_ACCUM:", 1)[0],
+        "value": {
+            "issuanceType": "ISSUANCE_BY_DEFAULT",
+            "maxCredNum": tails_file.max_cred_num,
+            "tailsHash": tails_file.tails_hash,
+            "tailsLocation": f"http://localhost/{revocation_reg_id}",
+        },
+        "ver": "1.0",
+    }
+
+
+class Store:
+    """The files stored before a run, and those prepared for its uploads."""
+
+    def __init__(self, file_size, store_size):
+        """Initialize the store."""
+        self.file_size = file_size
+        self.store_size = store_size
+        self.targets = []
+        self.uploads = 0
+
+    def populate(self, layout, ledger):
+        """Write `store_size` registries, each stored by hash and by id."""
+        large = max_cred_num(self.file_size)
+        for n in range(self.store_size):
+            size = large if n < DOWNLOAD_TARGETS else 1
+            tails_file = TailsFile(b"stored %d" % n, size)
+            revocation_reg_id = rev_reg_id(n)
+            with open(layout.prepare(tails_file.tails_hash), "xb") as f:
+                f.write(tails_file.body)
+            publish_alias(layout, tails_file.tails_hash, revocation_reg_id)
+            ledger.add(rev_reg_def(revocation_reg_id, tails_file))
+            if n < DOWNLOAD_TARGETS:
+                self.targets.append((revocation_reg_id, tails_file.tails_hash))
+
+    def new_uploads(self, count, ledger):
+        """Return `count` registries not stored yet, known to the ledger."""
+        registries = []
+        for _ in range(count):
+            n = self.store_size + self.uploads
+            self.uploads += 1
+            tails_file = TailsFile(b"uploaded %d" % n, max_cred_num(self.file_size))
+            revocation_reg_id = rev_reg_id(n)
+            ledger.add(rev_reg_def(revocation_reg_id, tails_file))
+            registries.append((revocation_reg_id, tails_file))
+        return registries
+
+
+async def download_id(session, url, store, i):
+    revocation_reg_id, _ = store.targets[i % len(store.targets)]
+    async with session.get(f"{url}/{revocation_reg_id}") as resp:
+        return resp.status == 200, len(await resp.read())
+
+
+async def download_hash(session, url, store, i):
+    _, tails_hash = store.targets[i % len(store.targets)]
+    async with session.get(f"{url}/hash/{tails_hash}") as resp:
+        return resp.status == 200, len(await resp.read())
+
+
+async def upload_id(session, url, registry):
+    revocation_reg_id, tails_file = registry
+    data = aiohttp.FormData()
+    data.add_field("genesis", GENESIS, filename="genesis")
+    data.add_field("tails", tails_file.body, filename="tails")
+    async with session.put(f"{url}/{revocation_reg_id}", data=data) as resp:
+        await resp.read()
+        return resp.status == 200, tails_file.size
+
+
+async def upload_hash(session, url, registry):
+    _, tails_file = registry
+    with aiohttp.MultipartWriter("mixed") as mpwriter:
+        mpwriter.append(tails_file.body)
+    async with session.put(
+        f"{url}/hash/{tails_file.tails_hash}", data=mpwriter
+    ) as resp:
+        await resp.read()
+        return resp.status == 200, tails_file.size
+
+
+async def match(session, url, store, i):
+    did = issuer_did(i % max(1, store.store_size // REGISTRIES_PER_ISSUER))
+    async with session.get(f"{url}/match/{did}") as resp:
+        return resp.status == 200, len(await resp.read())
+
+
+def request_maker(scenario, store, ledger, count):
+    """Return `send(session, url, i)` issuing the `i`th request of `scenario`."""
+    if scenario in ("upload-id", "upload-hash"):
+        # Every upload is of a new file, hashed before the clock starts
+        registries = store.new_uploads(count, ledger)
+        upload = upload_id if scenario == "upload-id" else upload_hash
+        return lambda session, url, i: upload(session, url, registries[i])
+    request = {
+        "download-id": download_id,
+        "download-hash": download_hash,
+        "match": match,
+    }[scenario]
+    return lambda session, url, i: request(session, url, store, i)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def rss():
+    """Return the resident set size of this process, in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return max_rss()
+
+
+def max_rss():
+    """Return the peak resident set size of this process, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+async def drive(session, url, send, concurrency, count, first=0):
+    """Issue `count` requests from `concurrency` clients, timing each one."""
+    latencies = []
+    errors = 0
+    transferred = 0
+    next_request = first
+
+    async def client():
+        nonlocal errors, transferred, next_request
+        while next_request < first + count:
+            i = next_request
+            next_request += 1
+            start = time.perf_counter()
+            try:
+                ok, size = await send(session, url, i)
+            except aiohttp.ClientError:
+                ok, size = False, 0
+            latencies.append(time.perf_counter() - start)
+            transferred += size
+            errors += not ok
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, errors, transferred
+
+
+async def run_scenario(session, url, store, ledger, scenario, concurrency, args):
+    send = request_maker(scenario, store, ledger, args.warmup + args.requests)
+    await drive(session, url, send, concurrency, args.warmup)
+
+    cpu_before = cpu_time()
+    start = time.perf_counter()
+    latencies, errors, transferred = await drive(
+        session, url, send, concurrency, args.requests, first=args.warmup
+    )
+    elapsed = time.perf_counter() - start
+    cpu = cpu_time() - cpu_before
+
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "file_size": store.file_size,
+        "store_size": store.store_size,
+        "concurrency": concurrency,
+        "requests": args.requests,
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput": args.requests / elapsed,
+        "bytes_per_second": transferred / elapsed,
+        "p50": percentile(latencies, 0.50),
+        "p99": percentile(latencies, 0.99),
+        "cpu_seconds": cpu,
+        "cpu_utilization": cpu / elapsed,
+        "rss": rss(),
+        "max_rss": max_rss(),
+    }
+
+
+def server_settings(args, storage_path):
+    return {
+        "storage_path": storage_path,
+        "storage_layout": args.storage_layout,
+        "cache_size": args.cache_size,
+        "catalog": os.path.join(storage_path, ".catalog.db") if args.catalog else None,
+        "index_refresh_interval": None,
+    }
+
+
+async def run_store(args, ledger, file_size, store_size):
+    """Benchmark every scenario against a fresh store."""
+    results = []
+    with TemporaryDirectory(prefix="tails-benchmark-") as storage_path:
+        settings = server_settings(args, storage_path)
+        layout = StorageLayout(storage_path, args.storage_layout == "sharded")
+        store = Store(file_size, store_size)
+        store.populate(layout, ledger)
+        if settings["catalog"]:
+            catalog = Catalog(settings["catalog"])
+            catalog.rebuild(layout)
+            catalog.close()
+
+        app = tails_web.create_app(settings)
+        app["ledger"] = ledger
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        url = f"http://127.0.0.1:{port}"
+
+        connector = aiohttp.TCPConnector(limit=max(args.concurrency))
+        try:
+            async with aiohttp.ClientSession(connector=connector) as session:
+                for scenario in args.scenarios:
+                    for concurrency in args.concurrency:
+                        result = await run_scenario(
+                            session, url, store, ledger, scenario, concurrency, args
+                        )
+                        rprint(
+                            f"[bright_green]{scenario} file={format_size(file_size)} "
+                            f"store={store_size} c={concurrency}: "
+                            f"{result['throughput']:.1f} req/s, "
+                            f"p99 {result['p99'] * 1000:.1f} ms"
+                        )
+                        results.append(result)
+        finally:
+            await runner.cleanup()
+    return results
+
+
+async def run_benchmarks(args):
+    ledger = FakeLedger(
+        latency=args.ledger_latency / 1000,
+        error_rate=args.ledger_error_rate,
+        timeout_rate=args.ledger_timeout_rate,
+        timeout=args.ledger_timeout / 1000,
+        seed=args.ledger_seed,
+    )
+
+    results = []
+    for file_size in args.file_sizes:
+        for store_size in args.store_sizes:
+            results += await run_store(args, ledger, file_size, store_size)
+    return results
+
+
+def result_key(result):
+    return (
+        result["scenario"],
+        result["file_size"],
+        result["store_size"],
+        result["concurrency"],
+    )
+
+
+def print_results(results):
+    table = Table(title="Benchmark results")
+    for column in ("scenario", "file", "store", "conc", "req/s", "MB/s"):
+        table.add_column(column, justify="right")
+    for column in ("p50 ms", "p99 ms", "errors", "CPU %", "RSS MB"):
+        table.add_column(column, justify="right")
+    for r in results:
+        table.add_row(
+            r["scenario"],
+            format_size(r["file_size"]),
+            str(r["store_size"]),
+            str(r["concurrency"]),
+            f"{r['throughput']:.1f}",
+            f"{r['bytes_per_second'] / 1024**2:.1f}",
+            f"{r['p50'] * 1000:.2f}",
+            f"{r['p99'] * 1000:.2f}",
+            str(r["errors"]),
+            f"{r['cpu_utilization'] * 100:.0f}",
+            f"{r['rss'] / 1024**2:.0f}",
+        )
+    rprint(table)
+
+
+def compare(results, baseline, tolerance):
+    """Print how `results` differ from `baseline`; return the regressions.
+
+    A result regresses if its throughput fell, or its p99 latency rose, by more
+    than `tolerance`.
+    """
+    previous = {result_key(r): r for r in baseline["results"]}
+    table = Table(title="Compared with baseline")
+    for column in ("scenario", "file", "store", "conc", "req/s", "p99"):
+        table.add_column(column, justify="right")
+    regressions = []
+    for r in results:
+        old = previous.get(result_key(r))
+        if old is None:
+            continue
+        throughput = r["throughput"] / old["throughput"] - 1
+        p99 = r["p99"] / old["p99"] - 1 if old["p99"] else 0
+        regressed = throughput < -tolerance or p99 > tolerance
+        if regressed:
+            regressions.append(r)
+        style = "bright_red" if regressed else None
+        table.add_row(
+            r["scenario"],
+            format_size(r["file_size"]),
+            str(r["store_size"]),
+            str(r["concurrency"]),
+            f"{throughput:+.1%}",
+            f"{p99:+.1%}",
+            style=style,
+        )
+    rprint(table)
+    return regressions
+
+
+def save_baseline(path, args, results):
+    baseline = {
+        "version": BASELINE_VERSION,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": {
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "storage_layout": args.storage_layout,
+            "cache_size": args.cache_size,
+            "catalog": args.catalog,
+            "ledger_latency": args.ledger_latency,
+            "ledger_error_rate": args.ledger_error_rate,
+            "ledger_timeout_rate": args.ledger_timeout_rate,
+            "ledger_timeout": args.ledger_timeout,
+            "ledger_seed": args.ledger_seed,
+        },
+        "results": results,
+    }
+    with open(path, "w") as baseline_file:
+        json.dump(baseline, baseline_file, indent=2)
+        baseline_file.write("\n")
+
+
+PARSER = argparse.ArgumentParser(description="Runs benchmarks.")
+PARSER.add_argument(
+    "--scenario",
+    type=str,
+    nargs="+",
+    choices=SCENARIOS,
+    default=SCENARIOS,
+    dest="scenarios",
+    help="Specify the scenarios to run. Default: all.",
+)
+PARSER.add_argument(
+    "--concurrency",
+    type=int,
+    nargs="+",
+    default=[1, 16],
+    dest="concurrency",
+    metavar="<concurrency>",
+    help="Specify the numbers of concurrent clients. Default: 1 16.",
+)
+PARSER.add_argument(
+    "--requests",
+    type=int,
+    default=200,
+    dest="requests",
+    metavar="<requests>",
+    help="Specify the number of timed requests per run. Default: 200.",
+)
+PARSER.add_argument(
+    "--warmup",
+    type=int,
+    default=20,
+    dest="warmup",
+    metavar="<requests>",
+    help="Specify the number of untimed requests before each run. Default: 20.",
+)
+PARSER.add_argument(
+    "--file-size",
+    type=parse_size,
+    nargs="+",
+    default=[parse_size("64K"), parse_size("1M")],
+    dest="file_sizes",
+    metavar="<size>",
+    help="Specify the sizes of tails files, e.g. 64K or 1M. Default: 64K 1M.",
+)
+PARSER.add_argument(
+    "--store-size",
+    type=int,
+    nargs="+",
+    default=[100, 10000],
+    dest="store_sizes",
+    metavar="<registries>",
+    help="Specify the numbers of registries stored. Default: 100 10000.",
+)
+PARSER.add_argument(
+    "--storage-layout",
+    type=str,
+    choices=["flat", "sharded"],
+    default="flat",
+    dest="storage_layout",
+    help="Specify the storage layout of the server. Default: flat.",
+)
+PARSER.add_argument(
+    "--cache-size",
+    type=parse_size,
+    default=0,
+    dest="cache_size",
+    metavar="<size>",
+    help="Specify the size of the server's tails file cache. Default: none.",
+)
+PARSER.add_argument(
+    "--catalog",
+    action="store_true",
+    dest="catalog",
+    help="Run the server with a catalog.",
+)
+PARSER.add_argument(
+    "--ledger-latency",
+    type=float,
+    default=0,
+    dest="ledger_latency",
+    metavar="<milliseconds>",
+    help="Specify how long the fake ledger takes to respond. Default: 0.",
+)
+PARSER.add_argument(
+    "--ledger-error-rate",
+    type=float,
+    default=0,
+    dest="ledger_error_rate",
+    metavar="<fraction>",
+    help="Specify the fraction of ledger lookups that fail. Default: 0.",
+)
+PARSER.add_argument(
+    "--ledger-timeout-rate",
+    type=float,
+    default=0,
+    dest="ledger_timeout_rate",
+    metavar="<fraction>",
+    help="Specify the fraction of ledger lookups that time out. Default: 0.",
+)
+PARSER.add_argument(
+    "--ledger-timeout",
+    type=float,
+    default=1000,
+    dest="ledger_timeout",
+    metavar="<milliseconds>",
+    help="Specify how long a ledger lookup takes to time out. Default: 1000.",
+)
+PARSER.add_argument(
+    "--ledger-seed",
+    type=int,
+    default=0,
+    dest="ledger_seed",
+    metavar="<seed>",
+    help="Seed choosing which ledger lookups fail. Default: 0.",
+)
+PARSER.add_argument(
+    "--output",
+    type=str,
+    dest="output",
+    metavar="<path>",
+    help="Save the results as a JSON baseline.",
+)
+PARSER.add_argument(
+    "--compare",
+    type=str,
+    dest="compare",
+    metavar="<path>",
+    help="Compare the results with a saved baseline.",
+)
+PARSER.add_argument(
+    "--tolerance",
+    type=float,
+    default=10,
+    dest="tolerance",
+    metavar="<percent>",
+    help="Specify the change counted as a regression. Default: 10.",
+)
+
+if __name__ == "__main__":
+    args = PARSER.parse_args()
+    results = asyncio.run(run_benchmarks(args))
+    print_results(results)
+    if args.output:
+        save_baseline(args.output, args, results)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.tolerance / 100):
+            sys.exit(1)
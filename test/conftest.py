@@ -0,0 +1,39 @@
+import hashlib
+import os
+import sys
+
+import base58
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tails_server import download, metrics  # noqa: E402
+from tails_server.config.defaults import TAIL_SIZE, TAILS_VERSION_TAG  # noqa: E402
+
+
+def tails_hash_of(data):
+    """Return the base58 SHA-256 digest of `data`, as in a tailsHash."""
+    return base58.b58encode(hashlib.sha256(data).digest()).decode("utf-8")
+
+
+def make_tails(max_cred_num, seed=b""):
+    """Return a tails file for a registry of `max_cred_num` credentials, and its hash.
+
+    The tails are not points on a curve, but the server never looks inside them.
+    """
+    tails = b"".join(
+        hashlib.sha512(seed + i.to_bytes(4, "big")).digest() * (TAIL_SIZE // 64)
+        for i in range(2 * max_cred_num + 1)
+    )
+    data = TAILS_VERSION_TAG + tails
+    return data, tails_hash_of(data)
+
+
+@pytest.fixture(autouse=True)
+def reset_process_state():
+    """Forget the metrics and remembered hashes of earlier tests."""
+    yield
+    for metric in vars(metrics).values():
+        if isinstance(metric, metrics.Metric):
+            metric.values.clear()
+    download._tails_hashes.clear()
@@ -0,0 +1,170 @@
+"""An in-process stand-in for an S3-compatible object store, for tests.
+
+Only the operations the S3 storage backend uses are implemented, with path
+style addressing: ListObjectsV2, Head/Get/Put/Delete/CopyObject with
+conditional puts and ranged gets, and multipart uploads.
+"""
+
+import time
+import uuid
+from email.utils import formatdate
+
+from aiohttp import web
+
+_XMLNS = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+# Keys listed per page, small so tests exercise continuation tokens
+LIST_PAGE_SIZE = 2
+
+
+class FakeObject:
+    def __init__(self, data, metadata):
+        self.data = data
+        self.metadata = metadata
+        self.mtime = time.time()
+
+
+class FakeS3:
+    """A single bucket of objects, served by `app()`.
+
+    `objects` maps keys to `FakeObject`s and `uploads` holds the parts of
+    multipart uploads in progress. Every request to an object is recorded in
+    `requests` as a (method, key, query) tuple.
+    """
+
+    def __init__(self, bucket):
+        """Initialize an empty bucket."""
+        self.bucket = bucket
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+
+    def app(self):
+        """Create the application serving the bucket."""
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_route("GET", f"/{self.bucket}", self.list_objects)
+        app.router.add_route("*", f"/{self.bucket}/{{key:.+}}", self.handle)
+        return app
+
+    @staticmethod
+    def check_signed(request):
+        authorization = request.headers.get("Authorization", "")
+        if not authorization.startswith("AWS4-HMAC-SHA256 Credential="):
+            raise web.HTTPForbidden(text="<Error><Code>AccessDenied</Code></Error>")
+
+    async def list_objects(self, request):
+        self.check_signed(request)
+        if request.query.get("list-type") != "2":
+            raise web.HTTPBadRequest()
+        prefix = request.query.get("prefix", "")
+        keys = sorted(key for key in self.objects if key.startswith(prefix))
+        start = int(request.query.get("continuation-token", 0))
+        end = start + LIST_PAGE_SIZE
+
+        body = [f'<ListBucketResult xmlns="{_XMLNS}">']
+        body += [f"<Contents><Key>{key}</Key></Contents>" for key in keys[start:end]]
+        if end < len(keys):
+            body.append("<IsTruncated>true</IsTruncated>")
+            body.append(f"<NextContinuationToken>{end}</NextContinuationToken>")
+        else:
+            body.append("<IsTruncated>false</IsTruncated>")
+        body.append("</ListBucketResult>")
+        return web.Response(text="".join(body), content_type="application/xml")
+
+    async def handle(self, request):
+        self.check_signed(request)
+        key = request.match_info["key"]
+        query = request.query
+        self.requests.append((request.method, key, dict(query)))
+
+        if request.method == "POST" and "uploads" in query:
+            return self.create_multipart_upload()
+        if request.method == "PUT" and "partNumber" in query:
+            return await self.upload_part(request)
+        if request.method == "POST" and "uploadId" in query:
+            return self.complete_multipart_upload(key, query["uploadId"])
+        if request.method == "DELETE" and "uploadId" in query:
+            del self.uploads[query["uploadId"]]
+            return web.Response(status=204)
+        if request.method == "PUT":
+            return await self.put_object(request, key)
+
+        obj = self.objects.get(key)
+        if obj is None:
+            raise web.HTTPNotFound()
+        if request.method == "DELETE":
+            del self.objects[key]
+            return web.Response(status=204)
+        if request.method == "HEAD":
+            return web.Response(headers=self.headers(obj, len(obj.data)))
+        if request.method == "GET":
+            return self.get_object(request, obj)
+        raise web.HTTPMethodNotAllowed(request.method, ["GET", "HEAD", "PUT"])
+
+    @staticmethod
+    def headers(obj, length):
+        return {
+            "Content-Length": str(length),
+            "Last-Modified": formatdate(obj.mtime, usegmt=True),
+            **obj.metadata,
+        }
+
+    def create_multipart_upload(self):
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {}
+        return web.Response(
+            text=(
+                f'<InitiateMultipartUploadResult xmlns="{_XMLNS}">'
+                f"<UploadId>{upload_id}</UploadId>"
+                "</InitiateMultipartUploadResult>"
+            ),
+            content_type="application/xml",
+        )
+
+    async def upload_part(self, request):
+        parts = self.uploads[request.query["uploadId"]]
+        part_number = int(request.query["partNumber"])
+        parts[part_number] = await request.read()
+        return web.Response(headers={"ETag": f'"{part_number}"'})
+
+    def complete_multipart_upload(self, key, upload_id):
+        parts = self.uploads.pop(upload_id)
+        data = b"".join(parts[number] for number in sorted(parts))
+        self.objects[key] = FakeObject(data, {})
+        return web.Response(
+            text=f'<CompleteMultipartUploadResult xmlns="{_XMLNS}"/>',
+            content_type="application/xml",
+        )
+
+    async def put_object(self, request, key):
+        if request.headers.get("If-None-Match") == "*" and key in self.objects:
+            raise web.HTTPPreconditionFailed()
+        metadata = {
+            name: value
+            for name, value in request.headers.items()
+            if name.lower().startswith("x-amz-meta-")
+        }
+        source = request.headers.get("x-amz-copy-source")
+        if source:
+            data = self.objects[source.split("/", 2)[2]].data
+        else:
+            data = await request.read()
+        self.objects[key] = FakeObject(data, metadata)
+        return web.Response()
+
+    def get_object(self, request, obj):
+        data = obj.data
+        byte_range = request.headers.get("Range")
+        if not byte_range:
+            return web.Response(body=data, headers=self.headers(obj, len(data)))
+
+        first, last = byte_range.removeprefix("bytes=").split("-")
+        start = int(first)
+        stop = min(int(last) + 1, len(data)) if last else len(data)
+        if start >= len(data):
+            raise web.HTTPRequestRangeNotSatisfiable()
+        return web.Response(
+            status=206,
+            body=data[start:stop],
+            headers=self.headers(obj, stop - start),
+        )
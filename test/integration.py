@@ -209,6 +209,8 @@ async def run_tests(genesis_url, tails_server_url):
     pool.close()
 
     await test_happy_path(genesis_file.name, tails_server_url, revo_reg_def)
+    await test_get_tails(tails_server_url, revo_reg_def)
+    await test_download_range(tails_server_url, revo_reg_def)
 
     pool = await connect_to_ledger(genesis_file.name)
     log_event("Publishing revocation registry to ledger...")
@@ -287,6 +289,50 @@ async def test_happy_path(genesis_path, tails_server_url, revo_reg_def):
                 assert matches
 
 
+async def test_get_tails(tails_server_url, revo_reg_def):
+    log_event("Testing per-tail download...", panel=True)
+    with open(revo_reg_def["value"]["tailsLocation"], "rb") as tails_file:
+        tails = tails_file.read()
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            f"{tails_server_url}/{revo_reg_def['id']}/tails/1?count=2"
+        ) as resp:
+            assert resp.status == 200
+            assert await resp.read() == tails[2 + 128 : 2 + 3 * 128]
+
+        last = (len(tails) - 2) // 128
+        async with session.get(
+            f"{tails_server_url}/{revo_reg_def['id']}/tails/{last}"
+        ) as resp:
+            assert resp.status == 404
+
+    log_event("Passed")
+
+
+async def test_download_range(tails_server_url, revo_reg_def):
+    log_event("Testing ranged download...", panel=True)
+    with open(revo_reg_def["value"]["tailsLocation"], "rb") as tails_file:
+        tails = tails_file.read()
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(
+            f"{tails_server_url}/{revo_reg_def['id']}",
+            headers={"Range": "bytes=2-129"},
+        ) as resp:
+            assert resp.status == 206
+            assert resp.headers["Content-Range"] == f"bytes 2-129/{len(tails)}"
+            assert await resp.read() == tails[2:130]
+
+        async with session.get(
+            f"{tails_server_url}/{revo_reg_def['id']}",
+            headers={"Range": f"bytes={len(tails)}-"},
+        ) as resp:
+            assert resp.status == 416
+
+    log_event("Passed")
+
+
 async def test_bad_revoc_reg_id_404(genesis_path, tails_server_url, revo_reg_def):
     log_event("Testing bad revocation registry id...", panel=True)
     async with aiohttp.ClientSession() as session:
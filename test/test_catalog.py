@@ -0,0 +1,152 @@
+import asyncio
+import fcntl
+import os
+import threading
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from conftest import make_tails
+
+from tails_server import catalog as catalog_module
+from tails_server.catalog import Catalog, fill_catalog
+from tails_server.config.defaults import CATALOG_FILL_LOCK
+from tails_server.layout import StorageLayout
+from tails_server.web import create_app
+
+REV_REG_ID = "WgWxqztrNooG92RXvxSTWv:4:WgWxqztrNooG92RXvxSTWv:3:CL:20:tag:CL_ACCUM:0"
+
+
+@pytest.fixture
+def storage_path(tmp_path):
+    storage_path = tmp_path / "storage"
+    storage_path.mkdir()
+    return storage_path
+
+
+@pytest.fixture
+def catalog_path(tmp_path):
+    return str(tmp_path / "catalog.sqlite3")
+
+
+@pytest.fixture
+def tails_files(storage_path):
+    data, tails_hash = make_tails(10)
+    (storage_path / tails_hash).write_bytes(data)
+    os.link(storage_path / tails_hash, storage_path / REV_REG_ID)
+    other_data, other_hash = make_tails(10, seed=b"other")
+    (storage_path / other_hash).write_bytes(other_data)
+    return {tails_hash: tails_hash, REV_REG_ID: tails_hash, other_hash: other_hash}
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    # The names of the files the catalog hashes
+    hashed = []
+    hash_tails_file = catalog_module.hash_tails_file
+
+    def counting_hash(tails_file):
+        hashed.append(os.path.basename(tails_file.name))
+        return hash_tails_file(tails_file)
+
+    monkeypatch.setattr(catalog_module, "hash_tails_file", counting_hash)
+    return hashed
+
+
+def catalogued(catalog):
+    return {name: catalog.get(name).tails_hash for name in catalog.names()}
+
+
+def test_rebuild(storage_path, catalog_path, tails_files, hashed):
+    layout = StorageLayout(str(storage_path), sharded=False)
+    catalog = Catalog(catalog_path)
+    assert catalog.created
+    try:
+        catalog.rebuild(layout)
+        assert catalogued(catalog) == tails_files
+        assert sorted(hashed) == sorted(tails_files)
+        entry = catalog.get(REV_REG_ID)
+        assert entry.size == os.path.getsize(storage_path / REV_REG_ID)
+        assert catalog.stored_bytes() == 2 * entry.size
+
+        # Unchanged files are not hashed again; removed ones are forgotten
+        hashed.clear()
+        other_hash = next(name for name in tails_files if name != tails_files[name])
+        data, tails_hash = make_tails(10, seed=b"new")
+        (storage_path / tails_hash).write_bytes(data)
+        os.unlink(storage_path / other_hash)
+        catalog.rebuild(layout)
+        expected = {**tails_files, tails_hash: tails_hash}
+        del expected[other_hash]
+        assert catalogued(catalog) == expected
+        assert hashed == [tails_hash]
+    finally:
+        catalog.close()
+
+    catalog = Catalog(catalog_path)
+    assert not catalog.created
+    catalog.close()
+
+
+def test_rebuild_stopped(storage_path, catalog_path, tails_files):
+    stop = threading.Event()
+    stop.set()
+    catalog = Catalog(catalog_path)
+    try:
+        catalog.put(catalog_module.CatalogEntry("removed", "hash", 1, 0.0))
+        catalog.rebuild(StorageLayout(str(storage_path), sharded=False), stop)
+        # A stopped rebuild keeps what it has and removes nothing
+        assert catalog.names() == {"removed"}
+    finally:
+        catalog.close()
+
+
+async def test_fill_catalog(storage_path, catalog_path, tails_files):
+    layout = StorageLayout(str(storage_path), sharded=False)
+
+    # Another worker is filling the catalog
+    lock = os.open(catalog_path + CATALOG_FILL_LOCK, os.O_RDONLY | os.O_CREAT)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        await fill_catalog(catalog_path, layout)
+    finally:
+        os.close(lock)
+    catalog = Catalog(catalog_path)
+    try:
+        assert catalog.names() == set()
+        await fill_catalog(catalog_path, layout)
+        assert catalogued(catalog) == tails_files
+    finally:
+        catalog.close()
+
+
+async def test_app_fills_catalog(storage_path, catalog_path, tails_files):
+    app = create_app(
+        {
+            "storage_path": str(storage_path),
+            "catalog": catalog_path,
+            "fill_catalog": True,
+        }
+    )
+    async with TestClient(TestServer(app)) as client:
+        # The index is listed from storage, not from the catalog being filled
+        response = await client.get("/match/CL_ACCUM")
+        assert await response.json() == [str(storage_path / REV_REG_ID)]
+
+        catalog = app["catalog"]
+        while len(await catalog.run(catalog.names)) < len(tails_files):
+            await asyncio.sleep(0.01)
+        assert await catalog.run(catalogued, catalog) == tails_files
+
+        response = await client.head(f"/{REV_REG_ID}")
+        assert response.headers["ETag"] == f'"{tails_files[REV_REG_ID]}"'
+
+
+async def test_index_ignores_catalog(storage_path, catalog_path, tails_files):
+    # Files stored through another host are missing from this host's catalog
+    catalog = Catalog(catalog_path)
+    catalog.close()
+    app = create_app({"storage_path": str(storage_path), "catalog": catalog_path})
+    async with TestClient(TestServer(app)) as client:
+        response = await client.get("/match/CL_ACCUM")
+        assert await response.json() == [str(storage_path / REV_REG_ID)]
+        assert await app["catalog"].run(app["catalog"].names) == set()
@@ -0,0 +1,142 @@
+import asyncio
+import os
+
+import aiohttp
+import pytest
+from aiohttp import hdrs, web
+from aiohttp.test_utils import TestClient, TestServer
+from conftest import make_tails
+
+from tails_server import download
+from tails_server.config.defaults import MAX_RANGES
+from tails_server.web import create_app
+
+REV_REG_ID = "WgWxqztrNooG92RXvxSTWv:4:WgWxqztrNooG92RXvxSTWv:3:CL:20:tag:CL_ACCUM:0"
+
+
+@pytest.fixture
+async def client(tmp_path):
+    app = create_app({"storage_path": str(tmp_path)})
+    async with TestClient(TestServer(app)) as client:
+        yield client
+
+
+@pytest.fixture
+def tails_file(tmp_path):
+    data, tails_hash = make_tails(20)
+    (tmp_path / tails_hash).write_bytes(data)
+    os.link(tmp_path / tails_hash, tmp_path / REV_REG_ID)
+    return data, tails_hash
+
+
+async def hashed(file_name):
+    while download._hashing:
+        await asyncio.sleep(0.01)
+    return download._tails_hashes.get(file_name)
+
+
+async def test_unknown_hash_served_at_once(client, tails_file):
+    data, tails_hash = tails_file
+
+    # Nothing depends on the ETag, so the file is served before it is hashed
+    response = await client.get(f"/{REV_REG_ID}")
+    assert response.status == 200
+    assert await response.read() == data
+    assert hdrs.ETAG not in response.headers
+
+    assert await hashed(REV_REG_ID) == tails_hash
+    response = await client.get(f"/{REV_REG_ID}")
+    assert response.headers[hdrs.ETAG] == f'"{tails_hash}"'
+
+
+async def test_unknown_hash_of_conditional_request(client, tails_file):
+    data, tails_hash = tails_file
+
+    response = await client.get(
+        f"/{REV_REG_ID}", headers={hdrs.IF_NONE_MATCH: f'"{tails_hash}"'}
+    )
+    assert response.status == 304
+    assert response.headers[hdrs.ETAG] == f'"{tails_hash}"'
+    assert download._tails_hashes[REV_REG_ID] == tails_hash
+
+
+async def test_unknown_hash_of_if_range(client, tails_file):
+    data, tails_hash = tails_file
+
+    response = await client.get(
+        f"/{REV_REG_ID}",
+        headers={hdrs.RANGE: "bytes=2-129", hdrs.IF_RANGE: f'"{tails_hash}"'},
+    )
+    assert response.status == 206
+    assert await response.read() == data[2:130]
+
+    response = await client.get(
+        f"/{REV_REG_ID}",
+        headers={hdrs.RANGE: "bytes=2-129", hdrs.IF_RANGE: '"stale"'},
+    )
+    assert response.status == 200
+    assert await response.read() == data
+
+
+async def test_missing_file(client):
+    response = await client.get(f"/{REV_REG_ID}")
+    assert response.status == 404
+    assert download._hashing == {}
+
+
+@pytest.mark.parametrize(
+    "header, ranges",
+    [
+        ("bytes=0-99", [(0, 100)]),
+        ("bytes=100-", [(100, 1000)]),
+        ("bytes=-100", [(900, 1000)]),
+        ("bytes=-2000", [(0, 1000)]),
+        ("bytes=900-1999", [(900, 1000)]),
+        ("BYTES = 0-0", [(0, 1)]),
+        # Overlapping and adjacent ranges are coalesced, in order
+        ("bytes=500-599, 0-99, 100-199, 550-650", [(0, 200), (500, 651)]),
+        ("bytes=0-9, 20-29", [(0, 10), (20, 30)]),
+        # Unsatisfiable parts are dropped if another part is satisfiable
+        ("bytes=0-9, 5000-", [(0, 10)]),
+        ("bytes=-0, 0-9", [(0, 10)]),
+    ],
+)
+def test_parse_range(header, ranges):
+    assert download.parse_range(header, 1000) == ranges
+
+
+@pytest.mark.parametrize(
+    "header",
+    ["items=0-9", "bytes", "bytes=", "bytes=-", "bytes=a-9", "bytes=9-0", "bytes=0-9,"],
+)
+def test_parse_range_ignored(header):
+    assert download.parse_range(header, 1000) is None
+
+
+TOO_MANY_RANGES = "bytes=" + ",".join(f"{i}0-{i}0" for i in range(MAX_RANGES + 1))
+
+
+@pytest.mark.parametrize(
+    "header", ["bytes=1000-", "bytes=5000-6000", "bytes=-0", TOO_MANY_RANGES]
+)
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(web.HTTPRequestRangeNotSatisfiable) as e:
+        download.parse_range(header, 1000)
+    assert e.value.headers[hdrs.CONTENT_RANGE] == "bytes */1000"
+
+
+async def test_multiple_ranges(client, tails_file):
+    data, tails_hash = tails_file
+
+    response = await client.get(
+        f"/hash/{tails_hash}", headers={hdrs.RANGE: "bytes=0-1, 130-257"}
+    )
+    assert response.status == 206
+    reader = aiohttp.MultipartReader.from_response(response)
+    parts = []
+    while (part := await reader.next()) is not None:
+        parts.append((part.headers[hdrs.CONTENT_RANGE], await part.read()))
+    assert parts == [
+        (f"bytes 0-1/{len(data)}", data[:2]),
+        (f"bytes 130-257/{len(data)}", data[130:258]),
+    ]
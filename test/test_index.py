@@ -0,0 +1,116 @@
+import random
+import string
+
+import pytest
+
+from tails_server import index as index_module
+from tails_server.index import FilenameIndex
+
+
+def random_names(count, seed=0):
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits
+    return {
+        "".join(rng.choices(alphabet, k=8)) + f":4:{rng.randrange(100)}:CL_ACCUM:0"
+        for _ in range(count)
+    }
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    # Small blocks, so a few hundred names exercise splits and empty blocks
+    monkeypatch.setattr(index_module, "INDEX_BLOCK_SIZE", 4)
+
+
+def check(index, names):
+    names = sorted(names)
+    assert len(index) == len(names)
+    assert list(index.range()) == names
+    for substring in ("a", "B", ":4:1", "CL_ACCUM:0", "0:", "missing"):
+        assert index.match(substring) == [n for n in names if substring in n]
+
+
+def test_add_and_discard():
+    index = FilenameIndex()
+    names = random_names(300)
+    for name in names:
+        index.add(name)
+    index.add(next(iter(names)))
+    check(index, names)
+
+    removed = set(sorted(names)[::3])
+    for name in removed:
+        index.discard(name)
+    index.discard("missing")
+    check(index, names - removed)
+    assert all(name not in index for name in removed)
+
+    for name in names - removed:
+        index.discard(name)
+    check(index, set())
+    index.add("again")
+    check(index, {"again"})
+
+
+def test_match():
+    index = FilenameIndex()
+    for name in ("abcabc", "xabc", "abd", "zzz"):
+        index.add(name)
+    # Each name is reported once, however often it contains the substring
+    assert index.match("abc") == ["abcabc", "xabc"]
+    # A match never spans two names
+    assert index.match("cx") == []
+    assert index.match("\0") == []
+    assert index.match("") == ["abcabc", "abd", "xabc", "zzz"]
+
+
+def test_range():
+    index = FilenameIndex()
+    names = sorted(random_names(200))
+    for name in names:
+        index.add(name)
+
+    prefix = names[50][:2]
+    expected = [n for n in names if n.startswith(prefix)]
+    assert list(index.range(prefix)) == expected
+    assert list(index.range(prefix, after=expected[0])) == expected[1:]
+    # A cursor before the prefix starts at the prefix
+    assert list(index.range(prefix, after="")) == expected
+    assert list(index.range(after=names[-1])) == []
+    assert list(index.range(after=names[99])) == names[100:]
+    assert list(index.range("~")) == []
+
+
+def test_range_is_a_snapshot():
+    index = FilenameIndex()
+    names = sorted(random_names(100))
+    for name in names:
+        index.add(name)
+
+    iterator = index.range()
+    first = next(iterator)
+    for name in names[::2]:
+        index.discard(name)
+    index.add("0")
+    index.add("~")
+    assert [first, *iterator] == names
+
+
+async def test_refresh():
+    index = FilenameIndex()
+    stored = random_names(100)
+
+    async def load_names():
+        # A file published while the names are being loaded is kept
+        index.add("published")
+        return set(stored)
+
+    await index.refresh(load_names)
+    check(index, stored | {"published"})
+
+    # Small changes are applied one name at a time, large ones in bulk
+    for changed in (set(sorted(stored)[:2]), set(sorted(stored)[:50])):
+        stored -= changed
+        stored |= random_names(len(changed), seed=len(changed))
+        await index.refresh(load_names)
+        check(index, stored | {"published"})
@@ -0,0 +1,111 @@
+import os
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from conftest import make_tails
+from test_upload import put_file, rev_reg_def
+
+from tails_server.fakeledger import FakeLedger
+from tails_server.layout import StorageLayout, scan_directory
+from tails_server.upload import publish_alias
+from tails_server.web import create_app
+
+REV_REG_ID = "WgWxqztrNooG92RXvxSTWv:4:WgWxqztrNooG92RXvxSTWv:3:CL:20:tag:CL_ACCUM:0"
+
+
+@pytest.fixture
+def flat_store(tmp_path):
+    # A tails file stored under its hash and, hard-linked, its registry id
+    data, tails_hash = make_tails(10)
+    (tmp_path / tails_hash).write_bytes(data)
+    os.link(tmp_path / tails_hash, tmp_path / REV_REG_ID)
+    (tmp_path / ".catalog.sqlite3").write_bytes(b"")
+    return data, tails_hash
+
+
+def test_flat(tmp_path, flat_store):
+    data, tails_hash = flat_store
+    layout = StorageLayout(str(tmp_path))
+
+    assert layout.path(REV_REG_ID) == str(tmp_path / REV_REG_ID)
+    assert layout.prepare("new") == str(tmp_path / "new")
+    assert layout.names() == {tails_hash, REV_REG_ID}
+    assert layout.locate(REV_REG_ID) == str(tmp_path / REV_REG_ID)
+    assert layout.locate("missing") is None
+    with layout.open(REV_REG_ID) as tails_file:
+        assert tails_file.read() == data
+
+
+def test_sharded_prepare(tmp_path, flat_store):
+    _, tails_hash = flat_store
+    layout = StorageLayout(str(tmp_path), sharded=True)
+
+    path = layout.prepare("new")
+    shard = layout.shard("new")
+    assert path == str(tmp_path / shard / "new")
+    assert os.path.isdir(tmp_path / shard)
+    assert not os.path.exists(path)
+
+    # A file not migrated yet is still stored
+    with pytest.raises(FileExistsError):
+        layout.prepare(REV_REG_ID)
+
+    publish_alias(layout, tails_hash, "alias")
+    assert os.path.samefile(layout.locate("alias"), tmp_path / tails_hash)
+    assert layout.names() == {tails_hash, REV_REG_ID, "alias"}
+
+
+def test_migrate(tmp_path, flat_store):
+    data, tails_hash = flat_store
+    inode = os.stat(tmp_path / tails_hash).st_ino
+    layout = StorageLayout(str(tmp_path), sharded=True)
+
+    # Files are read from the flat location until they are migrated
+    with layout.open(REV_REG_ID) as tails_file:
+        assert tails_file.read() == data
+
+    assert layout.migrate() == 2
+    for name in (tails_hash, REV_REG_ID):
+        path = layout.locate(name)
+        assert path == layout.path(name) == str(tmp_path / layout.shard(name) / name)
+        # Aliases keep sharing their data
+        assert os.stat(path).st_ino == inode
+        with layout.open(name) as tails_file:
+            assert tails_file.read() == data
+    assert layout.names() == {tails_hash, REV_REG_ID}
+    # Only tails files are moved
+    assert scan_directory(str(tmp_path)) == set()
+    assert os.path.isfile(tmp_path / ".catalog.sqlite3")
+
+    assert layout.migrate() == 0
+    with pytest.raises(FileNotFoundError):
+        layout.open("missing")
+
+
+async def test_upload_sharded(tmp_path):
+    data, tails_hash = make_tails(10)
+    ledger = FakeLedger()
+    ledger.add(rev_reg_def(REV_REG_ID, tails_hash, 10))
+    app = create_app({"storage_path": str(tmp_path), "storage_layout": "sharded"})
+    app["ledger"] = ledger
+    async with TestClient(TestServer(app)) as client:
+        response = await put_file(client, REV_REG_ID, data)
+        assert response.status == 200, await response.text()
+
+        layout = app["storage"].layout
+        assert os.path.samefile(layout.path(REV_REG_ID), layout.path(tails_hash))
+        response = await client.get(f"/hash/{tails_hash}")
+        assert await response.read() == data
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+@pytest.mark.parametrize("name", ["../evil", "/tmp/evil", ".staging", "..", ""])
+def test_not_a_file_name(tmp_path, flat_store, sharded, name):
+    layout = StorageLayout(str(tmp_path / "storage"), sharded=sharded)
+    with pytest.raises(ValueError):
+        layout.path(name)
+    with pytest.raises(ValueError):
+        layout.prepare(name)
+    assert layout.locate(name) is None
+    with pytest.raises(FileNotFoundError):
+        layout.open(name)
@@ -0,0 +1,99 @@
+import logging
+import threading
+
+from tails_server.logqueue import BoundedQueueHandler
+
+
+class RecordingHandler(logging.Handler):
+    """Records the messages it emits, once `released` is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.released = threading.Event()
+        self.released.set()
+
+    def emit(self, record):
+        self.released.wait()
+        self.messages.append(record.getMessage())
+
+
+def log(handler, *messages):
+    for message in messages:
+        handler.handle(
+            logging.makeLogRecord({"msg": message, "levelno": logging.WARNING})
+        )
+
+
+def queued(handler):
+    messages = []
+    while not handler.queue.empty():
+        messages.append(handler.queue.get_nowait().getMessage())
+    return messages
+
+
+def test_drop():
+    target = RecordingHandler()
+    handler = BoundedQueueHandler(target, 2)
+
+    # Nothing is emitted until the listener starts, so the queue fills up
+    log(handler, "a", "b", "c", "d", "e")
+    assert handler.dropped == 3
+    assert queued(handler) == ["a", "b"]
+
+    # The next record to fit is followed by a report of the dropped ones
+    log(handler, "f")
+    assert handler.dropped == 0
+    assert queued(handler) == [
+        "f",
+        "Dropped 3 log records because the log queue was full",
+    ]
+
+
+def test_drop_report_dropped():
+    target = RecordingHandler()
+    handler = BoundedQueueHandler(target, 2)
+
+    log(handler, "a", "b", "c")
+    handler.queue.get_nowait()
+    # The report does not fit after the record, so it counts as dropped too
+    log(handler, "d")
+    assert handler.dropped == 2
+    assert queued(handler) == ["b", "d"]
+
+    handler.start()
+    log(handler, "e")
+    handler.close()
+    assert target.messages == [
+        "e",
+        "Dropped 2 log records because the log queue was full",
+    ]
+
+
+def test_block():
+    target = RecordingHandler()
+    target.released.clear()
+    handler = BoundedQueueHandler(target, 1, overflow="block")
+    handler.start()
+
+    logging_thread = threading.Thread(target=log, args=(handler, "a", "b", "c"))
+    logging_thread.start()
+    # The target stalls on the first record, and the queue holds one more
+    logging_thread.join(0.1)
+    assert logging_thread.is_alive()
+
+    target.released.set()
+    logging_thread.join(5)
+    assert not logging_thread.is_alive()
+    handler.close()
+    assert target.messages == ["a", "b", "c"]
+    assert handler.dropped == 0
+
+
+def test_close_emits_queued_records():
+    target = RecordingHandler()
+    handler = BoundedQueueHandler(target, 10)
+    log(handler, "a", "b")
+    handler.start()
+    handler.close()
+    assert target.messages == ["a", "b"]
@@ -0,0 +1,161 @@
+import asyncio
+import os
+
+import pytest
+from aiohttp import hdrs, web
+from aiohttp.test_utils import TestClient, TestServer
+from conftest import make_tails
+
+from tails_server import metrics
+from tails_server.web import create_app
+
+REV_REG_ID = "WgWxqztrNooG92RXvxSTWv:4:WgWxqztrNooG92RXvxSTWv:3:CL:20:tag:CL_ACCUM:0"
+
+
+class Upstream:
+    """An upstream tails server, recording the paths requested from it."""
+
+    def __init__(self, app):
+        self.app = app
+        self.requests = []
+        app.middlewares.append(self.record)
+
+    @web.middleware
+    async def record(self, request, handler):
+        self.requests.append(request.path)
+        return await handler(request)
+
+
+@pytest.fixture
+def upstream_path(tmp_path):
+    upstream_path = tmp_path / "upstream"
+    upstream_path.mkdir()
+    return upstream_path
+
+
+@pytest.fixture
+def tails_file(upstream_path):
+    data, tails_hash = make_tails(20)
+    (upstream_path / tails_hash).write_bytes(data)
+    os.link(upstream_path / tails_hash, upstream_path / REV_REG_ID)
+    return data, tails_hash
+
+
+@pytest.fixture
+async def upstream(upstream_path):
+    upstream = Upstream(create_app({"storage_path": str(upstream_path)}))
+    async with TestServer(upstream.app) as server:
+        upstream.url = str(server.make_url(""))
+        yield upstream
+
+
+@pytest.fixture
+def mirror_path(tmp_path):
+    mirror_path = tmp_path / "mirror"
+    mirror_path.mkdir()
+    return mirror_path
+
+
+async def mirror_client(mirror_path, upstream):
+    app = create_app({"storage_path": str(mirror_path), "upstream": upstream.url})
+    return TestClient(TestServer(app))
+
+
+@pytest.fixture
+async def client(mirror_path, upstream):
+    async with await mirror_client(mirror_path, upstream) as client:
+        yield client
+
+
+def stored(path):
+    return sorted(name for name in os.listdir(path) if not name.startswith("."))
+
+
+async def test_fill(client, upstream, mirror_path, tails_file):
+    data, tails_hash = tails_file
+
+    response = await client.get(f"/{REV_REG_ID}")
+    assert response.status == 200
+    assert await response.read() == data
+    assert response.headers[hdrs.ETAG] == f'"{tails_hash}"'
+    assert stored(mirror_path) == sorted([tails_hash, REV_REG_ID])
+    assert os.path.samefile(mirror_path / tails_hash, mirror_path / REV_REG_ID)
+
+    # Later downloads, by either name, are served locally
+    response = await client.get(f"/hash/{tails_hash}", headers={hdrs.RANGE: "bytes=2-"})
+    assert response.status == 206
+    assert await response.read() == data[2:]
+    assert upstream.requests == [f"/{REV_REG_ID}"]
+
+
+async def test_fill_by_hash(client, upstream, mirror_path, tails_file):
+    data, tails_hash = tails_file
+
+    response = await client.get(f"/hash/{tails_hash}", headers={hdrs.RANGE: "bytes=2-"})
+    assert response.status == 206
+    assert await response.read() == data[2:]
+    assert stored(mirror_path) == [tails_hash]
+
+    # Only the alias is missing, but the upstream server vouches for the hash
+    response = await client.get(f"/{REV_REG_ID}")
+    assert await response.read() == data
+    assert stored(mirror_path) == sorted([tails_hash, REV_REG_ID])
+    assert upstream.requests == [f"/hash/{tails_hash}", f"/{REV_REG_ID}"]
+
+
+async def test_coalesced_misses(client, upstream, mirror_path, tails_file):
+    data, tails_hash = tails_file
+
+    responses = await asyncio.gather(
+        *(client.get(f"/hash/{tails_hash}") for _ in range(5))
+    )
+    assert [await response.read() for response in responses] == [data] * 5
+    assert upstream.requests == [f"/hash/{tails_hash}"]
+
+
+async def test_missing_upstream(client, upstream, mirror_path):
+    response = await client.get(f"/{REV_REG_ID}")
+    assert response.status == 404
+    assert stored(mirror_path) == []
+
+
+@pytest.fixture
+async def bad_upstream(tails_file):
+    # Serves other data than its ETag and the requested hash promise
+    data, tails_hash = tails_file
+    other_data, _ = make_tails(20, seed=b"other")
+
+    async def handler(request):
+        return web.Response(body=other_data, headers={hdrs.ETAG: f'"{tails_hash}"'})
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", handler)
+    upstream = Upstream(app)
+    async with TestServer(app) as server:
+        upstream.url = str(server.make_url(""))
+        yield upstream
+
+
+@pytest.mark.parametrize("path", ["/{rev_reg_id}", "/hash/{tails_hash}"])
+async def test_upstream_mismatch(bad_upstream, mirror_path, tails_file, path):
+    _, tails_hash = tails_file
+    path = path.format(rev_reg_id=REV_REG_ID, tails_hash=tails_hash)
+
+    async with await mirror_client(mirror_path, bad_upstream) as client:
+        response = await client.get(path, headers={hdrs.RANGE: "bytes=0-1"})
+        assert response.status == 502
+    assert metrics.HASH_MISMATCHES.values == {("upstream",): 1}
+    assert stored(mirror_path) == []
+    assert os.listdir(mirror_path / ".staging") == []
+
+
+@pytest.mark.parametrize(
+    "path", ["/..%2Fevil", "/hash/..%2Fevil", "/.staging", "/%2Ftmp%2Fevil"]
+)
+async def test_traversal(bad_upstream, mirror_path, tmp_path, path):
+    async with await mirror_client(mirror_path, bad_upstream) as client:
+        response = await client.get(path)
+        assert response.status == 404
+    assert bad_upstream.requests == []
+    assert stored(mirror_path) == []
+    assert not os.path.exists(tmp_path / "evil")
@@ -0,0 +1,143 @@
+import json
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from tails_server.index import FilenameIndex
+from tails_server.query import parse_rev_reg_id, query_registries
+from tails_server.web import create_app
+
+DID_A = "WgWxqztrNooG92RXvxSTWv"
+DID_B = "4QxzWk3ajdnEA37NdNU5Kt"
+# Not a registry id, but sorted among those of DID_A, which sort after DID_B
+TAILS_HASH = f"{DID_A}9"
+
+
+def rev_reg_id(did, schema_seq_no, cred_def_tag, tag, registry_type="CL_ACCUM"):
+    return f"{did}:4:{did}:3:CL:{schema_seq_no}:{cred_def_tag}:{registry_type}:{tag}"
+
+
+REV_REG_IDS = sorted(
+    [rev_reg_id(DID_A, 20, "default", str(tag)) for tag in range(5)]
+    + [rev_reg_id(DID_A, 21, "default", "0")]
+    + [rev_reg_id(DID_A, 20, "other", "0", registry_type="CL_ACCUM2")]
+    + [rev_reg_id(DID_B, 20, "default", str(tag)) for tag in range(3)]
+)
+
+
+@pytest.fixture
+def index():
+    index = FilenameIndex()
+    for name in REV_REG_IDS + [TAILS_HASH]:
+        index.add(name)
+    return index
+
+
+def query(index, after=None, **filters):
+    return [
+        registry.revocation_reg_id
+        for registry in query_registries(index, filters, after)
+    ]
+
+
+def test_parse_rev_reg_id():
+    parsed = parse_rev_reg_id(rev_reg_id(DID_A, 20, "default", "0"))
+    assert parsed.issuer_did == DID_A
+    assert parsed.cred_def_id == f"{DID_A}:3:CL:20:default"
+    assert parsed.registry_type == "CL_ACCUM"
+    assert parsed.tag == "0"
+    assert parse_rev_reg_id(TAILS_HASH) is None
+    assert parse_rev_reg_id(f"{DID_A}:3:CL:20:default") is None
+
+
+def test_query_registries(index):
+    cred_def_id = f"{DID_A}:3:CL:20:default"
+
+    assert query(index) == REV_REG_IDS
+    assert query(index, issuer_did=DID_B) == [n for n in REV_REG_IDS if DID_B in n]
+    assert query(index, cred_def_id=cred_def_id) == [
+        rev_reg_id(DID_A, 20, "default", str(tag)) for tag in range(5)
+    ]
+    assert query(index, issuer_did=DID_A, cred_def_id=cred_def_id, tag="3") == [
+        rev_reg_id(DID_A, 20, "default", "3")
+    ]
+    assert query(index, registry_type="CL_ACCUM2") == [
+        rev_reg_id(DID_A, 20, "other", "0", registry_type="CL_ACCUM2")
+    ]
+    assert query(index, tag="2") == [
+        rev_reg_id(DID_B, 20, "default", "2"),
+        rev_reg_id(DID_A, 20, "default", "2"),
+    ]
+    assert query(index, issuer_did=DID_B, cred_def_id=cred_def_id) == []
+    assert query(index, issuer_did="unknown") == []
+
+
+def test_query_registries_after(index):
+    cred_def_id = f"{DID_A}:3:CL:20:default"
+    registries = query(index, cred_def_id=cred_def_id)
+
+    assert query(index, after=registries[1], cred_def_id=cred_def_id) == (
+        registries[2:]
+    )
+    assert query(index, after=registries[-1], cred_def_id=cred_def_id) == []
+    # A cursor before the range of the filters starts at the range, and one
+    # after it ends the query
+    assert query(index, after=DID_B, issuer_did=DID_A) == (
+        [n for n in REV_REG_IDS if n.startswith(DID_A)]
+    )
+    assert query(index, after=DID_A, issuer_did=DID_B) == []
+
+
+@pytest.fixture
+async def client(tmp_path):
+    for name in REV_REG_IDS + [TAILS_HASH]:
+        (tmp_path / name).write_bytes(b"")
+    app = create_app({"storage_path": str(tmp_path)})
+    async with TestClient(TestServer(app)) as client:
+        yield client
+
+
+async def get_page(client, **params):
+    response = await client.get("/registries", params=params)
+    assert response.status == 200
+    assert response.content_type == "application/x-ndjson"
+    return [json.loads(line) async for line in response.content if line.strip()]
+
+
+async def test_registries_pages(client):
+    pages = []
+    params = {"limit": "4"}
+    while True:
+        page = await get_page(client, **params)
+        pages.append([record["revocation_reg_id"] for record in page])
+        if len(page) < 4:
+            break
+        params["cursor"] = page[-1]["revocation_reg_id"]
+
+    assert [len(page) for page in pages] == [4, 4, 2]
+    assert sum(pages, []) == REV_REG_IDS
+
+    page = await get_page(client, issuer_did=DID_B, tag="1")
+    assert page == [
+        {
+            "revocation_reg_id": rev_reg_id(DID_B, 20, "default", "1"),
+            "issuer_did": DID_B,
+            "cred_def_id": f"{DID_B}:3:CL:20:default",
+            "registry_type": "CL_ACCUM",
+            "tag": "1",
+        }
+    ]
+
+
+@pytest.mark.parametrize("limit", ["0", "10001", "ten"])
+async def test_registries_bad_limit(client, limit):
+    response = await client.get("/registries", params={"limit": limit})
+    assert response.status == 400
+
+
+async def test_match(client, tmp_path):
+    response = await client.get(f"/match/{DID_B}:3")
+    assert response.status == 200
+    assert await response.json() == [
+        str(tmp_path / name) for name in REV_REG_IDS if DID_B in name
+    ]
@@ -0,0 +1,130 @@
+import asyncio
+import os
+from contextlib import AsyncExitStack
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer, unused_port
+from conftest import make_tails
+from test_upload import put_file, rev_reg_def
+
+from tails_server import replication
+from tails_server.fakeledger import FakeLedger
+from tails_server.web import create_app
+
+REV_REG_ID = "WgWxqztrNooG92RXvxSTWv:4:WgWxqztrNooG92RXvxSTWv:3:CL:20:tag:CL_ACCUM:0"
+
+
+class Nodes:
+    """Tails servers replicating each other, started one at a time."""
+
+    def __init__(self, tmp_path, count, stack):
+        self.ports = [unused_port() for _ in range(count)]
+        self.paths = [tmp_path / f"node{i}" for i in range(count)]
+        self.ledger = FakeLedger()
+        self.clients = {}
+        self._stack = stack
+
+    async def start(self, i):
+        self.paths[i].mkdir(exist_ok=True)
+        app = create_app(
+            {
+                "storage_path": str(self.paths[i]),
+                "peers": [
+                    f"http://127.0.0.1:{port}"
+                    for j, port in enumerate(self.ports)
+                    if j != i
+                ],
+            }
+        )
+        app["ledger"] = self.ledger
+        server = TestServer(app, host="127.0.0.1", port=self.ports[i])
+        self.clients[i] = await self._stack.enter_async_context(TestClient(server))
+        return self.clients[i]
+
+    def stored(self, i):
+        return sorted(n for n in os.listdir(self.paths[i]) if not n.startswith("."))
+
+    async def wait_for(self, i, names):
+        async with asyncio.timeout(5):
+            while self.stored(i) != sorted(names):
+                await asyncio.sleep(0.01)
+
+
+@pytest.fixture
+async def nodes(tmp_path):
+    async with AsyncExitStack() as stack:
+        yield lambda count: Nodes(tmp_path, count, stack)
+
+
+async def test_upload_replicated(nodes):
+    nodes = nodes(3)
+    clients = [await nodes.start(i) for i in range(3)]
+    data, tails_hash = make_tails(10)
+    nodes.ledger.add(rev_reg_def(REV_REG_ID, tails_hash, 10))
+
+    response = await put_file(clients[0], REV_REG_ID, data)
+    assert response.status == 200, await response.text()
+
+    for i in (1, 2):
+        await nodes.wait_for(i, [tails_hash, REV_REG_ID])
+        assert os.path.samefile(
+            nodes.paths[i] / tails_hash, nodes.paths[i] / REV_REG_ID
+        )
+        response = await clients[i].get(f"/{REV_REG_ID}")
+        assert await response.read() == data
+
+
+async def test_sync_at_startup(nodes):
+    nodes = nodes(2)
+    data, tails_hash = make_tails(10)
+    nodes.paths[0].mkdir()
+    (nodes.paths[0] / tails_hash).write_bytes(data)
+    os.link(nodes.paths[0] / tails_hash, nodes.paths[0] / REV_REG_ID)
+    # Never pulled, as a peer only replicates tails files
+    (nodes.paths[0] / "notes.txt").write_bytes(b"")
+
+    await nodes.start(0)
+    await nodes.start(1)
+    await nodes.wait_for(1, [tails_hash, REV_REG_ID])
+    with open(nodes.paths[1] / REV_REG_ID, "rb") as tails_file:
+        assert tails_file.read() == data
+
+
+@pytest.mark.parametrize(
+    "names", [["../evil"], ["notes.txt"], [""], [".staging"], ["a/b"], [1]]
+)
+async def test_announce_bad_names(nodes, names):
+    client = await nodes(2).start(0)
+    response = await client.post("/replication/announce", json={"names": names})
+    assert response.status == 400
+
+
+async def test_announce_pending_bound(nodes, monkeypatch):
+    monkeypatch.setattr(replication, "REPLICATION_MAX_PENDING", 2)
+    client = await nodes(2).start(0)
+    replicator = client.app["replicator"]
+    names = [make_tails(1, seed=bytes([i]))[1] for i in range(3)]
+
+    # Announced files stay pending until the pulls are released
+    released = asyncio.Event()
+
+    async def pull(name):
+        await released.wait()
+        return False
+
+    monkeypatch.setattr(replicator, "_pull", pull)
+
+    async def announce(names):
+        response = await client.post("/replication/announce", json={"names": names})
+        return response.status
+
+    assert await announce(names[:2]) == 202
+    # Names already pending take no more room
+    assert await announce(names[:1]) == 202
+    assert await announce(names[2:]) == 503
+
+    released.set()
+    async with asyncio.timeout(5):
+        while replicator._pending:
+            await asyncio.sleep(0.01)
+    assert await announce(names[2:]) == 202
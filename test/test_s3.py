@@ -0,0 +1,216 @@
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from conftest import make_tails
+from fakes3 import FakeS3
+
+from tails_server import s3
+from tails_server.fakeledger import FakeLedger
+from tails_server.s3 import S3Storage
+from tails_server.web import create_app
+
+BUCKET = "tails"
+PREFIX = "files/"
+PART_SIZE = 1024
+
+REV_REG_ID = "WgWxqztrNooG92RXvxSTWv:4:WgWxqztrNooG92RXvxSTWv:3:CL:20:tag:CL_ACCUM:0"
+
+
+@pytest.fixture
+async def fake_s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "AKIDEXAMPLE")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+    # Small parts, so uploads of a few KiB are multipart uploads
+    monkeypatch.setattr(s3, "S3_PART_SIZE", PART_SIZE)
+    fake = FakeS3(BUCKET)
+    async with TestServer(fake.app()) as server:
+        fake.endpoint = str(server.make_url(""))
+        yield fake
+
+
+@pytest.fixture
+async def storage(fake_s3):
+    storage = S3Storage(BUCKET, endpoint=fake_s3.endpoint, prefix=PREFIX)
+    yield storage
+    await storage.close()
+
+
+async def store(storage, name, data, tails_hash):
+    async with storage.stage() as staged:
+        await staged.write(data)
+        await staged.publish(name, tails_hash)
+
+
+async def read_all(storage, name, offset=0, length=None):
+    return b"".join([chunk async for chunk in storage.read(name, offset, length)])
+
+
+def staging_keys(fake_s3):
+    return [key for key in fake_s3.objects if key.startswith(f"{PREFIX}.staging/")]
+
+
+async def test_stage_small_file(fake_s3, storage):
+    data, tails_hash = make_tails(2)
+    await store(storage, tails_hash, data, tails_hash)
+
+    obj = fake_s3.objects[PREFIX + tails_hash]
+    assert obj.data == data
+    assert obj.metadata["x-amz-meta-tails-hash"] == tails_hash
+    assert fake_s3.uploads == {}
+    assert staging_keys(fake_s3) == []
+
+    stored = await storage.stat(tails_hash)
+    assert stored.size == len(data)
+    assert stored.tails_hash == tails_hash
+
+
+async def test_stage_multipart_file(fake_s3, storage):
+    data, tails_hash = make_tails(20)
+    async with storage.stage() as staged:
+        for start in range(0, len(data), 500):
+            await staged.write(data[start : start + 500])
+        await staged.publish(tails_hash, tails_hash)
+
+    parts = [query for _, _, query in fake_s3.requests if "partNumber" in query]
+    assert len(parts) > 1
+    assert fake_s3.objects[PREFIX + tails_hash].data == data
+    # The staging object is deleted once copied
+    assert fake_s3.uploads == {}
+    assert staging_keys(fake_s3) == []
+
+
+async def test_discard_aborts_multipart_upload(fake_s3, storage):
+    data, _ = make_tails(20)
+    async with storage.stage() as staged:
+        await staged.write(data)
+    assert fake_s3.uploads == {}
+    assert fake_s3.objects == {}
+
+
+@pytest.mark.parametrize("max_cred_num", [2, 20])
+async def test_publish_existing_file(fake_s3, storage, max_cred_num):
+    data, tails_hash = make_tails(max_cred_num)
+    await store(storage, tails_hash, data, tails_hash)
+    with pytest.raises(FileExistsError):
+        await store(storage, tails_hash, b"\0" * len(data), tails_hash)
+    assert fake_s3.objects[PREFIX + tails_hash].data == data
+    assert staging_keys(fake_s3) == []
+
+
+async def test_alias(fake_s3, storage):
+    data, tails_hash = make_tails(2)
+    await store(storage, tails_hash, data, tails_hash)
+    await storage.alias(tails_hash, REV_REG_ID)
+
+    # An alias names the file it stands for, without a copy of the data
+    alias = fake_s3.objects[PREFIX + REV_REG_ID]
+    assert alias.data == b""
+    assert alias.metadata["x-amz-meta-tails-alias-of"] == tails_hash
+    assert await read_all(storage, REV_REG_ID) == data
+    stored = await storage.stat(REV_REG_ID)
+    assert stored.size == len(data)
+    assert stored.tails_hash == tails_hash
+
+    # An alias of an alias still points at the data
+    await storage.alias(REV_REG_ID, REV_REG_ID + "2")
+    assert (
+        fake_s3.objects[PREFIX + REV_REG_ID + "2"].metadata["x-amz-meta-tails-alias-of"]
+        == tails_hash
+    )
+
+    with pytest.raises(FileExistsError):
+        await storage.alias(tails_hash, REV_REG_ID)
+    with pytest.raises(FileNotFoundError):
+        await storage.alias("missing", REV_REG_ID + "3")
+
+
+async def test_read(storage):
+    data, tails_hash = make_tails(20)
+    await store(storage, tails_hash, data, tails_hash)
+
+    assert await read_all(storage, tails_hash) == data
+    assert await read_all(storage, tails_hash, 2, 128) == data[2:130]
+    assert await read_all(storage, tails_hash, 130) == data[130:]
+    assert await read_all(storage, tails_hash, 0, 0) == b""
+    # A range past the end of the file, which the store answers with 416
+    assert await read_all(storage, tails_hash, len(data)) == b""
+    assert await read_all(storage, tails_hash, len(data) + 10, 5) == b""
+
+    with pytest.raises(FileNotFoundError):
+        await read_all(storage, "missing")
+
+
+async def test_exists(storage):
+    data, tails_hash = make_tails(2)
+    assert not await storage.exists(tails_hash)
+    await store(storage, tails_hash, data, tails_hash)
+    assert await storage.exists(tails_hash)
+    await storage.alias(tails_hash, REV_REG_ID)
+    assert await storage.exists(REV_REG_ID)
+    with pytest.raises(FileNotFoundError):
+        await storage.stat("missing")
+
+
+async def test_names(fake_s3, storage):
+    names = set()
+    for i in range(5):
+        data, tails_hash = make_tails(2, seed=bytes([i]))
+        await store(storage, tails_hash, data, tails_hash)
+        names.add(tails_hash)
+    await storage.alias(tails_hash, REV_REG_ID)
+    names.add(REV_REG_ID)
+    # Objects outside the prefix, and staging objects, are not files
+    fake_s3.objects["elsewhere"] = fake_s3.objects[PREFIX + tails_hash]
+    fake_s3.objects[f"{PREFIX}.staging/upload"] = fake_s3.objects["elsewhere"]
+
+    # Listed a couple of keys at a time, so this follows continuation tokens
+    assert await storage.names() == names
+    assert storage.location(REV_REG_ID) == f"s3://{BUCKET}/{PREFIX}{REV_REG_ID}"
+
+
+async def test_unsigned_requests_fail(fake_s3):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{fake_s3.endpoint}/{BUCKET}/any") as response:
+            assert response.status == 403
+
+
+async def test_upload_and_download(fake_s3, tmp_path):
+    data, tails_hash = make_tails(20)
+    ledger = FakeLedger()
+    ledger.add({"id": REV_REG_ID, "value": {"tailsHash": tails_hash}})
+    app = create_app(
+        {
+            "storage_path": str(tmp_path),
+            "storage_backend": "s3",
+            "s3_bucket": BUCKET,
+            "s3_endpoint": fake_s3.endpoint,
+            "s3_prefix": PREFIX,
+        }
+    )
+    app["ledger"] = ledger
+
+    async with TestClient(TestServer(app)) as client:
+        with aiohttp.MultipartWriter("form-data") as upload:
+            part = upload.append(b'{"txn": {}}')
+            part.set_content_disposition("form-data", name="genesis")
+            part = upload.append(data)
+            part.set_content_disposition("form-data", name="tails", filename="tails")
+        response = await client.put(f"/{REV_REG_ID}", data=upload)
+        assert response.status == 200, await response.text()
+        assert set(fake_s3.objects) == {PREFIX + tails_hash, PREFIX + REV_REG_ID}
+
+        response = await client.get(f"/{REV_REG_ID}")
+        assert response.status == 200
+        assert await response.read() == data
+
+        response = await client.get(
+            f"/hash/{tails_hash}", headers={"Range": "bytes=2-129"}
+        )
+        assert response.status == 206
+        assert await response.read() == data[2:130]
+
+        response = await client.get(
+            f"/{REV_REG_ID}", headers={"Range": f"bytes={len(data)}-"}
+        )
+        assert response.status == 416
+        assert response.headers["Content-Range"] == f"bytes */{len(data)}"
@@ -0,0 +1,213 @@
+import asyncio
+import os
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from conftest import make_tails
+
+from tails_server import metrics
+from tails_server.config.defaults import STAGING_DIR
+from tails_server.fakeledger import FakeLedger
+from tails_server.upload import UploadInProgressError, UploadsInProgress
+from tails_server.web import create_app
+
+REV_REG_ID = "WgWxqztrNooG92RXvxSTWv:4:WgWxqztrNooG92RXvxSTWv:3:CL:20:tag:CL_ACCUM:0"
+
+# The fake ledger checks that genesis transactions are text, and nothing more
+GENESIS = b'{"reqSignature": {}, "txn": {}}\n'
+
+
+def rev_reg_def(rev_reg_id, tails_hash, max_cred_num):
+    return {
+        "id": rev_reg_id,
+        "value": {"tailsHash": tails_hash, "maxCredNum": max_cred_num},
+    }
+
+
+@pytest.fixture
+def ledger():
+    return FakeLedger()
+
+
+@pytest.fixture
+async def client(ledger, tmp_path):
+    app = create_app({"storage_path": str(tmp_path)})
+    app["ledger"] = ledger
+    async with TestClient(TestServer(app)) as client:
+        yield client
+
+
+async def put_file(client, rev_reg_id, data):
+    with aiohttp.MultipartWriter("form-data") as upload:
+        part = upload.append(GENESIS)
+        part.set_content_disposition("form-data", name="genesis")
+        part = upload.append(data)
+        part.set_content_disposition("form-data", name="tails", filename="tails")
+    return await client.put(f"/{rev_reg_id}", data=upload)
+
+
+def lookups(outcome):
+    # Per-bucket counts, then the sum of the durations
+    counts = metrics.LEDGER_LOOKUP_DURATION.values.get((outcome,), [0])
+    return sum(counts[:-1])
+
+
+def stored(tmp_path):
+    return sorted(name for name in os.listdir(tmp_path) if name != STAGING_DIR)
+
+
+def staged(tmp_path):
+    staging_path = tmp_path / STAGING_DIR
+    return os.listdir(staging_path) if staging_path.exists() else []
+
+
+async def test_found(client, ledger, tmp_path):
+    data, tails_hash = make_tails(10)
+    ledger.add(rev_reg_def(REV_REG_ID, tails_hash, 10))
+
+    response = await put_file(client, REV_REG_ID, data)
+    assert response.status == 200, await response.text()
+    assert await response.text() == tails_hash
+    assert lookups("found") == 1
+    assert stored(tmp_path) == sorted([tails_hash, REV_REG_ID])
+
+    response = await client.get(f"/{REV_REG_ID}")
+    assert await response.read() == data
+
+    response = await put_file(client, REV_REG_ID, data)
+    assert response.status == 409
+    assert staged(tmp_path) == []
+
+
+async def test_not_found(client, tmp_path):
+    data, _ = make_tails(10)
+
+    response = await put_file(client, REV_REG_ID, data)
+    assert response.status == 404
+    assert lookups("not_found") == 1
+    assert stored(tmp_path) == []
+    assert staged(tmp_path) == []
+
+
+async def test_bad_id(client, tmp_path):
+    data, _ = make_tails(10)
+
+    response = await put_file(client, "not-a-registry-id", data)
+    assert response.status == 400
+    assert "Revocation registry ID is not valid" in await response.text()
+    assert lookups("bad_id") == 1
+    assert stored(tmp_path) == []
+
+
+async def test_ledger_error(client, ledger, tmp_path):
+    data, tails_hash = make_tails(10)
+    ledger.add(rev_reg_def(REV_REG_ID, tails_hash, 10))
+    ledger.error_rate = 1
+
+    response = await put_file(client, REV_REG_ID, data)
+    assert response.status == 500
+    assert lookups("error") == 1
+    assert stored(tmp_path) == []
+    assert staged(tmp_path) == []
+
+
+async def test_ledger_timeout(client, ledger, tmp_path):
+    data, tails_hash = make_tails(10)
+    ledger.add(rev_reg_def(REV_REG_ID, tails_hash, 10))
+    ledger.timeout_rate = 1
+    ledger.timeout = 0.05
+
+    response = await put_file(client, REV_REG_ID, data)
+    assert response.status == 500
+    assert lookups("error") == 1
+    assert stored(tmp_path) == []
+    assert staged(tmp_path) == []
+
+
+async def test_hash_mismatch(client, ledger, tmp_path):
+    data, _ = make_tails(10)
+    _, other_hash = make_tails(10, seed=b"other")
+    ledger.add(rev_reg_def(REV_REG_ID, other_hash, 10))
+
+    response = await put_file(client, REV_REG_ID, data)
+    assert response.status == 400
+    assert "tailsHash does not match" in await response.text()
+    assert metrics.HASH_MISMATCHES.values == {("upload",): 1}
+    assert stored(tmp_path) == []
+    assert staged(tmp_path) == []
+
+
+async def test_hash_mismatch_of_stored_file(client, ledger, tmp_path):
+    # A registry sharing a stored tails file must still upload that file
+    data, tails_hash = make_tails(10)
+    ledger.add(rev_reg_def(REV_REG_ID, tails_hash, 10))
+    ledger.add(rev_reg_def(REV_REG_ID + "2", tails_hash, 10))
+    response = await put_file(client, REV_REG_ID, data)
+    assert response.status == 200, await response.text()
+
+    response = await put_file(client, REV_REG_ID + "2", b"\0" * len(data))
+    assert response.status == 400
+    assert "tailsHash does not match" in await response.text()
+    assert stored(tmp_path) == sorted([tails_hash, REV_REG_ID])
+
+    response = await put_file(client, REV_REG_ID + "2", data)
+    assert response.status == 200, await response.text()
+    assert stored(tmp_path) == sorted([tails_hash, REV_REG_ID, REV_REG_ID + "2"])
+
+
+@pytest.mark.parametrize("max_cred_num", [5, 20])
+async def test_size_mismatch(client, ledger, tmp_path, max_cred_num):
+    data, tails_hash = make_tails(10)
+    ledger.add(rev_reg_def(REV_REG_ID, tails_hash, max_cred_num))
+
+    response = await put_file(client, REV_REG_ID, data)
+    assert response.status == 400
+    assert "not the correct size" in await response.text()
+    assert stored(tmp_path) == []
+    assert staged(tmp_path) == []
+
+
+async def test_claim():
+    uploads = UploadsInProgress()
+    entered = []
+
+    async def upload(name, timeout=1):
+        async with uploads.claim(name, timeout):
+            entered.append(name)
+
+    async with uploads.claim("a"):
+        # Other names are not held up
+        await upload("b")
+        with pytest.raises(UploadInProgressError):
+            await upload("a", timeout=0.01)
+        waiting = asyncio.ensure_future(upload("a"))
+        await asyncio.sleep(0.01)
+        assert entered == ["b"]
+    # The duplicate gets its turn once the upload in progress is done
+    await waiting
+    assert entered == ["b", "a"]
+    assert uploads._uploads == {}
+
+
+async def test_claim_released_on_error():
+    uploads = UploadsInProgress()
+    with pytest.raises(RuntimeError):
+        async with uploads.claim("a"):
+            raise RuntimeError()
+    async with uploads.claim("a", timeout=0.01):
+        pass
+
+
+async def test_duplicate_upload_waits(client, ledger, tmp_path):
+    data, tails_hash = make_tails(10)
+    ledger.add(rev_reg_def(REV_REG_ID, tails_hash, 10))
+
+    async with client.app["uploads"].claim(REV_REG_ID):
+        uploading = asyncio.ensure_future(put_file(client, REV_REG_ID, data))
+        await asyncio.sleep(0.05)
+        assert not uploading.done()
+        assert stored(tmp_path) == []
+    response = await uploading
+    assert response.status == 200, await response.text()
+    assert stored(tmp_path) == sorted([tails_hash, REV_REG_ID])